@@ -1,11 +1,12 @@
 from __future__ import unicode_literals
 import json
+import time
 import traceback
 
 import cherrypy
 
-from sideboard.lib import log, config, serializer
-from sideboard.websockets import trigger_delayed_notifications
+from sideboard.lib import log, config, serializer, trace_span
+from sideboard.websockets import trigger_delayed_notifications, threadlocal, get_deadline, record_timeout, DeadlineExceeded, _get_singleflight
 
 
 ERR_INVALID_RPC = -32600
@@ -40,57 +41,79 @@ cherrypy.tools.force_json_in = cherrypy.Tool('before_request_body', force_json_i
 def _make_jsonrpc_handler(services, debug=config['debug'],
                          precall=lambda body: None,
                          errback=lambda err, message: log.error(message, exc_info=True)):
-    @cherrypy.expose
-    @cherrypy.tools.force_json_in()
-    @cherrypy.tools.json_out(handler=json_handler)
-    def jsonrpc_handler(self=None):
-        id = None
-
-        def error(code, message):
-            body = {'jsonrpc': '2.0', 'id': id, 'error': {'code': code, 'message': message}}
-            log.warning('returning error message: %s', body)
-            return body
+    def error(id, code, message):
+        body = {'jsonrpc': '2.0', 'id': id, 'error': {'code': code, 'message': message}}
+        log.warning('returning error message: %s', body)
+        return body
 
-        body = cherrypy.request.json
+    def respond(body, started):
         if not isinstance(body, dict):
-            return error(ERR_INVALID_JSON, 'invalid json input {!r}'.format(cherrypy.request.body))
+            return error(None, ERR_INVALID_JSON, 'invalid json input {!r}'.format(cherrypy.request.body))
 
         log.debug('jsonrpc request body: %s', body)
 
         id, params = body.get('id'), body.get('params', [])
         if 'method' not in body:
-            return error(ERR_INVALID_RPC, '"method" field required for jsonrpc request')
+            return error(id, ERR_INVALID_RPC, '"method" field required for jsonrpc request')
 
         method = body['method']
         if method.count('.') != 1:
-            return error(ERR_MISSING_FUNC, 'invalid method ' + method)
+            return error(id, ERR_MISSING_FUNC, 'invalid method ' + method)
 
         module, function = method.split('.')
         if module not in services:
-            return error(ERR_MISSING_FUNC, 'no module ' + module)
+            return error(id, ERR_MISSING_FUNC, 'no module ' + module)
 
         service = services[module]
         if not hasattr(service, function):
-            return error(ERR_MISSING_FUNC, 'no function ' + method)
+            return error(id, ERR_MISSING_FUNC, 'no function ' + method)
 
         if not isinstance(params, (list, dict)):
-            return error(ERR_INVALID_PARAMS, 'invalid parameter list: {!r}'.format(params))
+            return error(id, ERR_INVALID_PARAMS, 'invalid parameter list: {!r}'.format(params))
 
         args, kwargs = (params, {}) if isinstance(params, list) else ([], params)
 
         precall(body)
-        try:
-            response = {'jsonrpc': '2.0', 'id': id,
-                        'result': getattr(service, function)(*args, **kwargs)}
-            log.debug('returning success message: %s', response)
-            return response
-        except Exception as e:
-            errback(e, 'unexpected jsonrpc error calling ' + method)
-            message = 'unexpected error'
-            if debug:
-                message += ': ' + traceback.format_exc()
-            return error(ERR_FUNC_EXCEPTION, message)
-        finally:
-            trigger_delayed_notifications()
+        threadlocal.set('deadline', get_deadline(body.get('timeout'), config['ws.default_timeout'], started))
+        traceparent = body.get('traceparent') or cherrypy.request.headers.get('traceparent')
+        with trace_span(method, kind='server', traceparent=traceparent) as span:
+            try:
+                threadlocal.check_deadline()
+                func = getattr(service, function)
+                flight = _get_singleflight(method, func)
+                response = {'jsonrpc': '2.0', 'id': id,
+                            'result': flight.call(func, *args, **kwargs) if flight else func(*args, **kwargs)}
+                log.debug('returning success message: %s', response)
+                return response
+            except DeadlineExceeded as e:
+                if span:
+                    span.error = e
+                record_timeout(method)
+                return error(id, ERR_FUNC_EXCEPTION, '{}: {}'.format(method, e))
+            except Exception as e:
+                if span:
+                    span.error = e
+                errback(e, 'unexpected jsonrpc error calling ' + method)
+                message = 'unexpected error'
+                if debug:
+                    message += ': ' + traceback.format_exc()
+                return error(id, ERR_FUNC_EXCEPTION, message)
+            finally:
+                trigger_delayed_notifications()
+
+    @cherrypy.expose
+    @cherrypy.tools.force_json_in()
+    @cherrypy.tools.json_out(handler=json_handler)
+    def jsonrpc_handler(self=None):
+        """
+        Handles a JSON-RPC request, or a batch of requests sent as a list, in
+        which case each is called in order and we return a list of responses.
+        """
+        body, started = cherrypy.request.json, time.time()
+        if isinstance(body, list):
+            if not body:
+                return error(None, ERR_INVALID_RPC, 'empty jsonrpc batch request')
+            return [respond(request, started) for request in body]
+        return respond(body, started)
 
     return jsonrpc_handler
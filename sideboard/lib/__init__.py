@@ -7,10 +7,11 @@ from sideboard.config import config, ConfigurationError, parse_config
 from sideboard.lib._utils import is_listy, listify, serializer, cached_property, request_cached_property, class_property, entry_point, RWGuard
 from sideboard.lib._cp import stopped, on_startup, on_shutdown, mainloop, ajax, renders_template, render_with_templates, restricted, all_restricted, register_authenticator
 from sideboard.lib._profiler import cleanup_profiler, profile, Profiler, ProfileAggregator
-from sideboard.lib._threads import DaemonTask, Caller, GenericCaller, TimeDelayQueue
-from sideboard.lib._websockets import WebSocket, Model, Subscription, MultiSubscription
-from sideboard.websockets import subscribes, locally_subscribes, notifies, notify, threadlocal
-from sideboard.lib._services import services
+from sideboard.lib._threads import DaemonTask, Caller, GenericCaller, TimeDelayQueue, FairQueue
+from sideboard.lib._tracing import trace_span, TraceViewer
+from sideboard.lib._websockets import WebSocket, AsyncWebSocket, WebSocketPool, Model, Subscription, MultiSubscription
+from sideboard.websockets import subscribes, locally_subscribes, notifies, notify, singleflight, threadlocal, DeadlineExceeded
+from sideboard.lib._services import services, ServiceUnavailable
 
 __all__ = ['log',
            'services',
@@ -19,9 +20,10 @@ __all__ = ['log',
            'stopped', 'on_startup', 'on_shutdown', 'mainloop', 'ajax', 'renders_template', 'render_with_templates',
            'restricted', 'all_restricted', 'register_authenticator',
            'cleanup_profiler', 'profile', 'Profiler', 'ProfileAggregator',
-           'DaemonTask', 'Caller', 'GenericCaller', 'TimeDelayQueue',
-           'WebSocket', 'Model', 'Subscription', 'MultiSubscription',
+           'DaemonTask', 'Caller', 'GenericCaller', 'TimeDelayQueue', 'FairQueue',
+           'trace_span', 'TraceViewer',
+           'WebSocket', 'AsyncWebSocket', 'WebSocketPool', 'Model', 'Subscription', 'MultiSubscription',
            'listify', 'serializer', 'cached_property', 'request_cached_property', 'is_listy', 'entry_point', 'RWGuard',
-           'threadlocal', 'subscribes', 'locally_subscribes', 'notifies', 'notify']
+           'threadlocal', 'subscribes', 'locally_subscribes', 'notifies', 'notify', 'singleflight', 'DeadlineExceeded', 'ServiceUnavailable']
 if six.PY2:
     __all__ = [s.encode('ascii') for s in __all__]
@@ -1,32 +1,631 @@
 from __future__ import unicode_literals
 import os
 import ssl
-
+import json
+import time
+import socket
+import select
+from io import BytesIO
+from copy import deepcopy
+from itertools import count
+from threading import RLock
+from concurrent.futures import Future
+from collections import deque, OrderedDict
+
+import six
+from six.moves.http_client import HTTPConnection, HTTPSConnection, HTTPException, RemoteDisconnected
 from rpctools.jsonrpc import ServerProxy
+from rpctools.jsonrpc.transport import Transport
+from rpctools.jsonrpc.exc import Fault, ProtocolError, ResponseError, ConnectionError as RpcConnectionError
+
+from sideboard.lib import log, config, listify, serializer, threadlocal, WebSocket, WebSocketPool, DeadlineExceeded
+from sideboard.lib._websockets import _NoResponse, _Subscriber, _SharedSubscription
+from sideboard.lib._tracing import trace_span, current_traceparent
+from sideboard.debugging import register_diagnostics_status_function
+
+
+class ServiceUnavailable(Exception):
+    """
+    Raised when a call to a remote service is rejected without being made,
+    because its circuit breaker is open or because it already has as many
+    calls in flight as it's allowed.
+    """
+
+
+class _CircuitBreaker(object):
+    """
+    Tracks the outcome of recent calls to a remote service and stops sending
+    calls to it while it's failing or too slow; see the [service_breakers]
+    config section for how each of these settings is used.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, max_concurrent=0, window=20, min_calls=10, error_rate=0.5,
+                 slow_call=0, slow_rate=0.5, open_seconds=30, half_open_calls=1, **ignored):
+        self.name = name
+        self.max_concurrent, self.min_calls, self.error_rate = max_concurrent, min_calls, error_rate
+        self.slow_call, self.slow_rate = slow_call, slow_rate
+        self.open_seconds, self.half_open_calls = open_seconds, half_open_calls
+        self.lock = RLock()
+        self.results = deque(maxlen=max(1, window))
+        self.state, self.opened_at = self.CLOSED, None
+        self.in_flight = self.probes = self.rejected = self.trips = 0
+        self.generation = 0  # incremented on every change of state
+
+    @staticmethod
+    def is_failure(e):
+        """
+        Errors raised by the remote method itself mean that the service is up,
+        and running out of time on our own deadline isn't the service's fault.
+        """
+        return isinstance(e, _NoResponse) or not isinstance(e, (AssertionError, Fault, DeadlineExceeded))
+
+    def _set_state(self, state):
+        self.state = state
+        self.generation += 1
 
-from sideboard.lib import log, config, threadlocal, WebSocket
+    def _open(self):
+        self._set_state(self.OPEN)
+        self.opened_at = time.time()
+        self.trips += 1
+        log.warning('circuit breaker for %s opened for %s seconds', self.name, self.open_seconds)
+
+    def acquire(self):
+        """
+        Reserves a call to the service, raising ServiceUnavailable if it may not
+        be made right now.  Returns a token to pass back to release, which
+        records whether this call is one of the trial calls of the half-open
+        state, since only those may decide whether the breaker closes.
+        """
+        with self.lock:
+            if self.state == self.OPEN:
+                remaining = self.opened_at + self.open_seconds - time.time()
+                if remaining > 0:
+                    self.rejected += 1
+                    raise ServiceUnavailable('circuit breaker for {} is open for another {:.1f} seconds'.format(self.name, remaining))
+                self._set_state(self.HALF_OPEN)
+                self.probes = 0
+
+            if self.state == self.HALF_OPEN and self.probes >= self.half_open_calls:
+                self.rejected += 1
+                raise ServiceUnavailable('circuit breaker for {} is waiting on trial calls'.format(self.name))
+
+            if self.max_concurrent and self.in_flight >= self.max_concurrent:
+                self.rejected += 1
+                raise ServiceUnavailable('{} already has {} calls in flight'.format(self.name, self.in_flight))
+
+            self.in_flight += 1
+            probe = self.state == self.HALF_OPEN
+            if probe:
+                self.probes += 1
+            return self.generation, probe
+
+    def release(self, failed, elapsed, token=(None, False)):
+        """
+        Records the outcome of a call reserved by acquire.  Calls which started
+        before the breaker's current half-open state (e.g. while it was still
+        closed) don't count as trial calls; their results only count towards
+        the error and slow rates if the breaker is closed when they finish.
+        """
+        generation, probe = token
+        with self.lock:
+            self.in_flight -= 1
+            slow = bool(self.slow_call) and elapsed >= self.slow_call
+            if probe and generation == self.generation and self.state == self.HALF_OPEN:
+                self.probes -= 1
+                if failed or slow:
+                    self._open()
+                else:
+                    log.info('circuit breaker for %s closed', self.name)
+                    self._set_state(self.CLOSED)
+                    self.results.clear()
+            elif self.state == self.CLOSED:
+                self.results.append((failed, slow))
+                if len(self.results) >= self.min_calls:
+                    failures, slow_calls = [sum(r[i] for r in self.results) for i in [0, 1]]
+                    if failures > self.error_rate * len(self.results) or slow_calls > self.slow_rate * len(self.results):
+                        self._open()
+
+    def wrap(self, func):
+        def call(*args, **kwargs):
+            token = self.acquire()
+            failed, start = True, time.time()
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            except Exception as e:
+                failed = self.is_failure(e)
+                raise
+            finally:
+                self.release(failed, time.time() - start, token)
+        return call
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'in_flight': self.in_flight,
+                'recent_calls': len(self.results),
+                'recent_failures': sum(failed for failed, slow in self.results),
+                'recent_slow': sum(slow for failed, slow in self.results),
+                'rejected': self.rejected,
+                'trips': self.trips
+            }
+
+
+_breakers, _breakers_lock = {}, RLock()
+
+
+def _get_breaker(name):
+    """
+    Returns the circuit breaker for the named remote service, or None if
+    breakers are turned off for that service.
+    """
+    with _breakers_lock:
+        if name not in _breakers:
+            settings = {k: v for k, v in config['service_breakers'].items() if not isinstance(v, dict)}
+            settings.update({k: v for k, v in config['service_breakers'].get(name, {}).items() if v is not None})
+            _breakers[name] = _CircuitBreaker(name, **settings) if settings['enabled'] else None
+        return _breakers[name]
+
+
+class _ResultCache(object):
+    """
+    Least-recently-used cache of the results of one remote method, keyed by
+    the arguments it was called with; see the [rpc_cache] config section for
+    how each of these settings is used.  Each entry is a list of the result,
+    the time it expires (None for entries kept fresh by a subscription), and
+    the websocket and client id of that subscription (if any).
+
+    With subscribe turned on, a miss calls the method and then subscribes to
+    it, so the remote method runs twice: once for the call, which goes through
+    the service's circuit breaker and our deadline handling like any other,
+    and once for the initial result of the subscription.  After that the entry
+    is kept fresh by the subscription with no further calls.
+    """
+    def __init__(self, method, size=100, ttl=60, subscribe=False):
+        self.method, self.size, self.ttl, self.subscribe = method, size, ttl, subscribe
+        self.lock = RLock()
+        self.entries = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def make_key(args, kwargs):
+        try:
+            return json.dumps([args, kwargs], cls=serializer, sort_keys=True, separators=(',', ':'))
+        except Exception:
+            return None
+
+    def get(self, key):
+        stale = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires, subscribed, client = entry
+                if (subscribed and subscribed.connected) or (expires and expires > time.time()):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                stale = self._remove(key)
+            self.misses += 1
+        self._unsubscribe([stale])
+        return False, None
+
+    def put(self, key, value, websocket, args, kwargs):
+        subscribe = self.subscribe and websocket is not None
+        with self.lock:
+            removed = [self._remove(key)]
+            entry = self.entries[key] = [value, time.time() + self.ttl, None, None]
+            while len(self.entries) > self.size:
+                removed.append(self._remove(next(iter(self.entries))))
+                self.evictions += 1
+        self._unsubscribe(removed)
+        if subscribe:
+            client = websocket.subscribe({
+                'callback': lambda result: self._update(key, entry, result),
+                'errback': lambda error: self._invalidate(key, entry, error)
+            }, self.method, *args, **kwargs)
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    entry[1:] = [None, websocket, client]
+                else:
+                    websocket.unsubscribe(client)
+
+    def _update(self, key, entry, result):
+        with self.lock:
+            if self.entries.get(key) is entry:
+                entry[0] = result
+
+    def _invalidate(self, key, entry, error):
+        log.warning('dropping cached result of %s after subscription error: %s', self.method, error)
+        with self.lock:
+            removed = self._remove(key) if self.entries.get(key) is entry else None
+        self._unsubscribe([removed])
+
+    def _remove(self, key):
+        """
+        Removes and returns the entry for the given key; this must be called
+        with our lock held, and the caller should pass what it removes to
+        _unsubscribe once it's released the lock, since unsubscribing sends a
+        message over the websocket.
+        """
+        return self.entries.pop(key, None)
+
+    @staticmethod
+    def _unsubscribe(entries):
+        for entry in entries:
+            if entry and entry[2]:
+                entry[2].unsubscribe(entry[3])
+
+    def clear(self):
+        with self.lock:
+            removed = [self._remove(key) for key in list(self.entries)]
+        self._unsubscribe(removed)
+
+    def wrap(self, func, websocket=None):
+        def call(*args, **kwargs):
+            key = self.make_key(args, kwargs)
+            if key is None:
+                return func(*args, **kwargs)
+
+            found, value = self.get(key)
+            if not found:
+                value = func(*args, **kwargs)
+                self.put(key, value, websocket, args, kwargs)
+            return deepcopy(value)
+        return call
+
+    @property
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else None,
+                'evictions': self.evictions
+            }
+
+
+_caches, _caches_lock = {}, RLock()
+
+
+def _get_cache(method):
+    """
+    Returns the result cache for the given "service.method", or None if the
+    results of that method aren't configured to be cached.
+    """
+    with _caches_lock:
+        if method not in _caches:
+            settings = config['rpc_cache'].get(method)
+            _caches[method] = _ResultCache(method, **settings) if settings else None
+        return _caches[method]
 
 
 class _ServiceDispatcher(object):
-    def __init__(self, services, name):
-        self.services, self.name = services, name
+    def __init__(self, services, name, remote=()):
+        self.services, self.name, self.remote = services, name, remote
 
     def __getattr__(self, method):
         from sideboard.lib import is_listy
         assert self.name in self.services, '{} is not registered as a service'.format(self.name)
         service = self.services[self.name]
+        threadlocal.check_deadline()
         assert not is_listy(getattr(service, '__all__', None)) or method in service.__all__, 'unable to call non-whitelisted method {}.{}'.format(self.name, method)
-        func = service.make_caller('{}.{}'.format(self.name, method)) if isinstance(service, WebSocket) else getattr(service, method, None)
+        func = service.make_caller('{}.{}'.format(self.name, method)) if isinstance(service, (WebSocket, WebSocketPool)) else getattr(service, method, None)
         assert func and hasattr(func, '__call__') and not method.startswith('_'), 'no such method {}.{}'.format(self.name, method)
+        if self.name not in self.remote or isinstance(func, _Subscriber):
+            return func
+
+        breaker, cache = _get_breaker(self.name), _get_cache('{}.{}'.format(self.name, method))
+        if breaker:
+            func = breaker.wrap(func)
+        if cache:
+            websocket = services._services.get(self.name)
+            func = cache.wrap(func, websocket if isinstance(websocket, (WebSocket, WebSocketPool)) else None)
         return func
 
 
+def _ssl_context(ssl_opts, validate_cert_hostname=True):
+    """
+    Given a dict of options returned by _ssl_opts, return an SSLContext with
+    those settings, which checks the server's hostname against its cert if
+    we're validating the server cert and validate_cert_hostname is set.
+    """
+    context = ssl.SSLContext(ssl_opts.get('ssl_version', ssl.PROTOCOL_TLS_CLIENT))
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_REQUIRED if ssl_opts.get('ca_certs') else ssl.CERT_NONE
+    if ssl_opts.get('ca_certs'):
+        context.load_verify_locations(ssl_opts['ca_certs'])
+        context.check_hostname = validate_cert_hostname
+    if ssl_opts.get('certfile'):
+        context.load_cert_chain(ssl_opts['certfile'], ssl_opts.get('keyfile'))
+    return context
+
+
+def _timeout(name):
+    return config[name] or None  # 0 means no timeout
+
+
+class _HTTPConnection(HTTPConnection):
+    """
+    HTTP connection which gives up connecting after jsonrpc.connect_timeout
+    seconds and then waits at most jsonrpc.read_timeout seconds on each read,
+    so a server which accepts connections but never answers can't hang us.
+    """
+    def __init__(self, pool):
+        HTTPConnection.__init__(self, pool.host, timeout=_timeout('jsonrpc.connect_timeout'))
+        self.pool = pool
+
+    def connect(self):
+        HTTPConnection.connect(self)
+        self.sock.settimeout(_timeout('jsonrpc.read_timeout'))
+
+
+class _HTTPSConnection(HTTPSConnection):
+    """
+    HTTPS connection with the same timeouts as _HTTPConnection, which offers
+    the TLS session of the most recent connection made by its pool, so that new
+    connections to a host can usually resume that session instead of paying
+    for a full handshake.
+    """
+    def __init__(self, pool):
+        HTTPSConnection.__init__(self, pool.host, context=pool.context, timeout=_timeout('jsonrpc.connect_timeout'))
+        self.pool = pool
+
+    def connect(self):
+        HTTPConnection.connect(self)
+        self.sock.settimeout(_timeout('jsonrpc.read_timeout'))
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host, session=self.pool.tls_session)
+        if self.sock.session_reused:
+            with self.pool.lock:
+                self.pool.resumed += 1
+
+
+class _HttpPool(object):
+    """
+    Thread-safe pool of keep-alive HTTP(S) connections to a single host, shared
+    by every JSON-RPC client proxy for that host.  Connections are handed out
+    most-recently-used first, and we keep up to jsonrpc.pool_size idle ones,
+    closing any which have been idle for more than jsonrpc.idle_timeout seconds.
+    """
+    def __init__(self, scheme, host, ssl_opts=None, validate_cert_hostname=True):
+        self.scheme, self.host = scheme, host
+        self.context = _ssl_context(ssl_opts or {}, validate_cert_hostname) if scheme == 'https' else None
+        self.lock = RLock()
+        self.idle = deque()
+        self.tls_session = None
+        self.in_use = self.created = self.reused = self.resumed = self.expired = self.errors = 0
+
+    def _expired(self, last_used):
+        return time.time() - last_used > config['jsonrpc.idle_timeout']
+
+    @staticmethod
+    def _dropped(conn):
+        """
+        Returns whether the server has closed this idle connection, in which
+        case its socket is readable (there's nothing else it could be sending).
+        """
+        try:
+            return conn.sock is None or bool(select.select([conn.sock], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+
+    def acquire(self):
+        """Returns a tuple of (connection, whether it's been used before)."""
+        with self.lock:
+            self.in_use += 1
+            while self.idle:
+                conn, last_used = self.idle.pop()
+                if not self._expired(last_used) and not self._dropped(conn):
+                    self.reused += 1
+                    return conn, True
+                self.expired += 1
+                conn.close()
+            self.created += 1
+        return (_HTTPSConnection(self) if self.context else _HTTPConnection(self)), False
+
+    def release(self, conn, reusable=True):
+        with self.lock:
+            self.in_use -= 1
+            if not reusable:
+                self.errors += 1
+            while self.idle and self._expired(self.idle[0][1]):
+                self.expired += 1
+                self.idle.popleft()[0].close()
+            if self.context and conn.sock is not None:
+                self.tls_session = conn.sock.session
+            if reusable and conn.sock is not None and len(self.idle) < config['jsonrpc.pool_size']:
+                self.idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                'idle': len(self.idle),
+                'in_use': self.in_use,
+                'created': self.created,
+                'reused': self.reused,
+                'tls_resumed': self.resumed,
+                'expired': self.expired,
+                'errors': self.errors
+            }
+
+
+_http_pools, _http_pools_lock = {}, RLock()
+
+
+def _get_http_pool(scheme, host, ssl_opts=None, validate_cert_hostname=True):
+    with _http_pools_lock:
+        if (scheme, host) not in _http_pools:
+            _http_pools[scheme, host] = _HttpPool(scheme, host, ssl_opts, validate_cert_hostname)
+        return _http_pools[scheme, host]
+
+
+class _PooledTransport(Transport):
+    """
+    rpctools transport which sends each request over a connection from an
+    _HttpPool.  The response body is read before the connection is returned to
+    the pool, so we return it wrapped in a file-like object.  The pool doesn't
+    hand out idle connections which the server has visibly closed, but if the
+    server closes one just as we send a request on it (i.e. it hangs up without
+    sending any response), we retry the request once on a new connection.  We never retry other errors, since the
+    server may have already received the request, and JSON-RPC calls aren't
+    necessarily safe to make twice.
+    """
+    def __init__(self, pool):
+        Transport.__init__(self)
+        self.pool = pool
+
+    def request(self, host, handler, body, headers=None, verbose=False):
+        headers = dict(headers or {}, **{
+            'User-Agent': self.user_agent,
+            'Content-Type': 'application/json',
+            'Connection': 'keep-alive'
+        })
+        body = body.encode('utf-8') if isinstance(body, six.text_type) else body
+        for attempt in range(2):
+            conn, reused = self.pool.acquire()
+            try:
+                conn.request('POST', handler, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (socket.error, HTTPException) as e:
+                self.pool.release(conn, reusable=False)
+                if attempt == 0 and reused and isinstance(e, RemoteDisconnected):
+                    continue
+                raise RpcConnectionError('Error connecting to host {}: {!r}'.format(host, e))
+
+            self.pool.release(conn, reusable=not response.will_close)
+            if response.status != 200:
+                raise ProtocolError(host + handler, response.status, response.reason, headers)
+            return BytesIO(data)
+
+
+def _jsonrpc_result(method, decoded):
+    """
+    Given the decoded JSON-RPC response to a call to the given method, return
+    its result or raise the appropriate rpctools exception.
+    """
+    if decoded is None:
+        return None
+    elif decoded.get('error'):
+        raise Fault(decoded['error']['code'], decoded['error']['message'])
+    elif 'result' not in decoded:
+        raise ResponseError('Malformed JSON-RPC response to {}: {!r}'.format(method, decoded)[:256])
+    else:
+        return decoded['result']
+
+
+class _JsonrpcBatcher(object):
+    """
+    Coalesces JSON-RPC calls to one endpoint which are made within a few
+    milliseconds of each other into a single batch request.  The first call
+    to arrive waits for the batch window and then sends every call which has
+    arrived since, while the others wait for their responses.
+    """
+    def __init__(self, pool, handler):
+        self.pool, self.handler = pool, handler
+        self.transport = _PooledTransport(pool)
+        self.lock = RLock()
+        self.ids = count(1)
+        self.pending, self.collecting = [], False
+        self.batches = self.calls = 0
+
+    def call(self, data, headers, window):
+        future = Future()
+        with self.lock:
+            data['id'] = next(self.ids)
+            self.pending.append((data, future))
+            leader = not self.collecting
+            self.collecting = True
+
+        if leader:
+            time.sleep(window)
+            with self.lock:
+                batch, self.pending, self.collecting = self.pending, [], False
+                self.batches += 1
+                self.calls += len(batch)
+            self._send(batch, headers)
+        return future.result()
+
+    def _send(self, batch, headers):
+        try:
+            body = json.dumps([data for data, future in batch] if len(batch) > 1 else batch[0][0], cls=serializer)
+            response = self.transport.request(self.pool.host, self.handler, body, headers=headers)
+            decoded = json.loads(response.read().decode('utf-8'))
+        except Exception as e:
+            for data, future in batch:
+                future.set_exception(e)
+            return
+
+        responses = {r.get('id'): r for r in listify(decoded) if isinstance(r, dict)}
+        for data, future in batch:
+            if len(batch) == 1:
+                future.set_result(decoded)
+            elif data['id'] in responses:
+                future.set_result(responses[data['id']])
+            else:
+                future.set_exception(ResponseError('no response to batched call to {}: {!r}'.format(data['method'], decoded)[:256]))
+
+
+_batchers, _batchers_lock = {}, RLock()
+
+
+def _get_batcher(pool, handler):
+    with _batchers_lock:
+        if (pool, handler) not in _batchers:
+            _batchers[pool, handler] = _JsonrpcBatcher(pool, handler)
+        return _batchers[pool, handler]
+
+
+class _ServerProxy(ServerProxy):
+    """
+    JSON-RPC client proxy which passes along the remaining time before the
+    deadline of the current request (if any) as the "timeout" field of each
+    outgoing request, so the remote server knows when to give up, and records
+    each call as a tracing span whose traceparent is sent along with it.
+
+    Requests are sent over the shared keep-alive connections of the _HttpPool
+    for the remote host, and if batch_window is set then calls made within
+    that many seconds of each other are sent together as a batch request.
+    """
+    def __init__(self, uri, batch_window=0, **kwargs):
+        ServerProxy.__init__(self, uri, **kwargs)
+        self.transport = _PooledTransport(_get_http_pool(self.type, self.host, self.ssl_opts, self.validate_cert_hostname))
+        self.batch_window = batch_window
+
+    def _prepare_request(self, data, headers):
+        remaining = threadlocal.time_remaining()
+        if remaining is not None:
+            threadlocal.check_deadline()
+            data['timeout'] = remaining
+        traceparent = current_traceparent()
+        if traceparent:
+            data['traceparent'] = traceparent
+
+    def _request(self, methodname, params):
+        with trace_span(methodname, kind='client'):
+            if not self.batch_window:
+                return ServerProxy._request(self, methodname, params)
+
+            data, headers = {'method': methodname, 'params': params}, dict(self.extra_headers)
+            self._prepare_request(data, headers)
+            decoded = _get_batcher(self.transport.pool, self.handler).call(data, headers, self.batch_window)
+            return _jsonrpc_result(methodname, decoded)
+
+
 class _JsonrpcServices(object):
     def __init__(self, services):
         self.services = services
 
     def __getattr__(self, name):
-        return _ServiceDispatcher(self.services, name)
+        return _ServiceDispatcher(self.services, name, remote=self.services)
 
 
 class _Services(object):
@@ -60,7 +659,7 @@ class _Services(object):
     'Hello World!'
     """
     def __init__(self):
-        self._services, self._jsonrpc, self._websockets = {}, {}, {}
+        self._services, self._jsonrpc, self._websockets, self._pools = {}, {}, {}, {}
         self.jsonrpc = _JsonrpcServices(self._jsonrpc)
 
     def register(self, service, name=None, _jsonrpc=None, _override=False):
@@ -99,20 +698,38 @@ class _Services(object):
             self._websockets[url] = WebSocket(url, connect_immediately=connect_immediately, **ws_kwargs)
         return self._websockets[url]
 
+    def _register_pool(self, hosts, rpc_services):
+        """
+        Return the WebSocketPool for the given list of hosts, creating it with
+        pool_size connections to each host (as configured in the subsection for
+        that host in the given [rpc_services] config section) if necessary.
+        """
+        key = tuple(hosts)
+        if key not in self._pools:
+            websockets = []
+            for host in hosts:
+                section = rpc_services.get(host, {})
+                rpc_opts = _rpc_opts(host, section)
+                for i in range(max(1, section.get('pool_size', 1))):
+                    websockets.append(WebSocket(_ws_url(host, rpc_opts), ssl_opts=_ssl_opts(rpc_opts), connect_immediately=False))
+            self._pools[key] = WebSocketPool(websockets, balance=config['ws.pool_balance'])
+        return self._pools[key]
+
     def get_websocket(self, service_name=None):
         """
         Return the websocket connection to the machine that the specified service
-        is running on, or a websocket connection to localhost if the service is
-        unknown or not provided.
+        is running on (which is a WebSocketPool if the service is configured with
+        more than one connection), or a websocket connection to localhost if the
+        service is unknown or not provided.
         """
         for name, service in self._services.items():
-            if name == service_name and isinstance(service, WebSocket):
+            if name == service_name and isinstance(service, (WebSocket, WebSocketPool)):
                 return service
         else:
             return self._register_websocket()
 
     def __getattr__(self, name):
-        return _ServiceDispatcher(self._services, name)
+        return _ServiceDispatcher(self._services, name, remote=self._jsonrpc)
 
 services = _Services()
 
@@ -190,17 +807,28 @@ def _register_rpc_services(rpc_services):
 
     This function takes the [rpc_services] config section from either Sideboard
     itself or one of its plugins and registers all remote services found there.
+    A service may be configured with a list of hosts, and each host may have a
+    pool_size option; in that case we register a WebSocketPool which balances
+    calls across all of those connections.  JSON-RPC calls always go to the
+    first host in the list.
     """
-    for service_name, host in rpc_services.items():
-        if not isinstance(host, dict):
+    for service_name, hosts in rpc_services.items():
+        if not isinstance(hosts, dict):
+            hosts = listify(hosts)
+            host = hosts[0]
             rpc_opts = _rpc_opts(host, rpc_services.get(host, {}))
             ssl_opts = _ssl_opts(rpc_opts)
 
             jsonrpc_url = '{protocol}://{host}/jsonrpc'.format(host=host, protocol='https' if rpc_opts['ca'] else 'http')
-            jproxy = ServerProxy(jsonrpc_url, ssl_opts=ssl_opts, validate_cert_hostname=bool(rpc_opts['ca']))
+            batch_window = rpc_services.get(host, {}).get('jsonrpc_batch_window', 0)
+            jproxy = _ServerProxy(jsonrpc_url, batch_window=batch_window, ssl_opts=ssl_opts, validate_cert_hostname=bool(rpc_opts['ca']))
             jservice = getattr(jproxy, service_name)
             if rpc_services.get(host, {}).get('jsonrpc_only'):
                 service = jservice
+            elif len(hosts) == 1 and rpc_services.get(host, {}).get('pool_size', 1) <= 1:
+                service = services._register_websocket(_ws_url(host, rpc_opts), ssl_opts=ssl_opts, connect_immediately=False)
+            else:
+                service = services._register_pool(hosts, rpc_services)
 
             services.register(service, service_name, _jsonrpc=jservice, _override=True)
 
@@ -219,3 +847,61 @@ class _SideboardCoreServices(object):
         log.debug('sideboard.poll by user %s', threadlocal.get('username'))
 
 services.register(_SideboardCoreServices(), 'sideboard')
+
+
+@register_diagnostics_status_function
+def service_breakers():
+    with _breakers_lock:
+        breakers = sorted((name, breaker) for name, breaker in _breakers.items() if breaker)
+    return '\n'.join('{}: {}'.format(name, ', '.join('{}={}'.format(k, v) for k, v in sorted(breaker.stats.items()))) for name, breaker in breakers)
+
+
+@register_diagnostics_status_function
+def websocket_pools():
+    out = []
+    for hosts, pool in services._pools.items():
+        out.append('{} ({})'.format(', '.join(hosts), pool.balance))
+        for stats in pool.stats:
+            out.append('    {url}: connected={connected} ejected={ejected} outstanding={outstanding} '
+                       'errors={errors} latency={latency} subscriptions={subscriptions}'.format(**stats))
+    return '\n'.join(out)
+
+
+@register_diagnostics_status_function
+def websocket_reconnects():
+    return '\n'.join('{}: {}'.format(ws.url, ', '.join('{}={}'.format(k, v) for k, v in sorted(ws.reconnect_stats.items())))
+                     for ws in sorted(WebSocket._instances, key=lambda ws: ws.url))
+
+
+@register_diagnostics_status_function
+def remote_websocket_ping_times():
+    return '\n'.join('{}: {}'.format(ws.url, ', '.join('{}={}'.format(k, v) for k, v in sorted(ws.rtt.stats.items())))
+                     for ws in sorted(WebSocket._instances, key=lambda ws: ws.url))
+
+
+@register_diagnostics_status_function
+def passthrough_subscriptions():
+    return '\n'.join('{} {}: {} subscribers'.format(url, method, subscribers)
+                     for url, method, subscribers in sorted(_SharedSubscription.stats()))
+
+
+@register_diagnostics_status_function
+def rpc_caches():
+    with _caches_lock:
+        caches = sorted((method, cache) for method, cache in _caches.items() if cache)
+    return '\n'.join('{}: {}'.format(method, ', '.join('{}={}'.format(k, v) for k, v in sorted(cache.stats.items()))) for method, cache in caches)
+
+
+@register_diagnostics_status_function
+def jsonrpc_connection_pools():
+    with _http_pools_lock:
+        pools = sorted(_http_pools.items())
+    with _batchers_lock:
+        batchers = list(_batchers.values())
+    out = []
+    for (scheme, host), pool in pools:
+        out.append('{}://{}: {}'.format(scheme, host, ', '.join('{}={}'.format(k, v) for k, v in sorted(pool.stats.items()))))
+        for batcher in batchers:
+            if batcher.pool is pool:
+                out.append('    {} batches={} calls={}'.format(batcher.handler, batcher.batches, batcher.calls))
+    return '\n'.join(out)
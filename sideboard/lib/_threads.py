@@ -8,6 +8,7 @@ import traceback
 import threading
 from warnings import warn
 from threading import Thread, Timer, Event, Lock
+from collections import deque, OrderedDict
 
 import six
 from six.moves.queue import Queue, Empty
@@ -158,9 +159,58 @@ class TimeDelayQueue(Queue):
                     break
 
 
+class FairQueue(Queue):
+    """
+    A queue which schedules items by priority class and then fairly between
+    "flows" within each class.  Lower priority numbers are always served first;
+    within a priority class each flow (e.g. a user or a connection) gets its
+    turn in round-robin order, taking up to "weight" items per turn, so a flow
+    which enqueues hundreds of items can't make everyone else wait behind it.
+    Items in the same flow and priority class are always returned in the order
+    they were added.
+    """
+    def put(self, item, block=True, timeout=None, priority=0, flow=None, weight=1):
+        Queue.put(self, (priority, flow, weight, item), block, timeout)
+
+    def _init(self, maxsize):
+        self.classes = {}
+        self.size = 0
+
+    def _qsize(self, len=len):
+        return self.size
+
+    def _put(self, item):
+        priority, flow, weight, item = item
+        flows = self.classes.setdefault(priority, OrderedDict())
+        if flow not in flows:
+            weight = max(1, weight)
+            flows[flow] = [deque(), weight, weight]
+        flows[flow][0].append(item)
+        self.size += 1
+
+    def _get(self):
+        priority = min(self.classes)
+        flows = self.classes[priority]
+        flow, state = next(iter(flows.items()))
+        items, weight, credit = state
+        item = items.popleft()
+        self.size -= 1
+        if not items:
+            del flows[flow]
+            if not flows:
+                del self.classes[priority]
+        elif credit > 1:
+            state[2] -= 1
+        else:
+            state[2] = weight
+            del flows[flow]
+            flows[flow] = state
+        return item
+
+
 class Caller(DaemonTask):
-    def __init__(self, func, interval=0, threads=1, name=None):
-        self.q = Queue()
+    def __init__(self, func, interval=0, threads=1, name=None, queue=None):
+        self.q = Queue() if queue is None else queue
         DaemonTask.__init__(self, self.call, interval=interval, threads=threads, name=name or func.__name__)
         self.callee = func
 
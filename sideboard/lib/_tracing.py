@@ -0,0 +1,219 @@
+"""
+Lightweight distributed tracing for Sideboard RPC calls.
+
+Every incoming websocket or JSON-RPC call is recorded as a "span" with its
+timing, and each span belongs to a "trace" which is identified by a trace id.
+A call which arrives without a trace starts a new one; while it's being
+handled, the trace id and the id of its span are stored in threadlocal, and
+any calls it makes to remote services (over websockets or JSON-RPC) are
+recorded as their own spans and send along a W3C-style "traceparent" field, so
+the remote Sideboard server records its spans as part of the same trace.
+
+Plugins can record spans of their own with the trace_span context manager::
+
+    from sideboard.lib import trace_span
+
+    def monthly_report():
+        with trace_span('reports.load_rows'):
+            rows = load_rows()
+
+The most recent spans are kept in memory and can be viewed as JSON by mounting
+a TraceViewer, and may also be appended to an NDJSON file; see the tracing.*
+options in configspec.ini.
+"""
+from __future__ import unicode_literals
+import json
+import time
+import random
+from threading import RLock
+from collections import deque, defaultdict
+
+import cherrypy
+
+import sideboard.lib
+from sideboard.lib import log, config, serializer, ajax, on_shutdown
+
+
+def _new_id(bits):
+    return '{:0{}x}'.format(random.getrandbits(bits), bits // 4)
+
+
+def parse_traceparent(traceparent):
+    """
+    Returns the (trace_id, span_id) tuple from a traceparent string in the
+    format "00-<32 hex digit trace id>-<16 hex digit span id>-<flags>", or
+    (None, None) if it's missing or not in that format.
+    """
+    try:
+        version, trace_id, span_id, flags = traceparent.split('-')
+        assert len(trace_id) == 32 and len(span_id) == 16
+        int(trace_id, 16), int(span_id, 16)
+    except:
+        return None, None
+    else:
+        return trace_id.lower(), span_id.lower()
+
+
+def current_traceparent():
+    """Returns the traceparent for the span currently being recorded in this thread, if any."""
+    trace_id, span_id = sideboard.lib.threadlocal.get('trace_id'), sideboard.lib.threadlocal.get('span_id')
+    return '00-{}-{}-01'.format(trace_id, span_id) if trace_id and span_id else None
+
+
+class _Span(object):
+    def __init__(self, name, kind, trace_id, parent_id):
+        self.name, self.kind, self.parent_id = name, kind, parent_id
+        self.trace_id, self.span_id = trace_id or _new_id(128), _new_id(64)
+        self.start, self.duration, self.error = time.time(), None, None
+
+    @property
+    def traceparent(self):
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+    def activate(self):
+        sideboard.lib.threadlocal.set('trace_id', self.trace_id)
+        sideboard.lib.threadlocal.set('span_id', self.span_id)
+
+    def finish(self, error=None):
+        if self.duration is None:
+            self.duration = time.time() - self.start
+            error = error or self.error
+            self.error = None if error is None else '{}: {}'.format(type(error).__name__, error)
+            _exporter.export(self)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'start': self.start,
+            'duration': self.duration,
+            'error': self.error
+        }
+
+
+def start_span(name, kind='internal', traceparent=None, activate=True):
+    """
+    Starts recording a span and returns it, or returns None if tracing is off.
+    Server spans continue the trace of the given traceparent, or start a new
+    trace if there isn't one; other spans are children of the span currently
+    being recorded in this thread, and client spans (calls we're making to
+    other servers) are only recorded as part of an existing trace.  Unless the
+    activate parameter is False, the new span becomes the current span in
+    threadlocal.  The caller is responsible for calling finish() on the span.
+    """
+    if not config['tracing.enabled']:
+        return None
+
+    if kind == 'server':
+        trace_id, parent_id = parse_traceparent(traceparent)
+    else:
+        trace_id, parent_id = sideboard.lib.threadlocal.get('trace_id'), sideboard.lib.threadlocal.get('span_id')
+        if kind == 'client' and not trace_id:
+            return None
+
+    span = _Span(name, kind, trace_id, parent_id)
+    if activate:
+        span.activate()
+    return span
+
+
+class trace_span(object):
+    """
+    Context manager which records the code it wraps as a span, which is made
+    the current span in threadlocal until the block exits; the span (or None,
+    if tracing is off) is returned by __enter__.  If finish is False then the
+    span isn't finished when the block exits without an exception, which is
+    useful for calls whose responses arrive later, in which case the caller
+    must call finish() on the span itself.
+    """
+    def __init__(self, name, kind='internal', traceparent=None, finish=True):
+        self.name, self.kind, self.traceparent, self.finish = name, kind, traceparent, finish
+
+    def __enter__(self):
+        self.previous = sideboard.lib.threadlocal.get('trace_id'), sideboard.lib.threadlocal.get('span_id')
+        self.span = start_span(self.name, self.kind, self.traceparent)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.span:
+            sideboard.lib.threadlocal.set('trace_id', self.previous[0])
+            sideboard.lib.threadlocal.set('span_id', self.previous[1])
+            if self.finish or exc_value is not None:
+                self.span.finish(exc_value)
+
+
+class _SpanExporter(object):
+    """
+    Keeps the most recent tracing.buffer_size finished spans in memory, and
+    appends each of them to tracing.ndjson_path as a line of JSON if it's set.
+    """
+    def __init__(self):
+        self.lock = RLock()
+        self.spans = deque()
+        self.file = None
+
+    def export(self, span):
+        record = span.to_dict()
+        with self.lock:
+            if self.spans.maxlen != config['tracing.buffer_size']:
+                self.spans = deque(self.spans, maxlen=config['tracing.buffer_size'])
+            self.spans.append(record)
+
+            path = config['tracing.ndjson_path']
+            if path:
+                try:
+                    if not self.file or self.file.name != path:
+                        self.close()
+                        self.file = open(path, 'a', buffering=1)
+                    self.file.write(json.dumps(record, cls=serializer, separators=(',', ':'), sort_keys=True) + '\n')
+                except:
+                    log.warning('unable to write span to %s', path, exc_info=True)
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    def traces(self, trace_id=None, min_duration=0, limit=100):
+        """
+        Returns the most recent traces, newest first, as a list of dictionaries
+        with the trace id, the start time and duration of the whole trace (as
+        far as the spans we have recorded can tell), and the list of its spans.
+        """
+        with self.lock:
+            spans = list(self.spans)
+
+        by_trace = defaultdict(list)
+        for span in spans:
+            if trace_id is None or span['trace_id'] == trace_id:
+                by_trace[span['trace_id']].append(span)
+
+        traces = []
+        for id, spans in by_trace.items():
+            start = min(span['start'] for span in spans)
+            duration = max(span['start'] + span['duration'] for span in spans) - start
+            if duration >= min_duration:
+                spans.sort(key=lambda span: span['start'])
+                traces.append({'trace_id': id, 'start': start, 'duration': duration, 'spans': spans})
+        traces.sort(key=lambda trace: trace['start'], reverse=True)
+        return traces[:limit]
+
+_exporter = _SpanExporter()
+on_shutdown(_exporter.close)
+
+
+class TraceViewer(object):
+    """
+    CherryPy application which returns the most recently recorded traces as
+    JSON; plugins which want to expose this can mount it wherever they want,
+    e.g. cherrypy.tree.mount(TraceViewer(), '/traces').  The optional trace_id,
+    min_duration (in seconds) and limit query parameters filter the results.
+    """
+    @cherrypy.expose
+    @ajax
+    def index(self, trace_id=None, min_duration=0, limit=100):
+        return _exporter.traces(trace_id=trace_id, min_duration=float(min_duration), limit=int(limit))
@@ -2,50 +2,317 @@ from __future__ import unicode_literals
 import os
 import sys
 import json
+import time
+import heapq
+import random
+import select
+import asyncio
+import weakref
+from bisect import bisect_left
 from copy import deepcopy
 from itertools import count
-from threading import RLock, Event
+from concurrent.futures import Future, wait
+from threading import RLock, Event, Condition, Thread
 from datetime import datetime, timedelta
 from collections.abc import Mapping, MutableMapping
 
 import six
-from ws4py.client.threadedclient import WebSocketClient
+from ws4py.client import WebSocketBaseClient
+from ws4py.manager import WebSocketManager, EPollPoller, SelectPoller
 
 import sideboard.lib
-from sideboard.lib import log, config, stopped, on_startup, on_shutdown, DaemonTask, Caller
+from sideboard.lib import log, config, stopped, on_startup, on_shutdown, GenericCaller
+from sideboard.lib import _tracing
 
 
-class _WebSocketClientDispatcher(WebSocketClient):
+class _NoResponse(AssertionError):
+    """
+    Raised for a call which never got a response, because it timed out or the
+    connection was closed, as opposed to one which got an error response.
+    """
+
+
+class _ScheduledCall(object):
+    def __init__(self, when, func, args):
+        self.when, self.func, self.args = when, func, args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _Scheduler(object):
+    """
+    Runs functions at a scheduled time in a single background thread which is
+    shared by all WebSocket instances, so that timers (such as the expiration
+    of outstanding calls) don't each need their own thread.  The thread sleeps
+    until the next scheduled call is due, so it costs nothing while idle.
+    """
+    def __init__(self):
+        self.calls = []
+        self.counter = count()
+        self.condition = Condition()
+        self.thread = None
+
+    def schedule(self, delay, func, *args):
+        """
+        Call func(*args) after delay seconds; returns an object with a cancel()
+        method which may be used to cancel the call before it happens.
+        """
+        call = _ScheduledCall(time.time() + delay, func, args)
+        with self.condition:
+            heapq.heappush(self.calls, (call.when, next(self.counter), call))
+            if not self.thread or not self.thread.is_alive():
+                self.thread = Thread(target=self._run, name='ws_scheduler')
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+        return call
+
+    def _next_call(self):
+        with self.condition:
+            while not self.calls or self.calls[0][0] > time.time():
+                self.condition.wait(self.calls[0][0] - time.time() if self.calls else None)
+            return heapq.heappop(self.calls)[-1]
+
+    def _run(self):
+        while True:
+            call = self._next_call()
+            if not call.cancelled:
+                try:
+                    call.func(*call.args)
+                except:
+                    log.error('unexpected error in scheduled call to %s', call.func, exc_info=True)
+
+_scheduler = _Scheduler()
+
+
+class _Poller(EPollPoller if hasattr(select, 'epoll') else SelectPoller):
+    def unregister(self, fd):
+        """
+        A websocket may be closed by another thread while the manager thread is
+        reading from it, in which case both of them try to unregister it; this
+        isn't an error and must not kill the manager thread.
+        """
+        try:
+            super(_Poller, self).unregister(fd)
+        except (KeyError, ValueError, OSError):
+            pass
+
+
+class _Reactor(object):
+    """
+    Owns the background threads which are shared by every outbound WebSocket,
+    so that the number of threads doesn't grow with the number of connections:
+    - a single ws4py WebSocketManager thread which polls all open connections
+        and reads incoming messages as they arrive
+    - a pool of dispatch threads which run the callbacks for those messages;
+        each connection is always dispatched by the same thread, so messages
+        from any one connection are still handled in the order they arrived
+    - a pool of connect threads for work which blocks on the network, such as
+        connection attempts and sending polls
+    """
+    def __init__(self):
+        self.lock = RLock()
+        self.manager = None
+        self.dispatchers = [GenericCaller(name='ws_dispatch_{}'.format(i + 1)) for i in range(max(1, config['ws.client_dispatch_threads']))]
+        self.connector = GenericCaller(threads=max(1, config['ws.client_connect_threads']), name='ws_connect')
+
+    def start(self):
+        with self.lock:
+            if self.manager is None or not self.manager.is_alive():
+                self.manager = WebSocketManager(poller=_Poller())
+                self.manager.name = 'ws_reactor'
+                self.manager.daemon = True
+                self.manager.start()
+            for caller in self.dispatchers + [self.connector]:
+                caller.start()
+
+    def stop(self):
+        with self.lock:
+            if self.manager is not None:
+                self.manager.running = False
+                self.manager.join(1)
+                self.manager.stop()
+                self.manager = None
+
+    def add(self, ws):
+        with self.lock:
+            self.start()
+            self.manager.add(ws)
+
+    def remove(self, ws):
+        with self.lock:
+            if self.manager is not None and ws.sock:
+                try:
+                    self.manager.remove(ws)
+                except Exception:
+                    log.debug('error removing websocket %s from reactor', ws.url, exc_info=True)
+
+    def dispatch(self, websocket, message):
+        self.dispatchers[hash(websocket) % len(self.dispatchers)].defer(websocket._dispatch, message)
+
+    def defer(self, func, *args):
+        self.connector.defer(func, *args)
+
+_reactor = _Reactor()
+on_shutdown(_reactor.stop, priority=75)
+
+
+class _RttHistogram(object):
+    """
+    Counts round trip times in buckets whose upper bounds (in milliseconds) are
+    given by BUCKETS, which is enough to estimate percentiles without keeping
+    every sample around.
+    """
+    BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.lock = RLock()
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count, self.total, self.max, self.last = 0, 0.0, 0.0, None
+
+    def add(self, seconds):
+        ms = 1000 * seconds
+        with self.lock:
+            self.counts[bisect_left(self.BUCKETS, ms)] += 1
+            self.count += 1
+            self.total += ms
+            self.max = max(self.max, ms)
+            self.last = ms
+
+    def merge(self, other):
+        with self.lock, other.lock:
+            self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+            self.count += other.count
+            self.total += other.total
+            self.max = max(self.max, other.max)
+            self.last = other.last if other.last is not None else self.last
+        return self
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound (in milliseconds) of the bucket containing the
+        given percentile, or None if we haven't recorded anything yet.
+        """
+        with self.lock:
+            seen = 0
+            for i, bucket_count in enumerate(self.counts):
+                seen += bucket_count
+                if seen and seen >= self.count * percent / 100.0:
+                    return self.BUCKETS[i] if i < len(self.BUCKETS) else round(self.max, 1)
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                'count': self.count,
+                'last': None if self.last is None else round(self.last, 1),
+                'mean': round(self.total / self.count, 1) if self.count else None,
+                'max': round(self.max, 1) if self.count else None,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99)
+            }
+
+
+class _Liveness(object):
+    """
+    Tracks the websocket protocol pings we've sent over a connection.  We send a
+    ping every ws.ping_interval seconds and consider the other end dead once
+    ws.ping_misses of them in a row have gone without a pong, which finds a
+    half-open connection within seconds without involving the RPC machinery.
+    The round trip time of each ping is recorded in our rtt histogram.
+    """
+    def __init__(self):
+        self.lock = RLock()
+        self.counter = count()
+        self.rtt = _RttHistogram()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.outstanding, self.last_ping = {}, None
+
+    @property
+    def next_ping(self):
+        return time.time() if self.last_ping is None else self.last_ping + config['ws.ping_interval']
+
+    @property
+    def ping_due(self):
+        return bool(config['ws.ping_interval']) and self.next_ping <= time.time()
+
+    @property
+    def missed(self):
+        return len(self.outstanding)
+
+    @property
+    def dead(self):
+        return self.missed >= max(1, config['ws.ping_misses'])
+
+    def ping(self):
+        """Records that we're sending a ping and returns the payload to send with it."""
+        with self.lock:
+            payload = six.text_type(next(self.counter))
+            self.outstanding[payload] = self.last_ping = time.time()
+            return payload
+
+    def ponged(self, data):
+        """Records a pong and returns the round trip time of its ping, if it's one we sent."""
+        data = data.decode('utf-8') if isinstance(data, bytes) else six.text_type(data)
+        with self.lock:
+            sent = self.outstanding.pop(data, None)
+            if sent is not None:
+                elapsed = time.time() - sent
+                self.rtt.add(elapsed)
+                self.outstanding = {payload: when for payload, when in self.outstanding.items() if when > sent}
+                return elapsed
+
+
+class _WebSocketClientDispatcher(WebSocketBaseClient):
     def __init__(self, dispatcher, url, ssl_opts=None):
         self.connected = False
         self.dispatcher = dispatcher
-        WebSocketClient.__init__(self, url, ssl_options=ssl_opts)
+        WebSocketBaseClient.__init__(self, url, ssl_options=ssl_opts)
 
     def pre_connect(self):
         pass
 
     def connect(self, *args, **kwargs):
         self.pre_connect()
-        WebSocketClient.connect(self, *args, **kwargs)
+        WebSocketBaseClient.connect(self, *args, **kwargs)
         self.connected = True
+        try:
+            _reactor.add(self)
+        except:
+            self.connected = False
+            self.close_connection()
+            raise
+
+    def closed(self, code, reason=None):
+        self.connected = False
+        self.dispatcher.disconnected()
 
     def close(self, code=1000, reason=''):
+        _reactor.remove(self)
         try:
-            WebSocketClient.close(self, code=code, reason=reason)
+            WebSocketBaseClient.close(self, code=code, reason=reason)
         except:
             pass
         try:
-            WebSocketClient.close_connection(self)
+            WebSocketBaseClient.close_connection(self)
         except:
             pass
-        self.connected = False
+        if self.connected:
+            self.connected = False
+            self.dispatcher.disconnected()
 
     def send(self, data):
         log.debug('sending %s', data)
         assert self.connected, 'tried to send data on closed websocket {!r}'.format(self.url)
         if isinstance(data, Mapping):
             data = json.dumps(data)
-        return WebSocketClient.send(self, data)
+        return WebSocketBaseClient.send(self, data)
 
     def received_message(self, message):
         message = message.data if isinstance(message.data, six.text_type) else message.data.decode('utf-8')
@@ -57,13 +324,187 @@ class _WebSocketClientDispatcher(WebSocketClient):
         finally:
             self.dispatcher.defer(message)
 
+    def ponged(self, pong):
+        self.dispatcher.ponged(pong.data)
+
+
+class _Dispatcher(object):
+    """
+    Passed to each connection made by a WebSocket; incoming messages are handed
+    off to the reactor's dispatch threads, and losing the connection wakes up
+    the WebSocket's checker so that it reconnects right away.
+    """
+    def __init__(self, websocket):
+        self.websocket = websocket
+
+    def defer(self, message):
+        _reactor.dispatch(self.websocket, message)
+
+    def ponged(self, data):
+        elapsed = self.websocket._liveness.ponged(data)
+        if elapsed is not None:
+            self.websocket._record_latency(elapsed)
+
+    def disconnected(self):
+        self.websocket._schedule_reconnect()
+        self.websocket._checker.wake()
+
+
+class _Checker(object):
+    """
+    Reconnects and polls a WebSocket.  Each check returns the number of seconds
+    until the next one is needed, which is scheduled with the shared scheduler
+    and run on the reactor's connect threads, so an idle WebSocket has no
+    thread of its own and doesn't wake up until it has something to do.
+    """
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.lock, self.run_lock = RLock(), RLock()
+        self.running, self.scheduled = False, None
+        on_startup(self.start)
+        on_shutdown(self.stop)
+
+    def start(self):
+        with self.lock:
+            if not self.running:
+                self.running = True
+                _reactor.start()
+                self.wake()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            if self.scheduled:
+                self.scheduled.cancel()
+                self.scheduled = None
+
+    def wake(self, delay=0):
+        """Run a check after the given delay, unless one is already due sooner."""
+        with self.lock:
+            if self.running:
+                if self.scheduled:
+                    if self.scheduled.when <= time.time() + delay:
+                        return
+                    self.scheduled.cancel()
+                self.scheduled = _scheduler.schedule(delay, _reactor.defer, self._run)
+
+    def _run(self):
+        with self.run_lock:
+            with self.lock:
+                if not self.running:
+                    return
+                self.scheduled = None
+            try:
+                delay = self.websocket._check()
+            except:
+                log.error('unexpected error checking websocket %s', self.websocket.url, exc_info=True)
+                delay = 1
+            self.wake(delay)
+
+
+class _SharedSubscription(object):
+    """
+    A single upstream subscription to a remote method which is shared by every
+    passthrough subscriber making the same call with the same parameters, so
+    that a thousand browsers watching the same remote data only cost the remote
+    service one subscription.  Each result is sent to every subscriber, the most
+    recent result is sent immediately to subscribers who join later, and the
+    upstream subscription is canceled when the last subscriber leaves.
+    """
+    _lock = RLock()
+    _registry = {}
+
+    def __init__(self, key, dest_ws, method):
+        self.key, self.dest_ws, self.method = key, dest_ws, method
+        self.client = dest_ws._next_id('client')
+        self.subscribers = []
+        self.latest = None
+
+    @staticmethod
+    def make_key(dest_ws, method, args, kwargs):
+        """
+        Subscriptions are shared when they're made on the same connection to the
+        same method with the same parameters after preprocessing, since that's
+        where plugins add anything which depends on who is making the request.
+        Parameters which can't be serialized get a key which is never shared.
+        """
+        params = dest_ws.preprocess(method, args or kwargs)
+        try:
+            fingerprint = json.dumps(params, cls=sideboard.lib.serializer, sort_keys=True, separators=(',', ':'))
+        except Exception:
+            fingerprint = object()
+        return (dest_ws, method, fingerprint)
+
+    @classmethod
+    def join(cls, subscriber, args, kwargs):
+        key = cls.make_key(subscriber.dest_ws, subscriber.method, args, kwargs)
+        with cls._lock:
+            shared = cls._registry.get(key)
+            created = shared is None
+            if created:
+                shared = cls._registry[key] = cls(key, subscriber.dest_ws, subscriber.method)
+            shared.subscribers.append(subscriber)
+            latest = shared.latest
+
+        if created:
+            shared.dest_ws.subscribe({
+                'client': shared.client,
+                'callback': shared.callback,
+                'errback': shared.errback
+            }, shared.method, *args, **kwargs)
+        elif latest:
+            shared._deliver([subscriber], *latest)
+        return shared
+
+    def leave(self, subscriber):
+        with self._lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+            last = not self.subscribers and self._registry.get(self.key) is self
+            if last:
+                del self._registry[self.key]
+        if last:
+            self.dest_ws.unsubscribe(self.client)
+
+    def callback(self, data):
+        self._publish('callback', data)
+
+    def errback(self, error):
+        self._publish('errback', error)
+
+    def _publish(self, kind, value):
+        with self._lock:
+            self.latest = (kind, value)
+            subscribers = list(self.subscribers)
+        self._deliver(subscribers, kind, value)
+
+    def _deliver(self, subscribers, kind, value):
+        for subscriber in subscribers:
+            try:
+                getattr(subscriber, kind)(value)
+            except:
+                log.warning('unable to send %s result to passthrough subscriber %s', self.method, subscriber.src_client, exc_info=True)
+
+    @classmethod
+    def stats(cls):
+        """A list of (url, method, number of subscribers) for every shared subscription."""
+        with cls._lock:
+            return [(shared.dest_ws.url, shared.method, len(shared.subscribers)) for shared in cls._registry.values()]
+
 
 class _Subscriber(object):
-    def __init__(self, method, src_client, dst_client, src_ws, dest_ws):
-        self.method, self.src_ws, self.dest_ws, self.src_client, self.dst_client = method, src_ws, dest_ws, src_client, dst_client
+    def __init__(self, method, src_client, src_ws, dest_ws):
+        self.method, self.src_ws, self.dest_ws, self.src_client = method, src_ws, dest_ws, src_client
+        self.shared = None
+
+    @property
+    def dst_client(self):
+        return self.shared and self.shared.client
 
     def unsubscribe(self):
-        self.dest_ws.unsubscribe(self.dst_client)
+        shared, self.shared = self.shared, None
+        if shared:
+            shared.leave(self)
 
     def callback(self, data):
         self.src_ws.send(data=data, client=self.src_client)
@@ -72,11 +513,13 @@ class _Subscriber(object):
         self.src_ws.send(error=error, client=self.src_client)
 
     def __call__(self, *args, **kwargs):
-        self.dest_ws.subscribe({
-            'client': self.dst_client,
-            'callback': self.callback,
-            'errback': self.errback
-        }, self.method, *args, **kwargs)
+        if self.shared and self.shared.key == _SharedSubscription.make_key(self.dest_ws, self.method, args, kwargs):
+            latest = self.shared.latest
+            if latest:
+                self.shared._deliver([self], *latest)
+        else:
+            self.unsubscribe()
+            self.shared = _SharedSubscription.join(self, args, kwargs)
         return self.src_ws.NO_RESPONSE
 
     def __del__(self):
@@ -94,6 +537,7 @@ class WebSocket(object):
     """
     poll_method = 'sideboard.poll'
     WebSocketDispatcher = _WebSocketClientDispatcher
+    _instances = weakref.WeakSet()
 
     def __init__(self, url=None, ssl_opts=None, connect_immediately=True, max_wait=2):
         self.ws = None
@@ -103,9 +547,13 @@ class WebSocket(object):
         self._counter = count()
         self.ssl_opts = ssl_opts
         self._reconnect_attempts = 0
-        self._last_poll, self._last_reconnect_attempt = None, None
-        self._dispatcher = Caller(self._dispatch, threads=1)
-        self._checker = DaemonTask(self._check, interval=1)
+        self._last_poll, self._last_reconnect_attempt, self._next_reconnect = None, None, None
+        self.latency = None
+        self._liveness = _Liveness()
+        self.reconnects = self.reconnect_failures = self.resubscribed = self.resubscribes_pending = 0
+        self._dispatcher = _Dispatcher(self)
+        self._checker = _Checker(self)
+        self._instances.add(self)
         if connect_immediately:
             self.connect(max_wait=max_wait)
 
@@ -126,41 +574,111 @@ class WebSocket(object):
         """
         return params
 
+    def _schedule_reconnect(self):
+        """
+        Picks a random time for our next reconnection attempt between now and
+        2 ** (failed attempts so far) seconds from now, capped at
+        ws.reconnect_interval seconds, so that when a server goes down its
+        clients don't all try to reconnect to it at the same moments.
+        """
+        with self._lock:
+            if self._next_reconnect is None or self._reconnect_attempts:
+                interval = min(config['ws.reconnect_interval'], 2 ** self._reconnect_attempts)
+                self._next_reconnect = time.time() + random.uniform(0, interval)
+
     @property
     def _should_reconnect(self):
-        interval = min(config['ws.reconnect_interval'], 2 ** self._reconnect_attempts)
-        cutoff = datetime.now() - timedelta(seconds=interval)
-        return not self.connected and (self._reconnect_attempts == 0 or self._last_reconnect_attempt < cutoff)
+        return not self.connected and (self._next_reconnect is None or self._next_reconnect <= time.time())
 
     @property
     def _should_poll(self):
         cutoff = datetime.now() - timedelta(seconds=config['ws.poll_interval'])
-        return self.connected and (self._last_poll is None or self._last_poll < cutoff)
+        return self.connected and not config['ws.ping_interval'] and (self._last_poll is None or self._last_poll < cutoff)
+
+    @property
+    def _should_ping(self):
+        return self.connected and self._liveness.ping_due
+
+    @property
+    def _next_check(self):
+        if not self.connected:
+            return max(0.1, self._next_reconnect - time.time()) if self._next_reconnect else 1
+        if config['ws.ping_interval']:
+            return max(0.1, self._liveness.next_ping - time.time())
+        last = self._last_poll
+        return max(1, (last + timedelta(seconds=config['ws.poll_interval']) - datetime.now()).total_seconds()) if last else 1
 
     def _check(self):
         if self._should_reconnect:
             self._reconnect()
         if self._should_poll:
             self._poll()
+        if self._should_ping:
+            self._ping()
+        return self._next_check
+
+    def _ping(self):
+        """
+        Sends a websocket ping, unless the last ws.ping_misses pings are still
+        waiting for pongs, in which case we assume that the connection is dead
+        and close it so that we'll reconnect.
+        """
+        with self._lock:
+            ws = self.ws
+            if self._liveness.dead:
+                log.warning('no response to the last %s pings sent to %s, closing connection, will attempt to reconnect', self._liveness.missed, self.url)
+                ws.close()
+                return
+            try:
+                ws.ping(self._liveness.ping())
+            except:
+                log.warning('failed to ping %s, closing connection, will attempt to reconnect', self.url, exc_info=True)
+                ws.close()
 
     def _poll(self):
         assert self.ws and self.ws.connected, 'cannot poll while websocket is not connected'
+        ws, self._last_poll, sent = self.ws, datetime.now(), time.time()
+
+        def on_response(future):
+            if future.exception():
+                log.warning('no poll response received from %s, closing connection, will attempt to reconnect', self.url, exc_info=future.exception())
+                ws.close()
+            else:
+                self._record_latency(time.time() - sent)
+
         try:
-            self.call(self.poll_method)
+            self.call_async(self.poll_method).add_done_callback(on_response)
         except:
-            log.warning('no poll response received from %s, closing connection, will attempt to reconnect', self.url, exc_info=True)
-            self.ws.close()
-        else:
-            self._last_poll = datetime.now()
+            log.warning('failed to poll %s, closing connection, will attempt to reconnect', self.url, exc_info=True)
+            ws.close()
 
     def _refire_subscriptions(self):
+        """
+        Re-sends our subscriptions after reconnecting, most recently used first,
+        and no more than ws.resubscribe_rate of them per second so that a server
+        which just came back up isn't flooded by all of its clients at once.
+        """
+        subscriptions = [cb for cb in list(self._callbacks.values()) if 'client' in cb]
+        subscriptions.sort(key=lambda cb: cb.get('last_used', 0), reverse=True)
+        self._refire_batch(self.ws, [cb['client'] for cb in subscriptions])
+
+    def _refire_batch(self, ws, clients):
+        rate = config['ws.resubscribe_rate']
+        batch, clients = (clients[:rate], clients[rate:]) if rate else (clients, [])
+        self.resubscribes_pending = len(clients)
         try:
-            for cb in self._callbacks.values():
-                if 'client' in cb:
+            for client in batch:
+                cb = self._callbacks.get(client)
+                if cb and self.ws is ws:
                     params = cb['paramback']() if 'paramback' in cb else cb['params']
-                    self._send(method=cb['method'], params=params, client=cb['client'])
+                    self._send(method=cb['method'], params=params, client=client)
+                    self.resubscribed += 1
         except:
-            pass  # self._send() already closes and logs on error
+            self.resubscribes_pending = 0
+            return  # self._send() already closes and logs on error
+
+        if clients and self.ws is ws:
+            _scheduler.schedule(1, _reactor.defer, self._refire_batch, ws, clients)
 
     def _reconnect(self):
         with self._lock:
@@ -172,17 +690,25 @@ class WebSocket(object):
                 log.warning('failed to connect to %s: %s', self.url, str(e))
                 self._last_reconnect_attempt = datetime.now()
                 self._reconnect_attempts += 1
+                self.reconnect_failures += 1
+                self._schedule_reconnect()
             else:
-                self._reconnect_attempts = 0
+                self._reconnect_attempts, self._next_reconnect = 0, None
+                self._liveness.reset()
+                self.reconnects += 1
                 self._refire_subscriptions()
 
     def _next_id(self, prefix):
         return '{}-{}'.format(prefix, next(self._counter))
 
     def _send(self, **kwargs):
+        traceparent = _tracing.current_traceparent()
+        if traceparent:
+            kwargs.setdefault('traceparent', traceparent)
         log.debug('sending %s', kwargs)
         with self._lock:
-            assert self.connected, 'tried to send data on closed websocket {!r}'.format(self.url)
+            if not self.connected:
+                raise _NoResponse('tried to send data on closed websocket {!r}'.format(self.url))
             try:
                 return self.ws.send(kwargs)
             except:
@@ -196,14 +722,17 @@ class WebSocket(object):
             assert isinstance(message, Mapping), 'incoming message is not a dictionary'
             assert 'client' in message or 'callback' in message, 'no callback or client in message {}'.format(message)
             id = message.get('client') or message.get('callback')
-            assert id in self._callbacks, 'unknown dispatchee {}'.format(id)
+            cb = self._callbacks.get(id)
+            assert cb, 'unknown dispatchee {}'.format(id)
         except AssertionError:
             self.fallback(message)
         else:
+            if 'client' in message:
+                cb['last_used'] = time.time()
             if 'error' in message:
-                self._callbacks[id]['errback'](message['error'])
+                cb['errback'](message['error'])
             else:
-                self._callbacks[id]['callback'](message.get('data'))
+                cb['callback'](message.get('data'))
 
     def fallback(self, message):
         """
@@ -224,17 +753,42 @@ class WebSocket(object):
         """boolean indicating whether or not this connection is currently active"""
         return bool(self.ws) and self.ws.connected
 
+    @property
+    def reconnect_stats(self):
+        """
+        Counters describing how often this websocket has had to reconnect and
+        how far along it is with re-sending its subscriptions since then.
+        """
+        return {
+            'connected': self.connected,
+            'reconnects': self.reconnects,
+            'reconnect_failures': self.reconnect_failures,
+            'failed_attempts': self._reconnect_attempts,
+            'next_attempt': None if self.connected or self._next_reconnect is None else round(max(0, self._next_reconnect - time.time()), 1),
+            'resubscribed': self.resubscribed,
+            'resubscribes_pending': self.resubscribes_pending
+        }
+
+    @property
+    def rtt(self):
+        """
+        Histogram of the round trip times of the websocket pings we've sent over
+        this connection; its stats attribute gives percentiles in milliseconds.
+        """
+        return self._liveness.rtt
+
     def connect(self, max_wait=0):
         """
-        Start the background threads which connect this websocket and handle RPC
-        dispatching.  This method is safe to call even if the websocket is already
+        Start connecting this websocket in the background; incoming messages are
+        read and dispatched by background threads which are shared by every
+        WebSocket instance, and if the connection is lost we automatically
+        reconnect.  This method is safe to call even if the websocket is already
         connected.  You may optionally pass a max_wait parameter if you want to
         wait for up to that amount of time for the connection to go through; if
         that amount of time elapses without successfully connecting, a warning
         message is logged.
         """
         self._checker.start()
-        self._dispatcher.start()
         for i in range(10 * max_wait):
             if not self.connected:
                 stopped.wait(0.1)
@@ -246,14 +800,19 @@ class WebSocket(object):
 
     def close(self):
         """
-        Closes the underlying websocket connection and stops background tasks.
+        Closes the underlying websocket connection and stops reconnecting.
         This method is always safe to call; exceptions will be swallowed and
         logged, and calling close on an already-closed websocket is a no-op.
         """
         self._checker.stop()
-        self._dispatcher.stop()
         if self.ws:
             self.ws.close()
+        self._fail_pending_calls('websocket closed before response was received')
+
+    def _fail_pending_calls(self, message):
+        for callback, cb in list(self._callbacks.items()):
+            if 'future' in cb:
+                self._resolve(callback, error=_NoResponse(message))
 
     def subscribe(self, callback, method, *args, **kwargs):
         """
@@ -303,7 +862,8 @@ class WebSocket(object):
         self._callbacks[client].setdefault('errback', lambda result: log.error('%s(*%s, **%s) returned an error: %s', method, args, kwargs, result))
         self._callbacks[client].update({
             'method': method,
-            'params': params
+            'params': params,
+            'last_used': time.time()
         })
 
         try:
@@ -327,37 +887,89 @@ class WebSocket(object):
         except:
             pass
 
-    def call(self, method, *args, **kwargs):
+    def _resolve(self, callback, result=None, error=None):
         """
-        Send a websocket rpc method call, then wait for and return the eventual
-        response, or raise an exception if we get back an error.  This method
-        will raise an AssertionError after 10 seconds if no response of any
-        kind was received.  The positional and keyword arguments to this method
-        are used as the arguments to the rpc function call.
+        Completes the future for an outstanding call, unless something else
+        (the response, an error, or the call expiring) already completed it.
+        """
+        cb = self._callbacks.pop(callback, None)
+        if cb is not None:
+            cb['expiration'].cancel()
+            if error is None:
+                cb['future'].set_result(result)
+            else:
+                cb['future'].set_exception(error)
+
+    def _record_latency(self, elapsed):
+        """
+        Keeps a moving average in our latency attribute of the round trip times
+        of our pings, or of our sideboard.poll calls if pings are turned off.
+        Unlike other calls these don't do any real work on the server, so this
+        measures the connection rather than how busy the other end is.
+        """
+        self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+
+    def call_async(self, method, *args, **kwargs):
+        """
+        Send a websocket rpc method call and return a concurrent.futures.Future
+        which will hold the eventual response.  Responses are matched to calls
+        by their callback id, so any number of calls may be in flight at once
+        without tying up a thread for each one.  The future's exception is set
+        if we get back an error, if no response arrives within ws.call_timeout
+        seconds (or before the deadline of the current request, if sooner), or
+        if this websocket is closed first.
+
+        >>> futures = [ws.call_async('foo.bar', i) for i in range(100)]
+        >>> results = [future.result() for future in futures]
         """
-        finished = Event()
-        result, error = [], []
+        assert not stopped.is_set(), 'websocket closed before response was received'
+        timeout, remaining = config['ws.call_timeout'], sideboard.lib.threadlocal.time_remaining()
+        if remaining is not None:
+            sideboard.lib.threadlocal.check_deadline()
+            timeout = min(timeout, remaining)
+
+        future = Future()
         callback = self._next_id('callback')
+        if remaining is not None and remaining <= timeout:
+            error = sideboard.lib.DeadlineExceeded('no response received before the deadline of the current request')
+        else:
+            error = _NoResponse('no response received for {} seconds'.format(timeout))
         self._callbacks[callback] = {
-            'callback': lambda response: (result.append(response), finished.set()),
-            'errback': lambda response: (error.append(response), finished.set())
+            'future': future,
+            'sent': time.time(),
+            'expiration': _scheduler.schedule(timeout, self._resolve, callback, None, error),
+            'callback': lambda response: self._resolve(callback, result=response),
+            'errback': lambda response: self._resolve(callback, error=AssertionError(response))
         }
         params = self.preprocess(method, args or kwargs)
         try:
-            self._send(method=method, params=params, callback=callback)
+            with _tracing.trace_span(method, kind='client', finish=False) as span:
+                self._send(method=method, params=params, callback=callback, timeout=timeout)
         except:
-            self._callbacks.pop(callback, None)
+            cb = self._callbacks.pop(callback, None)
+            if cb:
+                cb['expiration'].cancel()
             raise
+        if span:
+            future.add_done_callback(lambda future: span.finish(future.exception()))
+        return future
 
-        wait_until = datetime.now() + timedelta(seconds=config['ws.call_timeout'])
-        while datetime.now() < wait_until:
-            finished.wait(0.1)
-            if stopped.is_set() or result or error:
-                break
-        self._callbacks.pop(callback, None)
-        assert not stopped.is_set(), 'websocket closed before response was received'
-        assert result, error[0] if error else 'no response received for 10 seconds'
-        return result[0]
+    def call(self, method, *args, **kwargs):
+        """
+        Send a websocket rpc method call, then wait for and return the eventual
+        response, or raise an exception if we get back an error.  If no response
+        of any kind is received within ws.call_timeout seconds (or if the
+        connection closes first), this raises _NoResponse, a subclass of
+        AssertionError.  The positional and keyword arguments to this method
+        are used as the arguments to the rpc function call.
+
+        The number of seconds we're willing to wait is sent along with the call
+        so the remote server can stop working on it after we've given up.  If
+        this is called while handling a request which has a deadline, we wait
+        no longer than the time remaining and raise DeadlineExceeded if that
+        runs out first.
+        """
+        return self.call_async(method, *args, **kwargs).result()
 
     def make_caller(self, method):
         """
@@ -379,6 +991,10 @@ class WebSocket(object):
         so then in addition to returning a callable, it also registers the
         new subscription with the client websocket so it can be cleaned up when
         the client websocket closes and/or when its subscription is canceled.
+
+        Passthrough subscriptions to the same method with the same parameters
+        share a single subscription to the remote service, whose results are
+        sent to every client; it's canceled when the last client unsubscribes.
         """
         client = sideboard.lib.threadlocal.get_client()
         originating_ws = sideboard.lib.threadlocal.get('websocket')
@@ -387,13 +1003,313 @@ class WebSocket(object):
             if sub:
                 sub.method = method
             else:
-                sub = _Subscriber(method=method, src_client=client, dst_client=self._next_id('client'), src_ws=originating_ws, dest_ws=self)
+                sub = _Subscriber(method=method, src_client=client, src_ws=originating_ws, dest_ws=self)
                 originating_ws.passthru_subscriptions[client] = sub
             return sub
         else:
             return lambda *args, **kwargs: self.call(method, *args, **kwargs)
 
 
+@on_shutdown
+def _fail_pending_calls():
+    for ws in list(WebSocket._instances):
+        ws._fail_pending_calls('websocket closed before response was received')
+
+
+class _PoolMember(object):
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.outstanding = self.errors = 0
+        self.ejected_until = 0
+
+    @property
+    def ejected(self):
+        return self.ejected_until > time.time()
+
+    @property
+    def healthy(self):
+        return self.websocket.connected and not self.ejected
+
+
+class WebSocketPool(object):
+    """
+    Spreads calls and subscriptions across several WebSocket connections, e.g.
+    a few connections to each of several hosts which all run the same service.
+    This has the same interface as the WebSocket class, so a pool can be used
+    anywhere a WebSocket can, including being registered as a service.
+
+    Each call goes to the healthy connection with the fewest calls in flight,
+    or to each healthy connection in turn if balance is 'round_robin'.  A
+    connection is ejected from the pool for ws.pool_eject_interval seconds if
+    it's disconnected, if ws.pool_eject_errors calls in a row get no response,
+    or if the average round trip time of its pings (or polls, if pings are
+    turned off) exceeds ws.pool_eject_latency seconds, and its subscriptions
+    are moved to a healthy connection.
+    """
+    BALANCE = ['least_outstanding', 'round_robin']
+
+    def __init__(self, websockets, balance='least_outstanding'):
+        assert websockets, 'WebSocketPool requires at least one websocket'
+        assert balance in self.BALANCE, 'unknown balance {!r}, expected one of {}'.format(balance, self.BALANCE)
+        self.balance = balance
+        self._lock = RLock()
+        self._counter, self._turns = count(), count()
+        self._members = [_PoolMember(ws) for ws in websockets]
+        self._subscriptions = {}
+        self._running, self._scheduled = False, None
+        on_startup(self._start_checks)
+        on_shutdown(self._stop_checks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def websockets(self):
+        return [member.websocket for member in self._members]
+
+    @property
+    def url(self):
+        return ', '.join(sorted(set(ws.url for ws in self.websockets)))
+
+    @property
+    def connected(self):
+        """boolean indicating whether any connection in this pool is active"""
+        return any(ws.connected for ws in self.websockets)
+
+    def connect(self, max_wait=0):
+        """
+        Same as WebSocket.connect; if max_wait is passed, we wait until at least
+        one connection in the pool is active.
+        """
+        for ws in self.websockets:
+            ws.connect()
+        self._start_checks()
+        for i in range(10 * max_wait):
+            if not self.connected:
+                stopped.wait(0.1)
+            else:
+                break
+        else:
+            if max_wait:
+                log.warning('websocket pool %s not connected after %s seconds', self.url, max_wait)
+
+    def close(self):
+        """Closes every connection in this pool; this is always safe to call."""
+        self._stop_checks()
+        for ws in self.websockets:
+            ws.close()
+
+    def _start_checks(self):
+        with self._lock:
+            if not self._running:
+                self._running = True
+                self._schedule_check()
+
+    def _stop_checks(self):
+        with self._lock:
+            self._running = False
+            if self._scheduled:
+                self._scheduled.cancel()
+                self._scheduled = None
+
+    def _schedule_check(self):
+        with self._lock:
+            if self._running:
+                self._scheduled = _scheduler.schedule(config['ws.pool_check_interval'], _reactor.defer, self._check)
+
+    def _check(self):
+        for member in self._members:
+            if not member.ejected:
+                latency = member.websocket.latency
+                if not member.websocket.connected:
+                    self._eject(member, 'not connected')
+                elif latency is not None and latency > config['ws.pool_eject_latency']:
+                    self._eject(member, 'average round trip time of {:.2f} seconds'.format(latency))
+        self._schedule_check()
+
+    def _eject(self, member, reason):
+        with self._lock:
+            if member.ejected:
+                return
+            member.errors = 0
+            member.websocket.latency = None
+            member.ejected_until = time.time() + config['ws.pool_eject_interval']
+        log.warning('ejecting %s from websocket pool for %s seconds: %s', member.websocket.url, config['ws.pool_eject_interval'], reason)
+        self._move_subscriptions(member)
+
+    def _choose(self, exclude=None):
+        with self._lock:
+            members = [m for m in self._members if m is not exclude] or self._members
+            members = [m for m in members if m.healthy] or [m for m in members if m.websocket.connected] or members
+            if self.balance == 'least_outstanding':
+                least = min(m.outstanding for m in members)
+                members = [m for m in members if m.outstanding == least]
+            return members[next(self._turns) % len(members)]
+
+    def _completed(self, member, future):
+        with self._lock:
+            member.outstanding -= 1
+            if isinstance(future.exception(), _NoResponse):
+                member.errors += 1
+            else:
+                member.errors = 0
+            failing = member.errors >= config['ws.pool_eject_errors']
+        if failing:
+            self._eject(member, '{} calls in a row got no response'.format(member.errors))
+
+    def _move_subscriptions(self, member):
+        with self._lock:
+            moving = [(client, sub) for client, sub in self._subscriptions.items() if sub[0] is member]
+        for client, sub in moving:
+            target = self._choose(exclude=member)
+            if target is not member and target.healthy:
+                log.info('moving subscription %s to %s from %s', client, target.websocket.url, member.websocket.url)
+                member.websocket.unsubscribe(client)
+                sub[0] = target
+                _, request, method, args, kwargs = sub
+                target.websocket.subscribe(request, method, *args, **kwargs)
+
+    def _next_id(self, prefix):
+        return '{}-{}'.format(prefix, next(self._counter))
+
+    def call_async(self, method, *args, **kwargs):
+        """Same as WebSocket.call_async, using a connection chosen by the pool."""
+        member = self._choose()
+        with self._lock:
+            member.outstanding += 1
+        try:
+            future = member.websocket.call_async(method, *args, **kwargs)
+        except:
+            with self._lock:
+                member.outstanding -= 1
+            raise
+        future.add_done_callback(lambda future: self._completed(member, future))
+        return future
+
+    def call(self, method, *args, **kwargs):
+        """Same as WebSocket.call, using a connection chosen by the pool."""
+        return self.call_async(method, *args, **kwargs).result()
+
+    def subscribe(self, callback, method, *args, **kwargs):
+        """
+        Same as WebSocket.subscribe; the subscription is made on a connection
+        chosen by the pool, and is moved to another connection if that one is
+        ejected from the pool.
+        """
+        request = dict(callback) if isinstance(callback, Mapping) else {'callback': callback}
+        client = request.setdefault('client', self._next_id('client'))
+        member = self._choose()
+        with self._lock:
+            self._subscriptions[client] = [member, request, method, args, kwargs]
+        member.websocket.subscribe(request, method, *args, **kwargs)
+        return client
+
+    def unsubscribe(self, client):
+        """Same as WebSocket.unsubscribe."""
+        with self._lock:
+            sub = self._subscriptions.pop(client, None)
+        if sub:
+            sub[0].websocket.unsubscribe(client)
+
+    def preprocess(self, method, params):
+        """Same as WebSocket.preprocess, using the first connection in the pool."""
+        return self.websockets[0].preprocess(method, params)
+
+    def make_caller(self, method):
+        """Same as WebSocket.make_caller."""
+        return WebSocket.make_caller(self, method)
+
+    @property
+    def stats(self):
+        """A list of dictionaries describing the state of each connection."""
+        with self._lock:
+            return [{
+                'url': member.websocket.url,
+                'connected': member.websocket.connected,
+                'ejected': member.ejected,
+                'outstanding': member.outstanding,
+                'errors': member.errors,
+                'latency': member.websocket.latency,
+                'subscriptions': sum(1 for sub in self._subscriptions.values() if sub[0] is member)
+            } for member in self._members]
+
+
+class AsyncWebSocket(object):
+    """
+    asyncio interface to a WebSocket connection.  All network I/O still happens
+    in the background threads of the underlying WebSocket instance; calls made
+    through this class return awaitables which are resolved when the response
+    arrives, so a single connection can have thousands of calls in flight at
+    once, and subscription callbacks are run on the event loop which was
+    running when subscribe() was called.
+
+    >>> ws = AsyncWebSocket('wss://example.com/ws')
+    >>> results = await asyncio.gather(*[ws.call('foo.bar', i) for i in range(1000)])
+
+    You may pass an existing WebSocket instance to wrap instead of a url.
+    """
+    def __init__(self, url=None, ssl_opts=None, connect_immediately=True, max_wait=0, websocket=None):
+        self.websocket = websocket or WebSocket(url, ssl_opts=ssl_opts, connect_immediately=connect_immediately, max_wait=max_wait)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def url(self):
+        return self.websocket.url
+
+    @property
+    def connected(self):
+        return self.websocket.connected
+
+    async def connect(self, max_wait=0):
+        """
+        Same as WebSocket.connect, except that the optional wait for the
+        connection to become active happens without blocking the event loop.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.websocket.connect, max_wait)
+
+    def close(self):
+        self.websocket.close()
+
+    async def call(self, method, *args, **kwargs):
+        """Coroutine version of WebSocket.call, with the same arguments."""
+        return await asyncio.wrap_future(self.websocket.call_async(method, *args, **kwargs))
+
+    def subscribe(self, callback, method, *args, **kwargs):
+        """
+        Same as WebSocket.subscribe, except that the callback and errback (which
+        may be either regular functions or coroutine functions) are invoked on
+        the running event loop instead of in a background thread.  This must be
+        called from code running on that loop, and raises RuntimeError if there
+        isn't one, rather than quietly binding the callbacks to a loop which may
+        never run.
+        """
+        loop = asyncio.get_running_loop()
+        request = dict(callback) if isinstance(callback, Mapping) else {'callback': callback}
+        for name in ['callback', 'errback']:
+            if name in request:
+                request[name] = self._on_loop(loop, request[name])
+        return self.websocket.subscribe(request, method, *args, **kwargs)
+
+    def unsubscribe(self, client):
+        self.websocket.unsubscribe(client)
+
+    @staticmethod
+    def _on_loop(loop, func):
+        def invoke(data):
+            result = func(data)
+            if asyncio.iscoroutine(result):
+                asyncio.ensure_future(result)
+        return lambda data: loop.call_soon_threadsafe(invoke, data)
+
+
 class Model(MutableMapping):
     """
     Utility class for representing database objects found in the databases of
@@ -572,7 +1488,9 @@ class MultiSubscription(object):
     response will have no key/value pair in the "results" dictionary.
 
     If you want to do postprocessing on the results, you can subclass this and
-    override the "callback" method, e.g.
+    override the "callback" method (called with each host's result), or the
+    "merge" method to keep a running "aggregate" of the results from every host
+    without recomputing it from all of them every time one of them changes, e.g.
 
     >>> class UserList(MultiSubscription):
     ...     def __init__(self):
@@ -587,11 +1505,25 @@ class MultiSubscription(object):
     The above code gives you a "users" object with a "usernames" attribute; when Sideboard
     starts, it opens websocket connections to 'host1' and 'host2', then subscribes to the
     "admin.get_logged_in_users" method and calls the "callback" method on every response.
+
+    >>> class UserCount(MultiSubscription):
+    ...     aggregate = 0
+    ...
+    ...     def merge(self, aggregate, users, previous, ws):
+    ...         return aggregate + len(users) - len(previous or [])
+    ...
+    >>> user_count = UserCount(['host1', 'host2'], 'admin.get_logged_in_users')
+
+    Here user_count.aggregate is always the total number of logged in users across
+    every host, and each response only costs work proportional to that one host's data.
     """
+    aggregate = None
+
     def __init__(self, hostnames, rpc_method, *args, **kwargs):
         from sideboard.lib import listify
         self.hostnames, self.method, self.args, self.kwargs = listify(hostnames), rpc_method, args, kwargs
         self.results, self.websockets, self._client_ids = {}, {}, {}
+        self._lock = RLock()
         on_startup(self._subscribe)
         on_shutdown(self._unsubscribe)
 
@@ -616,13 +1548,26 @@ class MultiSubscription(object):
         return lambda result_data: self._callback(result_data, ws)
 
     def _callback(self, response_data, ws):
-        self.results[ws] = response_data
+        with self._lock:
+            previous = self.results.get(ws)
+            self.results[ws] = response_data
+            self.aggregate = self.merge(self.aggregate, response_data, previous, ws)
         self.callback(response_data, ws)
 
     def callback(self, result_data, ws):
         """override this to define what to do with your rpc method return values"""
 
-    def refresh(self):
+    def merge(self, aggregate, result_data, previous, ws):
+        """
+        Override this to maintain the "aggregate" attribute incrementally; this
+        is called with the current aggregate, the latest result from a host, and
+        the previous result from that same host (None if this is its first), and
+        should return the new aggregate.  Calls are never made concurrently, so
+        this doesn't need to do any locking of its own.
+        """
+        return aggregate
+
+    def refresh(self, timeout=None):
         """
         Sometimes we want to manually re-fire all of our subscription methods to
         get the latest data.  This is useful in cases where the remote server
@@ -630,9 +1575,26 @@ class MultiSubscription(object):
         it's available, usually for performance reasons.  This method allows the
         client to get the latest data more often than the server is programmed
         to provide it.
+
+        Every host is called at once, and we wait up to timeout seconds (by
+        default ws.call_timeout) for their responses.  Hosts which don't respond
+        in time keep their previous results, and this returns a dictionary of
+        the new results from the hosts which did respond, keyed by websocket.
         """
+        futures = {}
         for ws in self.websockets.values():
             try:
-                self._callback(self.ws.call(self.method, *self.args, **self.kwargs), ws)
+                futures[ws] = ws.call_async(self.method, *self.args, **self.kwargs)
             except:
-                log.warning('failed to fetch latest data from %s on %s', self.method, ws.url)
+                log.warning('failed to fetch latest data from %s on %s', self.method, ws.url, exc_info=True)
+
+        wait(futures.values(), timeout=config['ws.call_timeout'] if timeout is None else timeout)
+        refreshed = {}
+        for ws, future in futures.items():
+            if future.done() and not future.exception():
+                refreshed[ws] = future.result()
+                self._callback(refreshed[ws], ws)
+            else:
+                log.warning('failed to fetch latest data from %s on %s: %s', self.method, ws.url,
+                            future.exception() if future.done() else 'no response within the time limit')
+        return refreshed
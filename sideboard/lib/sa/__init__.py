@@ -10,11 +10,11 @@ import sqlalchemy
 from sqlalchemy import event
 from sqlalchemy.ext import declarative
 from sqlalchemy.dialects import postgresql
-from sqlalchemy.orm import Query, sessionmaker, configure_mappers
+from sqlalchemy.orm import Query, Mapper, sessionmaker, configure_mappers
 from sqlalchemy.orm.decl_base import _declarative_constructor
 from sqlalchemy.types import TypeDecorator, String, DateTime, CHAR, Unicode
 
-from sideboard.lib import log, config
+from sideboard.lib import log, config, threadlocal
 
 __all__ = ['UUID', 'JSON', 'CoerceUTF8', 'declarative_base', 'SessionManager',
            'CrudException', 'crudable', 'crud_validation', 'text_length_validation', 'regex_validation']
@@ -255,6 +255,91 @@ class _SessionInitializer(type):
         return SessionClass
 
 
+def _resolve_model_name(name, models, tables):
+    """
+    Returns the model class (or failing that, the table) which the given name
+    refers to, trying camelcase permutations and singular forms of the name,
+    or None if it doesn't match anything.
+    """
+    permutations = [name, _underscore_to_camelcase(name), _underscore_to_camelcase(name, cap_segment=0)]
+    for name in permutations:
+        if name in models:
+            return models[name]
+
+        if name.lower().endswith('s'):
+            singular = name.rstrip('sS')
+            if singular in models:
+                return models[singular]
+
+        if name.lower().endswith('ies'):
+            singular = name[:-3] + 'y'
+            if singular in models:
+                return models[singular]
+
+    for name in permutations:
+        if name in tables:
+            return tables[name]
+
+
+# bumped whenever a class is mapped or mappers are configured, so that each
+# SessionManager knows to rebuild its _ModelIndex
+_model_index_version = [0]
+
+
+@event.listens_for(Mapper, 'instrument_class')
+@event.listens_for(Mapper, 'after_configured')
+def _invalidate_model_indexes(*args):
+    _model_index_version[0] += 1
+
+
+class _ModelIndex(object):
+    """
+    SessionManager.resolve_model is called many times for every crud request,
+    so rather than searching through every model each time, we precompute
+    what each model's name, plural, and table name resolve to.  Other names
+    are still resolved by _resolve_model_name, without being remembered, since
+    clients can send us arbitrarily many different names.
+    """
+    def __init__(self, models, tables):
+        self.version = _model_index_version[0]
+        self.models = {model.__name__: model for model in models}
+        self.tables = dict(tables)
+
+        self.aliases = {}
+        names = list(self.tables)
+        for name in self.models:
+            names.extend([name, name + 's'])
+            if name.endswith('y'):
+                names.append(name[:-1] + 'ies')
+        for model in models:
+            tablename = getattr(model, '__tablename__', None)
+            if isinstance(tablename, six.string_types):
+                names.extend([tablename, tablename + 's'])
+        for name in names:
+            resolved = _resolve_model_name(name, self.models, self.tables)
+            if resolved is not None:
+                self.aliases[name] = resolved
+
+    def resolve(self, name):
+        if name in self.aliases:
+            return self.aliases[name]
+        return _resolve_model_name(name, self.models, self.tables)
+
+
+def _check_deadline_on_begin(session, transaction, connection):
+    """
+    When a session is created while handling a request with a deadline, this
+    is called at the start of each transaction to bail out if the deadline has
+    already passed, and on Postgres to set a statement timeout so that no query
+    in the transaction can keep running after the caller has given up.
+    """
+    remaining = threadlocal.time_remaining()
+    if remaining is not None:
+        threadlocal.check_deadline()
+        if connection.dialect.name == 'postgresql':
+            connection.execute(sqlalchemy.text('SET LOCAL statement_timeout = {:d}'.format(max(1, int(remaining * 1000)))))
+
+
 @six.add_metaclass(_SessionInitializer)
 class SessionManager(object):
     class SessionMixin(object):
@@ -269,6 +354,8 @@ class SessionManager(object):
             if not name.startswith('__'):
                 assert not hasattr(self.session, name) and hasattr(val, '__call__')
                 setattr(self.session, name, types.MethodType(val, self.session))
+        if threadlocal.get('deadline'):
+            event.listen(self.session, 'after_begin', _check_deadline_on_begin)
 
     def __enter__(self):
         return self.session
@@ -288,6 +375,7 @@ class SessionManager(object):
     @classmethod
     def initialize_db(cls, drop=False, create=True):
         configure_mappers()
+        cls._model_index()
         cls.BaseClass.metadata.bind = cls.engine
         if drop:
             cls.BaseClass.metadata.drop_all(cls.engine, checkfirst=True)
@@ -296,34 +384,35 @@ class SessionManager(object):
 
     @classmethod
     def all_models(cls):
-        return cls.BaseClass.__subclasses__()   # TODO: subclasses of subclasses; this needs to be recursive or something
+        models, pending = [], list(cls.BaseClass.__subclasses__())
+        while pending:
+            model = pending.pop(0)
+            if model not in models:
+                models.append(model)
+                pending.extend(model.__subclasses__())
+        return models
+
+    @classmethod
+    def _model_index(cls):
+        """
+        Returns the _ModelIndex for this session's models, rebuilding it if any
+        models have been mapped or configured since it was last built.
+        """
+        index = cls.__dict__.get('_cached_model_index')
+        if index is None or index.version != _model_index_version[0]:
+            index = _ModelIndex(cls.all_models(), cls.BaseClass.metadata.tables)
+            cls._cached_model_index = index
+        return index
 
     @classmethod
     def resolve_model(cls, name):
         if inspect.isclass(name) and issubclass(name, cls.BaseClass):
             return name
 
-        subclasses = {ModelClass.__name__: ModelClass for ModelClass in cls.all_models()}
-        permutations = [name, _underscore_to_camelcase(name), _underscore_to_camelcase(name, cap_segment=0)]
-        for name in permutations:
-            if name in subclasses:
-                return subclasses[name]
-
-            if name.lower().endswith('s'):
-                singular = name.rstrip('sS')
-                if singular in subclasses:
-                    return subclasses[singular]
-
-            if name.lower().endswith('ies'):
-                singular = name[:-3] + 'y'
-                if singular in subclasses:
-                    return subclasses[singular]
-
-        for name in permutations:
-            if name in cls.BaseClass.metadata.tables:
-                return cls.BaseClass.metadata.tables[name]
-
-        raise ValueError('Unrecognized model: {}'.format(name))
+        model = cls._model_index().resolve(name)
+        if model is None:
+            raise ValueError('Unrecognized model: {}'.format(name))
+        return model
 
 if six.PY2:
     __all__ = [s.encode('ascii') for s in __all__]
@@ -121,6 +121,8 @@ return {
     results: [<result>, <result>, <result>, <result>, <result>]
 }
 
+Counting every matching object can cost more than fetching the results on large tables, so the crud.read method also accepts a 'total' parameter: True (the default) returns the exact count, which is fetched in the same query as the results on databases which support "count(*) OVER ()", 'estimate' returns the query planner's estimate on databases which provide one (otherwise an exact count), and False skips counting and returns a total of None.
+
 To prevent the client from always being forced to deal with entire query result, there are three parameters in place for the crud.read method to simplify only receiving the information that's desired. At a high level:
 
 - 'Limit' takes a positive integer 'L' and when provided, the crud.read method will return at most L results, defaults to no limit
@@ -147,12 +149,15 @@ Using the 4 records in the ordering example (including the ordering specificatio
 - a limit of 0 (unlimited, which is the default if unspecified) and an offset of 0 would be identical to the table in the ordering-only example
 - a limit of 0 and an offset of 1 would return everything except for the first result, so in this case, the last 3 results
 - a limit of 2 and an offset of 1 would return the 2nd and 3rd results, so in this case, the middle 2 results
+
+Offsets get slower the deeper the page, since the database still has to skip over every earlier row, and pages shift when rows are inserted or deleted before them. When a limit is provided, crud.read also returns a 'next_cursor' string, which can be passed back as the 'cursor' parameter (with the same query, ordering and limit, and without an offset) to get the page which follows it; this works by filtering on the sort values of the last row rather than skipping rows, so it's equally fast on every page. The id is used as a final tie-breaker when paging, and the sort fields should not be nullable. 'next_cursor' is None on the last page.
 """
 from __future__ import unicode_literals
 import functools
 import re
 import sys
 import json
+import base64
 import uuid
 import inspect
 import collections
@@ -161,6 +166,8 @@ from collections.abc import Mapping
 from collections import defaultdict
 from datetime import datetime, date, time
 from itertools import chain
+from threading import RLock
+from time import monotonic
 from functools import wraps
 
 import six
@@ -174,10 +181,12 @@ from sqlalchemy.orm.properties import ColumnProperty, RelationshipProperty
 from sqlalchemy.orm.util import class_mapper
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.sql import text, ClauseElement
-from sqlalchemy.sql.expression import alias, cast, label, bindparam, and_, or_, asc, desc, literal, text, union, join
+from sqlalchemy.sql.expression import alias, cast, label, bindparam, and_, or_, asc, desc, literal, literal_column, text, union, join, tuple_
 from sqlalchemy.types import Boolean, Text, Integer, String, UnicodeText, DateTime
 
 from sideboard.lib import log, notify, listify, threadlocal, serializer, is_listy, class_property
+from sideboard.config import config
+from sideboard.debugging import register_diagnostics_status_function
 
 
 class CrudException(Exception):
@@ -315,6 +324,124 @@ def normalize_object_graph(graph):
         return None
 
 
+_loaders = {
+    'selectin': orm.selectinload,
+    'joined': orm.joinedload,
+    'subquery': orm.subqueryload,
+    'lazy': orm.lazyload
+}
+
+
+def read_plan(model, graph):
+    """
+    Returns a (columns, relationships) tuple describing what to_dict will read
+    from an instance of the model for the given data specification: a list of
+    the names of column attributes (always starting with id) and a dictionary
+    mapping relationship names to their own data specifications.  Returns None
+    if to_dict would read anything else, such as a property, since then we
+    can't tell which columns it will need, or if the model overrides crud_read
+    or to_dict, or is part of an inheritance hierarchy, since then rows may
+    need to be serialized as some other class.
+    """
+    if not inspect.isclass(model) or not issubclass(model, CrudMixin):
+        return None
+    elif model.crud_read is not CrudMixin.crud_read or model.to_dict is not CrudMixin.to_dict:
+        return None
+
+    mapper = class_mapper(model)
+    if mapper.polymorphic_on is not None or mapper.inherits is not None or len(list(mapper.self_and_descendants)) > 1:
+        return None
+
+    graph = normalize_object_graph(graph)
+    names = model.to_dict_default_attrs if graph is None else model.extra_defaults + [name for name, spec in graph.items() if spec]
+    columns, relationships = ['id'], {}
+    for name in names:
+        try:
+            if not _crud_read_validator(model, name):
+                continue
+        except ValueError:
+            return None
+
+        if name in mapper.column_attrs:
+            if name not in columns:
+                columns.append(name)
+        elif graph is not None and name in mapper.relationships:
+            relationships[name] = graph.get(name, True)
+        else:
+            return None
+    return columns, relationships
+
+
+def loader_options(model, graph, project=True):
+    """
+    Returns a list of SQLAlchemy loader options for reading the given data
+    specification from instances of the model:
+
+    - Every relationship named in the data specification is eagerly loaded, at
+      any depth, so that serializing the results doesn't issue a separate
+      lazy-load query for each object.  By default collections are loaded
+      with selectinload and many-to-one relationships with joinedload; a model
+      can override this for any of its relationships with its
+      loader_strategies dictionary, which maps relationship names to
+      'selectin', 'joined', 'subquery', or 'lazy'.
+
+    - Unless project is False, each model is loaded with only the columns the
+      data specification reads (see read_plan) plus the keys needed to load
+      its relationships, so wide columns which weren't asked for are never
+      fetched.
+    """
+    columns, options = _loader_options(model, graph, project)
+    return ([orm.load_only(*[getattr(model, name) for name in columns])] if columns else []) + options
+
+
+def joins_collection(model, graph):
+    """
+    Returns whether the loader options for the given data specification would
+    eagerly load a collection with a join (either directly or through joined
+    many-to-one relationships), which makes the query return a row for each
+    member of the collection rather than one per instance of the model.
+    """
+    mapper = class_mapper(model)
+    for name, subgraph in (normalize_object_graph(graph) or {}).items():
+        if subgraph and name in mapper.relationships:
+            prop = mapper.relationships[name]
+            strategy = getattr(model, 'loader_strategies', {}).get(name, 'selectin' if prop.uselist else 'joined')
+            if strategy == 'joined' and (prop.uselist or joins_collection(prop.mapper.class_, subgraph)):
+                return True
+    return False
+
+
+def _loader_options(model, graph, project):
+    graph = normalize_object_graph(graph)
+    plan = read_plan(model, graph) if project else None
+    mapper = class_mapper(model)
+
+    options = []
+    for name, subgraph in (graph or {}).items():
+        if subgraph and name in mapper.relationships:
+            prop = mapper.relationships[name]
+            submodel = prop.mapper.class_
+            strategy = getattr(model, 'loader_strategies', {}).get(name, 'selectin' if prop.uselist else 'joined')
+            assert strategy in _loaders, 'unknown loader strategy {!r} for {}.{}'.format(strategy, model.__name__, name)
+            option = _loaders[strategy](getattr(model, name))
+            subcolumns, suboptions = _loader_options(submodel, subgraph, project)
+            if subcolumns:
+                option = option.load_only(*[getattr(submodel, subname) for subname in subcolumns])
+            if suboptions:
+                option = option.options(*suboptions)
+            options.append(option)
+
+    columns = None
+    if plan:
+        columns, relationships = plan
+        for name in relationships:
+            for column in mapper.relationships[name].local_columns:
+                key = mapper.get_property_by_column(column).key
+                if key not in columns:
+                    columns = columns + [key]
+    return columns, options
+
+
 def collect_ancestor_classes(cls, terminal_cls=None, module=None):
     """
     Collects all the classes in the inheritance hierarchy of the given class,
@@ -547,7 +674,8 @@ def normalize_query(query, top_level=True, supermodel=None):
     if query is None:
         raise ValueError('None passed for query parameter')
 
-    query = listify(deepcopy(query))
+    # nested clauses are normalized in place, since they're part of our copy
+    query = listify(deepcopy(query) if top_level else query)
 
     queries = []
     for q in query:
@@ -621,6 +749,212 @@ def get_queries(x):
     return [d for d in queries if isinstance(d.get("_model"), six.string_types)]
 
 
+def _pattern(prefix, value, suffix):
+    if isinstance(value, six.string_types):
+        return prefix + value + suffix
+    else:
+        return literal(prefix) + value + literal(suffix)
+
+_comparisons = {
+    'eq': lambda field, val: field == val,
+    'ne': lambda field, val: field != val,
+    'lt': lambda field, val: field < val,
+    'le': lambda field, val: field <= val,
+    'gt': lambda field, val: field > val,
+    'ge': lambda field, val: field >= val,
+    'in': lambda field, val: field.in_(val),
+    'notin': lambda field, val: ~field.in_(val),
+    'isnull': lambda field, val: field == None,
+    'isnotnull': lambda field, val: field != None,
+    'contains': lambda field, val: field.like(_pattern('%', val, '%')),
+    'icontains': lambda field, val: field.ilike(_pattern('%', val, '%')),
+    'like': lambda field, val: field.like(_pattern('%', val, '%')),
+    'ilike': lambda field, val: field.ilike(_pattern('%', val, '%')),
+    'startswith': lambda field, val: field.startswith(val),
+    'endswith': lambda field, val: field.endswith(val),
+    'istartswith': lambda field, val: field.ilike(_pattern('', val, '%')),
+    'iendswith': lambda field, val: field.ilike(_pattern('%', val, ''))
+}
+
+
+def filter_shape(filters, values=None):
+    """
+    Returns a (shape, values) tuple for a normalized filter, where the shape is
+    a copy of the filter with each comparison value replaced by a placeholder
+    and values is the list of the values that were replaced, so that filters
+    which differ only in their values have the same shape.  None values are
+    left in place, since comparing to None generates different SQL, as are
+    subqueries, whose own values are replaced.
+    """
+    values = [] if values is None else values
+    shape = {key: filters[key] for key in ['_model', 'field', 'comparison', 'select'] if key in filters}
+    for op in ['and', 'or']:
+        if op in filters:
+            shape[op] = [filter_shape(clause, values)[0] for clause in filters[op]]
+    if 'value' in filters:
+        value = filters['value']
+        if isinstance(value, dict):
+            shape['value'] = filter_shape(value, values)[0]
+        elif value is None:
+            shape['value'] = None
+        else:
+            expanding = filters.get('comparison') in ['in', 'notin']
+            shape['value'] = {'_param': len(values), 'expanding': expanding}
+            values.append(list(value) if expanding else value)
+    return shape, values
+
+
+def supports_window_count(dialect):
+    """
+    Returns whether the database supports "count(*) OVER ()", which lets
+    crud.read fetch a page of results and the total number of matches in a
+    single query; SQLite only added window functions in version 3.25 and
+    MySQL in version 8.
+    """
+    if dialect.name == 'sqlite':
+        return getattr(dialect.dbapi, 'sqlite_version_info', (0,)) >= (3, 25)
+    elif dialect.name == 'mysql':
+        return (dialect.server_version_info or (0,)) >= (8,)
+    else:
+        return dialect.name in ['postgresql', 'oracle', 'mssql']
+
+
+def estimate_count(session, query):
+    """
+    Returns the query planner's estimate of how many rows the query will
+    return, which is much cheaper than counting them on large tables but may
+    be off by quite a bit.  Only PostgreSQL exposes this, so on any other
+    database we fall back to an exact count.
+    """
+    if session.get_bind().dialect.name == 'postgresql':
+        try:
+            compiled = query.statement.compile(dialect=session.get_bind().dialect)
+            plan = session.connection().exec_driver_sql('EXPLAIN (FORMAT JSON) ' + six.text_type(compiled), compiled.params).scalar()
+            plan = json.loads(plan) if isinstance(plan, six.string_types) else plan
+            return int(plan[0]['Plan']['Plan Rows'])
+        except:
+            log.warning('unable to get an estimated count, falling back to an exact count', exc_info=True)
+    return query.count()
+
+
+_cursor_types = {
+    'datetime': (datetime, datetime.fromisoformat),
+    'date': (date, date.fromisoformat),
+    'time': (time, time.fromisoformat)
+}
+
+
+def encode_cursor(sort, values):
+    """
+    Returns the opaque cursor string which crud.read hands back as next_cursor:
+    the sort it was generated for along with the sort key values of the last
+    row of the page, base64-encoded JSON.
+    """
+    encoded = []
+    for value in values:
+        for name, (type_, parse) in _cursor_types.items():
+            # datetime is a subclass of date, so we check the exact type
+            if type(value) is type_:
+                value = {name: value.isoformat()}
+                break
+        else:
+            value = value if isinstance(value, (six.string_types, int, float, bool, type(None))) else six.text_type(value)
+        encoded.append(value)
+    cursor = json.dumps({'sort': sort, 'values': encoded}, sort_keys=True, separators=(',', ':'))
+    return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, sort):
+    """
+    Returns the sort key values from a cursor returned by encode_cursor, raising
+    a CrudException if it's malformed or was generated for a different sort.
+    """
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        values = []
+        for value in cursor['values']:
+            if isinstance(value, dict):
+                [(name, value)] = value.items()
+                value = _cursor_types[name][1](value)
+            values.append(value)
+    except Exception:
+        raise CrudException('invalid cursor: {!r}'.format(cursor))
+
+    if cursor['sort'] != sort or len(values) != len(sort):
+        raise CrudException('cursor was generated for a different sort order: {!r}'.format(cursor['sort']))
+    return values
+
+
+def keyset_filter(keys, values):
+    """
+    Returns a clause matching the rows which come after the given sort key
+    values, where keys is a list of (expression, direction, lowered) tuples
+    in order of priority; lowered expressions are compared case-insensitively,
+    matching how string columns are sorted.  Rows with NULL sort key values
+    can't be compared this way, so sort on non-nullable columns when paging
+    with cursors.
+    """
+    clauses = []
+    for i, (expression, direction, lowered) in enumerate(keys):
+        value = func.lower(values[i]) if lowered else values[i]
+        earlier = [key[0] == (func.lower(values[j]) if key[2] else values[j]) for j, key in enumerate(keys[:i])]
+        clauses.append(and_(*(earlier + [expression > value if direction == 'asc' else expression < value])))
+    return or_(*clauses)
+
+
+class _LRUCache(object):
+    """
+    A thread-safe dictionary which holds at most the given number of entries,
+    evicting the least recently used entry to make room for new ones.  If a ttl
+    is given, entries also expire that many seconds after they were computed.
+    """
+    def __init__(self, size, ttl=None):
+        self.size, self.ttl = size, ttl
+        self.lock = RLock()
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key, compute):
+        """Returns the value cached for the key, calling compute() to fill it in on a miss."""
+        with self.lock:
+            if key in self.entries:
+                value, expires = self.entries[key]
+                if expires is None or expires > monotonic():
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return value
+                del self.entries[key]
+            self.misses += 1
+
+        value = compute()
+        with self.lock:
+            self.entries[key] = value, (None if self.ttl is None else monotonic() + self.ttl)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'max_size': self.size, 'hits': self.hits, 'misses': self.misses}
+
+# Subscriptions re-run the same read every time one of their models changes,
+# so we remember estimated totals keyed on the query and the ids of the page of
+# results it returned; if the page is unchanged then the total most likely is
+# too, so we return the previous total instead of asking the database again.
+# Rows can be added past the end of an unchanged page, so these expire after
+# crud.estimated_total_ttl seconds.
+_total_cache = _LRUCache(1000, ttl=config['crud.estimated_total_ttl'])
+
+# where clauses for crud queries, keyed on the model and the query's shape
+_filter_clauses = _LRUCache(1000)
+
+
 def crud_exceptions(fn):
     """A decorator designed to catch exceptions from the crud api methods."""
     @wraps(fn)
@@ -704,18 +1038,39 @@ def make_crud_service(Session):
             return {model.__name__ for model in cls._collect_models(get_queries([args, kwargs]))}
 
         @classmethod
-        def _sort_query(cls, query, model, sort):
-            sort = normalize_sort(model, sort)
-            for sorter in sort:
-                dir = {'asc': asc, 'desc': desc}[sorter['dir']]
-                field = sorter['field']
+        def _sort_keys(cls, model, sort):
+            """
+            Returns a list of (expression, direction, lowered) tuples for the
+            normalized sort, where string columns are sorted case-insensitively.
+            """
+            keys = []
+            for sorter in normalize_sort(model, sort):
+                field, lowered = sorter['field'], False
                 if model:
                     field = getattr(model, field)
                     if issubclass(type(field.__clause_element__().type), String):
-                        field = func.lower(field)
-                query = query.order_by(dir(field))
+                        field, lowered = func.lower(field), True
+                keys.append((field, sorter['dir'], lowered))
+            return keys
+
+        @classmethod
+        def _sort_query(cls, query, model, sort):
+            for field, dir, lowered in cls._sort_keys(model, sort):
+                query = query.order_by({'asc': asc, 'desc': desc}[dir](field))
             return query
 
+        @classmethod
+        def _paging_sort(cls, model, order):
+            """
+            Returns the normalized sort for a paged read, with the id added as a
+            final tie-breaker so that rows have a stable order and every row has
+            a distinct cursor.
+            """
+            sort = normalize_sort(model, order)
+            if 'id' not in [sorter['field'] for sorter in sort]:
+                sort.append({'field': 'id', 'dir': 'asc'})
+            return sort
+
         @classmethod
         def _limit_query(cls, query, limit, offset):
             if offset is not None:
@@ -751,7 +1106,7 @@ def make_crud_service(Session):
             if filters:
                 query = cls._distinct_query(query, filters)
                 query = cls._groupby_query(query, filters)
-                filters = cls._resolve_filters(filters, model)
+                filters = cls._filter_clause(filters, model)
                 if filters is not None:
                     query = query.filter(filters)
             if sort:
@@ -759,33 +1114,210 @@ def make_crud_service(Session):
             query = cls._limit_query(query, limit, offset)
             return query
 
+        @classmethod
+        def _total(cls, count_query, total, filters, order, limit, offset, ids, cursor=None):
+            """
+            Returns the total for crud.read given the unlimited query and the ids
+            of the page of results it returned.  When the page wasn't cut short by
+            the limit, its length already tells us the total without a second trip
+            to the database, unless it started from a cursor since then we don't
+            know how many rows came before it.
+            """
+            if not total:
+                return None
+            elif cursor is None and (not limit or len(ids) < limit) and (ids or not offset):
+                return (offset or 0) + len(set(ids))
+            elif total == 'estimate':
+                key = json.dumps([filters, order, limit, offset, cursor], cls=serializer, sort_keys=True), tuple(six.text_type(id) for id in ids)
+                return _total_cache.get(key, lambda: estimate_count(count_query.session, count_query))
+            else:
+                return count_query.count()
+
+        @classmethod
+        def _crud_read(cls, instances):
+            """
+            Returns instance.crud_read(attrs) for each (instance, attrs) pair, but
+            only looks up the serialization plan for each model and data spec
+            once instead of once per instance.
+            """
+            plans, results = {}, []
+            for instance, attrs in instances:
+                model = instance.__class__
+                if model.crud_read is not CrudMixin.crud_read or model.to_dict is not CrudMixin.to_dict:
+                    results.append(instance.crud_read(attrs))
+                else:
+                    if (model, id(attrs)) not in plans:
+                        plans[model, id(attrs)] = to_dict_plan(model, attrs, _crud_read_validator)
+                    results.append(plans[model, id(attrs)].serialize(instance))
+            return results
+
+        @classmethod
+        def _bulk_insertable(cls, model, attrs):
+            """
+            Returns whether the item can be created with a bulk INSERT instead of
+            through the ORM, which is the case if it only sets plain columns of a
+            model with a single table, no polymorphic discriminator, no insert
+            event listeners, and which doesn't override crud_create or from_dict
+            (which could set anything, e.g. relationships, that a bulk INSERT of
+            its column values would silently drop).
+            """
+            if not inspect.isclass(model) or not issubclass(model, CrudMixin):
+                return False
+            elif model.crud_create is not CrudMixin.crud_create or model.from_dict is not CrudMixin.from_dict:
+                return False
+            mapper = class_mapper(model)
+            return (len(mapper.tables) == 1 and mapper.polymorphic_on is None
+                    and not mapper.dispatch.before_insert and not mapper.dispatch.after_insert
+                    and all(name.startswith('_') or name in mapper.column_attrs for name in attrs))
+
+        @classmethod
+        def _conflict_columns(cls, model, upsert):
+            if upsert is True:
+                return [column.name for column in class_mapper(model).local_table.primary_key.columns]
+            else:
+                return [getattr(model, name).property.columns[0].name for name in listify(upsert)]
+
+        @classmethod
+        def _bulk_insert(cls, session, instances, upsert=None):
+            """
+            INSERTs the column values which have been set on the given unsaved
+            instances of the same model, with one executemany for each distinct
+            set of columns, optionally updating rows which conflict with them.
+            """
+            model = instances[0].__class__
+            table = class_mapper(model).local_table
+            groups = collections.OrderedDict()
+            for instance in instances:
+                row = {}
+                for prop in class_mapper(model).column_attrs:
+                    column = prop.columns[0]
+                    if prop.key in instance.__dict__ and getattr(column, 'table', None) is table:
+                        row[column.key] = instance.__dict__[prop.key]
+                groups.setdefault(frozenset(row), []).append(row)
+
+            for rows in groups.values():
+                statement = table.insert()
+                if upsert:
+                    dialect = session.get_bind().dialect.name
+                    if dialect == 'postgresql':
+                        from sqlalchemy.dialects.postgresql import insert
+                    elif dialect == 'sqlite':
+                        from sqlalchemy.dialects.sqlite import insert
+                    else:
+                        raise CrudException('upsert is not supported on {}'.format(dialect))
+
+                    conflict = cls._conflict_columns(model, upsert)
+                    statement = insert(table)
+                    updates = {key: statement.excluded[key] for key in rows[0]
+                               if key not in conflict and not table.c[key].primary_key}
+                    if updates:
+                        statement = statement.on_conflict_do_update(index_elements=conflict, set_=updates)
+                    else:
+                        statement = statement.on_conflict_do_nothing(index_elements=conflict)
+                session.execute(statement, rows)
+
+        @classmethod
+        def _bulk_read(cls, session, model, instances, upsert=None, batch_size=500):
+            """
+            Reads back the rows which were written for the given instances by
+            _bulk_insert, in batches, returning a dictionary mapping the id() of
+            each instance to its crud_read().  Upserted rows may have kept their
+            existing ids, so those are matched on the upsert's conflict columns.
+            """
+            table = class_mapper(model).local_table
+            columns = [table.c[name] for name in (cls._conflict_columns(model, upsert) if upsert else ['id'])]
+            attr_names = [class_mapper(model).get_property_by_column(column).key for column in columns]
+            key = lambda obj: tuple(six.text_type(getattr(obj, name)) for name in attr_names)
+
+            read = {}
+            for i in range(0, len(instances), batch_size):
+                batch = instances[i:i + batch_size]
+                if len(columns) == 1:
+                    clause = columns[0].in_([instance.__dict__.get(attr_names[0]) for instance in batch])
+                else:
+                    clause = tuple_(*columns).in_([tuple(instance.__dict__.get(name) for name in attr_names) for instance in batch])
+                rows = {key(row): row for row in session.query(model).filter(clause)}
+                read.update({id(instance): rows[key(instance)].crud_read() for instance in batch})
+            return read
+
+        @classmethod
+        def _set_based(cls, session, model, filter, statement):
+            """
+            Executes an UPDATE or DELETE statement against the rows matching the
+            given query, returning the ids of the rows it affected.  These come
+            from RETURNING where the database supports it, and are otherwise
+            selected beforehand in the same transaction.
+            """
+            if len(class_mapper(model).tables) != 1:
+                raise CrudException('set-based updates and deletes are not supported for {}, which spans multiple tables'.format(model.__name__))
+
+            matching = cls._filter_query(session.query(model), model, filter).with_entities(model.id)
+            statement = statement.where(model.id.in_(matching.statement))
+            if session.get_bind().dialect.full_returning:
+                return [id for id, in session.execute(statement.returning(model.id))]
+            else:
+                ids = [id for id, in matching]
+                session.execute(statement)
+                return ids
+
+        @classmethod
+        def _bulk_update(cls, session, model, filter, attrs):
+            """
+            Checks the plain column values of the data specification against the
+            model's update permissions and validators, then sets them on all of
+            the rows matching the query with a single UPDATE.  Attributes with
+            validators which depend on the instance (i.e. any not declared with
+            uses_instance=False) can't be validated without loading each row,
+            so they can't be set this way.
+            """
+            mapper = class_mapper(model)
+            values = {}
+            for name, value in attrs.items():
+                if name.startswith('_'):
+                    continue
+                elif name not in mapper.column_attrs:
+                    raise CrudException('bulk updates may only set plain columns, not {}.{}'.format(model.__name__, name))
+                elif name not in getattr(model, '_crud_perms', {}).get('update', []):
+                    raise CrudException('Attempt to update non-updateable attribute {}.{}'.format(model.__name__, name))
+
+                for val_dict in getattr(model, '_validators', {}).get(name, []):
+                    if val_dict.get('uses_instance', True):
+                        raise CrudException('bulk updates may not set {}.{}, which has a validator that depends on the instance'.format(model.__name__, name))
+                    elif not val_dict['model_validator'](None, value):
+                        raise CrudException('validation failed for {}.{} with value {!r}: {}'.format(
+                            model.__name__, name, value, val_dict.get('validator_message')))
+                values[mapper.column_attrs[name].columns[0].key] = value
+
+            if not values:
+                return []
+            return cls._set_based(session, model, filter, mapper.local_table.update().values(values))
+
         @classmethod
         def _resolve_comparison(cls, comparison, column, value):
-            if isinstance(value, dict):
+            if isinstance(value, dict) and '_param' in value:
+                value = bindparam('crud_{}'.format(value['_param']), expanding=value['expanding'])
+            elif isinstance(value, dict):
                 model_class = Session.resolve_model(value.get('_model'))
                 field = value.get('select', 'id')
                 value = select(getattr(model_class, field)).where(cls._resolve_filters(value))
 
-            return {
-                'eq': lambda field, val: field == val,
-                'ne': lambda field, val: field != val,
-                'lt': lambda field, val: field < val,
-                'le': lambda field, val: field <= val,
-                'gt': lambda field, val: field > val,
-                'ge': lambda field, val: field >= val,
-                'in': lambda field, val: field.in_(val),
-                'notin': lambda field, val: ~field.in_(val),
-                'isnull': lambda field, val: field == None,
-                'isnotnull': lambda field, val: field != None,
-                'contains': lambda field, val: field.like('%'+val+'%'),
-                'icontains': lambda field, val: field.ilike('%'+val+'%'),
-                'like': lambda field, val: field.like('%'+val+'%'),
-                'ilike': lambda field, val: field.ilike('%'+val+'%'),
-                'startswith': lambda field, val: field.startswith(val),
-                'endswith': lambda field, val: field.endswith(val),
-                'istartswith': lambda field, val: field.ilike(val+'%'),
-                'iendswith': lambda field, val: field.ilike('%'+val)
-            }[comparison](column, value)
+            return _comparisons[comparison](column, value)
+
+        @classmethod
+        def _filter_clause(cls, filters, model=None):
+            """
+            Returns the where clause for the normalized filters.  Our clients
+            send the same few shapes of query over and over with different
+            values, so we cache the clause built for each shape (see
+            filter_shape) with bind parameters in place of the values, and
+            only need to fill in the values when the shape has been seen before.
+            """
+            shape, values = filter_shape(filters)
+            key = Session.resolve_model(filters.get('_model', model)), json.dumps(shape, sort_keys=True, default=repr)
+            clause = _filter_clauses.get(key, lambda: cls._resolve_filters(shape, model))
+            if clause is None or not values:
+                return clause
+            return clause.unique_params({'crud_{}'.format(i): value for i, value in enumerate(values)})
 
         @classmethod
         def _resolve_filters(cls, filters, model=None):
@@ -921,7 +1453,7 @@ def make_crud_service(Session):
             return results
 
         @crud_subscribes.__func__
-        def read(query, data=None, order=None, limit=None, offset=0):
+        def read(query, data=None, order=None, limit=None, offset=0, total=True, cursor=None):
             """
             Get the model objects matching the supplied query parameters,
             optionally setting which part of the objects are in the returned dictionary
@@ -942,6 +1474,17 @@ def make_crud_service(Session):
             @param offset: The offset parameter, when provided with positive integer
                 "F", at most "L" results will be returned after skipping the first "F"
                 results (first based on ordering)
+            @param total: whether and how to count the total number of matching
+                objects; True (the default) returns the exact count, which is
+                fetched along with the results in a single query when the
+                database supports window functions, 'estimate' returns a cheaper
+                approximation on databases which can provide one, and False skips
+                counting entirely and returns None as the total
+            @param cursor: the next_cursor returned by a previous call with the
+                same query, order and limit; rather than skipping rows with an
+                offset, the results will start right after the last row of that
+                previous page, which stays fast on deep pages and doesn't shift
+                when rows are inserted or deleted before it
             @return: one or more data specification dictionaries with models that
                 match the provided queries including all readable fields without
                 following foreign keys (the default if no data parameter is included),
@@ -951,21 +1494,75 @@ def make_crud_service(Session):
                 return {
                     total: <int> # count of ALL matching objects, separate from <limit>
                     results: [c{dict}, c{dict}, ... , c{dict}] # subject to <limit>
+                    next_cursor: <str> # only included when paging with a limit or
+                                       # cursor, or None if this is the last page
                 }
             """
+            if total not in [True, False, 'estimate']:
+                raise CrudException('total must be True, False, or "estimate", not {!r}'.format(total))
+            if cursor and offset:
+                raise CrudException('offset cannot be used with a cursor')
+
             with Session() as session:
                 filters = normalize_query(query)
                 data = normalize_data(data, len(filters))
                 if len(filters) == 1:
                     filter = filters[0]
                     model = Session.resolve_model(filter['_model'])
-                    total = 0
-                    results = []
+                    response = {'total': 0, 'results': []}
+                    if limit or cursor:
+                        response['next_cursor'] = None
                     if getattr(model, '_crud_perms', {}).get('read', True):
-                        total = Crud._filter_query(session.query(model), model, filter).count()
-                        results = Crud._filter_query(session.query(model), model, filter, limit, offset, order).all()
+                        # when paging we add the id to the sort as a tie-breaker
+                        # so that each row has a distinct cursor
+                        sort = order
+                        if limit or cursor:
+                            sort = Crud._paging_sort(model, order)
+                            sort_fields = [sorter['field'] for sorter in sort]
+
+                        # when only plain columns were requested we skip creating
+                        # model instances and build the results from the rows
+                        plan = read_plan(model, data[0])
+                        columns = None
+                        if plan and not plan[1] and not filter.get('distinct') and not filter.get('groupby'):
+                            columns = plan[0]
+                            if limit or cursor:
+                                columns = columns + [field for field in sort_fields if field not in columns]
+                            page = session.query(*[getattr(model, name) for name in columns])
+                        else:
+                            page = session.query(model).options(*loader_options(model, data[0]))
+                        if cursor:
+                            values = decode_cursor(cursor, [[sorter['field'], sorter['dir']] for sorter in sort])
+                            page = page.filter(keyset_filter(Crud._sort_keys(model, sort), values))
+                        page = Crud._filter_query(page, model, filter, limit, offset, sort)
+                        count_query = Crud._filter_query(session.query(model), model, filter)
+
+                        # the window count is computed over the rows the query
+                        # returns, so we can't use it when those are multiplied
+                        # by joining in a collection
+                        if (total is True and not cursor and not filter.get('distinct') and supports_window_count(session.get_bind().dialect)
+                                and (columns or not joins_collection(model, data[0]))):
+                            rows = page.add_columns(func.count().over()).all()
+                            count = rows[0][-1] if rows else Crud._total(count_query, total, filter, order, limit, offset, [])
+                            results = [row[:-1] if columns else row[0] for row in rows]
+                        else:
+                            results = page.all()
+                            count = Crud._total(count_query, total, filter, order, limit, offset, [r[0] if columns else r.id for r in results], cursor)
 
-                    return {'total': total, 'results': [r.crud_read(data[0]) for r in results]}
+                        if limit and len(results) == limit:
+                            if columns:
+                                last = dict(zip(columns, results[-1]))
+                                values = [last[field] for field in sort_fields]
+                            else:
+                                values = [getattr(results[-1], field) for field in sort_fields]
+                            response['next_cursor'] = encode_cursor([[sorter['field'], sorter['dir']] for sorter in sort], values)
+
+                        response['total'] = count
+                        if columns:
+                            response['results'] = model.rows_to_dicts(columns, results, data[0], validator=_crud_read_validator)
+                        else:
+                            response['results'] = Crud._crud_read([(r, data[0]) for r in results])
+                    return response
 
                 elif len(filters) > 1:
                     queries = []
@@ -976,26 +1573,40 @@ def make_crud_service(Session):
                         model = Session.resolve_model(filter['_model'])
                         if getattr(model, '_crud_perms', {}).get('read', True):
                             queried_models.append(model)
-                            query_fields = [model.id, cast(literal(model.__name__), Text).label("_table_name"), cast(literal(filter_index), Integer)]
+                            query_fields = [model.id.label('_id'), cast(literal(model.__name__), Text).label("_table_name"), cast(literal(filter_index), Integer)]
                             for sort_index, sort in enumerate(normalize_sort(model, order)):
                                 sort_field = getattr(model, sort['field'])
-                                sort_field_types[sort_index] = type(sort_field.__clause_element__().type)
+                                sort_field_types[sort_index] = sort_field.__clause_element__().type
                                 query_fields.append(sort_field.label('anon_sort_{}'.format(sort_index)))
                             queries.append(Crud._filter_query(session.query(*query_fields), model, filter))
                             count_queries.append(Crud._filter_query(session.query(model.id), model, filter))
 
-                    total = count_queries[0].union(*(count_queries[1:])).count()
                     query = queries[0].union(*(queries[1:]))
                     normalized_sort_fields = normalize_sort(None, order)
+
+                    # the union's rows are sorted by their labelled sort columns,
+                    # then by model name and id so that paging has a stable order
+                    keys = []
                     for sort_index, sort in enumerate(normalized_sort_fields):
-                        dir = {'asc': asc, 'desc': desc}[sort['dir']]
-                        sort_field = 'anon_sort_{}'.format(sort_index)
-                        if issubclass(sort_field_types[sort_index], String):
-                            sort_field = 'lower({})'.format(sort_field)
-                        query = query.order_by(dir(sort_field))
-                    if normalized_sort_fields:
-                        query = query.order_by("_table_name")
+                        sort_field = literal_column('anon_sort_{}'.format(sort_index), sort_field_types[sort_index])
+                        lowered = isinstance(sort_field_types[sort_index], String)
+                        keys.append((func.lower(sort_field) if lowered else sort_field, sort['dir'], lowered))
+                    keys.append((literal_column('_table_name', Text()), 'asc', False))
+                    if limit or cursor:
+                        keys.append((literal_column('_id', queried_models[0].id.type), 'asc', False))
+                    sort_spec = [[sort['field'], sort['dir']] for sort in normalized_sort_fields] + [['_table_name', 'asc'], ['id', 'asc']]
+
+                    if cursor:
+                        query = query.filter(keyset_filter(keys, decode_cursor(cursor, sort_spec)))
+                    for sort_field, dir, lowered in keys:
+                        query = query.order_by({'asc': asc, 'desc': desc}[dir](sort_field))
                     rows = Crud._limit_query(query, limit, offset).all()
+                    count = Crud._total(count_queries[0].union(*(count_queries[1:])), total, filters, order, limit, offset, [row[0] for row in rows], cursor)
+
+                    next_cursor = None
+                    if limit and len(rows) == limit:
+                        last = rows[-1]
+                        next_cursor = encode_cursor(sort_spec, [last[3 + i] for i in range(len(normalized_sort_fields))] + [last[1], last[0]])
 
                     result_table = {}
                     result_order = {}
@@ -1009,7 +1620,13 @@ def make_crud_service(Session):
                         query_index_table[id] = query_index
 
                     for model, ids in result_table.items():
-                        result_table[model] = session.query(model).filter(model.id.in_(ids)).all()
+                        # if different queries for this model have different data
+                        # specs then we need all of their columns, so only project
+                        # the columns when there's just one
+                        query_indexes = {query_index_table[id] for id in ids}
+                        options = [option for query_index in query_indexes
+                                          for option in loader_options(model, data[query_index], project=len(query_indexes) == 1)]
+                        result_table[model] = session.query(model).filter(model.id.in_(ids)).options(*options).all()
 
                     ordered_results = len(result_order) * [None]
                     for model, instances in result_table.items():
@@ -1017,20 +1634,38 @@ def make_crud_service(Session):
                             ordered_results[result_order[instance.id]] = instance
                     results = [r for r in ordered_results if r is not None]
 
-                    return {'total': total, 'results': [r.crud_read(data[query_index_table[r.id]]) for r in results]}
+                    response = {'total': count, 'results': Crud._crud_read([(r, data[query_index_table[r.id]]) for r in results])}
+                    if limit or cursor:
+                        response['next_cursor'] = next_cursor
+                    return response
                 else:
                     return {'total': 0, 'results': []}
 
         @crud_notifies.__func__
-        def create(data):
+        def create(data, returning=True, upsert=None):
             """
             Create a model object using the provided data specifications.
 
+            Consecutive items for the same model which only set plain columns
+            are written with a single bulk INSERT rather than flushing each
+            instance through the ORM; they're still instantiated so that their
+            validators and defaults apply, but their models must not rely on
+            ORM insert events.
+
             @param data: one or more data specification (as c{dict} or [c{dict}]),
                 corresponding to the format of the data specification parameter
                 described in the module-level docstrings. A new object will be created
                 for each data specification dictionary provided.
-            @return: True if the objects were successfully created
+            @param returning: if True (the default) the created objects are read
+                back and returned; pass False to skip that when creating a large
+                number of objects
+            @param upsert: if provided, items which conflict with an existing row
+                update that row instead of failing to be created; this may be True
+                to match rows on their primary key or a list of the column names of
+                a unique constraint. Only supported on PostgreSQL and SQLite, and
+                only for items which only set plain columns
+            @return: the crud_read() of each created object, or True if the
+                returning parameter is False
             """
             data = normalize_data(data)
             if any('_model' not in attrs for attrs in data):
@@ -1038,17 +1673,48 @@ def make_crud_service(Session):
 
             created = []
             with Session() as session:
+                pending = []  # consecutive items for the same model to insert in bulk
                 for attrs in data:
                     model = Session.resolve_model(attrs['_model'])
+                    bulk = Crud._bulk_insertable(model, attrs)
+                    if upsert and not bulk:
+                        raise CrudException('upsert is only supported for items which only set plain columns')
+                    if pending and (not bulk or pending[0].__class__ is not model):
+                        Crud._bulk_insert(session, pending, upsert)
+                        pending = []
+
                     instance = model()
-                    session.add(instance)
-                    instance.crud_create(**attrs)
-                    session.flush()  # any items that were created should now be queryable
-                    created.append(instance.crud_read())
-            return created
+                    if bulk:
+                        instance.crud_create(**attrs)
+                    else:
+                        session.add(instance)
+                        instance.crud_create(**attrs)
+
+                    if bulk and instance.id is not None:
+                        pending.append(instance)
+                        created.append(instance)
+                    else:
+                        # without an id we wouldn't be able to read it back
+                        session.add(instance)
+                        session.flush()  # any items that were created should now be queryable
+                        created.append(instance.crud_read() if returning else None)
+                if pending:
+                    Crud._bulk_insert(session, pending, upsert)
+
+                if not returning:
+                    return True
+
+                inserted = defaultdict(list)
+                for instance in created:
+                    if isinstance(instance, CrudMixin):
+                        inserted[instance.__class__].append(instance)
+                read = {}
+                for model, instances in inserted.items():
+                    read.update(Crud._bulk_read(session, model, instances, upsert))
+                return [read[id(instance)] if isinstance(instance, CrudMixin) else instance for instance in created]
 
         @crud_notifies.__func__
-        def update(query, data):
+        def update(query, data, bulk=False):
             """
             Get the model objects matching the supplied query parameters,
             setting the fields of the resulting objects to the values specified in
@@ -1062,35 +1728,54 @@ def make_crud_service(Session):
                 described in the module-level docstrings. The length of the data
                 parameter should be N, where N is the number of queries after
                 normalization
-            @return: True if the objects were successfully updated
+            @param bulk: if True, each query and data specification are compiled
+                to a single UPDATE statement instead of loading and updating each
+                matching object; the data specifications may then only set plain
+                columns whose validators were declared with uses_instance=False
+                (see crud_validation)
+            @return: True if the objects were successfully updated, or the ids of
+                the updated objects if bulk is True
             """
             filters = normalize_query(query)
             data = normalize_data(data, len(filters))
+            updated = []
             with Session() as session:
                 for filter, attrs in zip(filters, data):
                     model = Session.resolve_model(filter['_model'])
+                    if bulk:
+                        updated.extend(Crud._bulk_update(session, model, filter, attrs))
+                        continue
                     for instance in Crud._filter_query(session.query(model), model, filter):
                         instance.crud_update(**attrs)
                         # any items that were created should now be queryable
                         session.flush()
-            return True
+            return updated if bulk else True
 
         @crud_notifies.__func__
-        def delete(query):
+        def delete(query, bulk=False):
             """
             Delete the model objects matching the supplied query parameters
 
             @param id: one of more queries (as c{dict} or [c{dict}]), corresponding
                 to the format of the query parameter described in the module-level
                 docstrings. This query parameter will be normalized
-            @return: True if the objects were successfully updated
+            @param bulk: if True, each query is compiled to a single DELETE
+                statement which may delete any number of objects; this relies on
+                the database's ON DELETE rules rather than ORM cascades
+            @return: the number of objects deleted; note that if bulk is True
+                this is instead the list of the ids of the deleted objects, which
+                may be any number of them (check its length for the count)
             """
-            deleted = 0
+            deleted = [] if bulk else 0
             filters = normalize_query(query)
             with Session() as session:
                 for filter in filters:
                     model = Session.resolve_model(filter['_model'])
-                    if getattr(model, '_crud_perms', {}).get('can_delete', False):
+                    if bulk:
+                        if not getattr(model, '_crud_perms', {}).get('can_delete', False):
+                            raise CrudException('Attempt to delete non-deletable model {}'.format(model.__name__))
+                        deleted.extend(Crud._set_based(session, model, filter, class_mapper(model).local_table.delete()))
+                    elif getattr(model, '_crud_perms', {}).get('can_delete', False):
                         to_delete = Crud._filter_query(session.query(model), model, filter)
                         count = to_delete.count()
                         assert count in [0, 1], "each query passed to crud.delete must return at most 1 item"
@@ -1164,6 +1849,10 @@ class CrudMixin(object):
     # in addition to any default attributes, also show these in the repr
     _additional_repr_attr_names = ()
 
+    # override how crud.read eagerly loads relationships named in a data spec,
+    # e.g. {'players': 'joined'}; see loader_options for the available strategies
+    loader_strategies = {}
+
     @classmethod
     def _get_unique_constraint_column_names(cls):
         """
@@ -1185,7 +1874,83 @@ class CrudMixin(object):
         return cls._pk_names
 
     @classmethod
-    def _create_or_fetch(cls, session, value, **backref_mapping):
+    def _prefetch_key(cls, session, names, values):
+        """
+        Returns the values of the given columns as they'd be sent to the
+        database, so that values which were passed in can be matched against
+        those of loaded instances, or None if they can't be converted.
+        """
+        dialect = session.get_bind().dialect
+        key = []
+        for name in names:
+            processor = getattr(cls, name).property.columns[0].type.bind_processor(dialect)
+            try:
+                key.append(processor(values[name]) if processor else values[name])
+            except Exception:
+                return None
+        return tuple(key)
+
+    @classmethod
+    def _prefetch(cls, session, values, batch_size=500):
+        """
+        Fetches the existing instances that _create_or_fetch would otherwise
+        look up one at a time for each of the given values, using one IN query
+        per batch of ids and per unique constraint.
+
+        @return: a dictionary mapping ('id',) or the column names of a unique
+            constraint to a (found, queried) tuple, where found maps the keys
+            returned by _prefetch_key to the matching instance, and queried
+            is the set of keys which were looked up
+        """
+        lookups = defaultdict(dict)
+        for value in values:
+            id = value.get('id') if isinstance(value, Mapping) else value if isinstance(value, six.string_types) else None
+            if id is not None:
+                lookups[('id',)][cls._prefetch_key(session, ('id',), {'id': id})] = (id,)
+            elif isinstance(value, Mapping):
+                for column_names in cls._get_unique_constraint_column_names():
+                    if all((name in value and value[name]) for name in column_names):
+                        key = cls._prefetch_key(session, column_names, value)
+                        lookups[tuple(column_names)][key] = tuple(value[name] for name in column_names)
+
+        prefetched = {}
+        for names, keys in lookups.items():
+            keys.pop(None, None)
+            columns = [getattr(cls, name) for name in names]
+            found, raw = {}, list(keys.values())
+            try:
+                for i in range(0, len(raw), batch_size):
+                    batch = raw[i:i + batch_size]
+                    if len(columns) == 1:
+                        clause = columns[0].in_([value for value, in batch])
+                    else:
+                        clause = tuple_(*columns).in_(batch)
+                    for instance in session.query(cls).filter(clause):
+                        found[cls._prefetch_key(session, names, {name: getattr(instance, name) for name in names})] = instance
+            except Exception:
+                log.debug('unable to prefetch %s by %s, falling back to fetching individually', cls.__name__, names, exc_info=True)
+            else:
+                prefetched[names] = (found, set(keys))
+        return prefetched
+
+    @classmethod
+    def _lookup_prefetched(cls, session, prefetched, names, value):
+        """
+        Returns a (known, instance) tuple for the value from the results of
+        _prefetch, where known is False if we still need to query for it.
+        Ids which weren't found are always queried again, since the database
+        may consider them equal to an id of a different form.
+        """
+        if not prefetched or tuple(names) not in prefetched:
+            return False, None
+        found, queried = prefetched[tuple(names)]
+        key = cls._prefetch_key(session, names, value)
+        if key in found:
+            return True, found[key]
+        return key in queried and tuple(names) != ('id',), None
+
+    @classmethod
+    def _create_or_fetch(cls, session, value, prefetched=None, **backref_mapping):
         """
         Fetch an existing or create a new instance of this class. Fetching uses
         the values from the value positional argument (the id if available, or
@@ -1196,6 +1961,8 @@ class CrudMixin(object):
         @param cls: The class object we're going to fetch or create a new one of
         @param session: the session object
         @param value: the dictionary value to fetch with
+        @param prefetched: the result of calling _prefetch with a list of
+            values which includes this one, if any
         @param backref_mapping: the backref key name and value of the "parent"
             object of the object you're fetching or about to create. If the
             backref value of a fetched instance is not the same as the value
@@ -1220,16 +1987,24 @@ class CrudMixin(object):
 
         instance = None
         if id is not None:
-            try:
-                instance = session.query(cls).filter(cls.id == id).first()
-            except:
-                log.error('Unable to fetch instance based on id value %s', value, exc_info=True)
-                raise TypeError('Invalid instance ID type for relation: {0.__name__} (value: {1})'.format(cls, value))
+            known, instance = cls._lookup_prefetched(session, prefetched, ('id',), {'id': id})
+            if not known:
+                try:
+                    instance = session.query(cls).filter(cls.id == id).first()
+                except:
+                    log.error('Unable to fetch instance based on id value %s', value, exc_info=True)
+                    raise TypeError('Invalid instance ID type for relation: {0.__name__} (value: {1})'.format(cls, value))
         elif isinstance(value, Mapping):
             # if there's no id, check to see if we're provided a dictionary
             # that includes all of the columns associated with a UniqueConstraint.
             for column_names in cls._get_unique_constraint_column_names():
                 if all((name in value and value[name]) for name in column_names):
+                    known, instance = cls._lookup_prefetched(session, prefetched, column_names, value)
+                    if known:
+                        if instance is None:
+                            continue
+                        break
+
                     # all those column names are provided,
                     # use that to query by chaining together all the necessary
                     # filters to construct that query
@@ -1328,6 +2103,28 @@ class CrudMixin(object):
 
         return obj
 
+    @classmethod
+    def rows_to_dicts(cls, columns, rows, attrs=None, validator=lambda self, name: True):
+        """
+        Returns the same dictionaries that to_dict would for the given attrs, but
+        built straight from rows of column values instead of model instances;
+        the rows must contain a value for each of the named columns, which must
+        include every column that read_plan says to_dict would read.
+        """
+        plan = to_dict_plan(cls, attrs, validator)
+        dicts = []
+        for row in rows:
+            values = dict(zip(columns, row))
+            obj = {}
+            if plan.include_model:
+                obj['_model'] = cls.__name__
+            if plan.include_id:
+                obj['id'] = values['id']
+            for name, subattrs in plan.fields:
+                obj[name] = plan.cast_type(values[name])
+            dicts.append(obj)
+        return dicts
+
     def from_dict(self, attrs, validator=lambda self, name, val: True):
         relations = []
         # merge_relations modifies the dictionaries that are passed to it in
@@ -1411,22 +2208,30 @@ class CrudMixin(object):
             for i in value:
                 if backref_id_name is not None and isinstance(i, dict) and not i.get(backref_id_name):
                     i[backref_id_name] = self.id
-                relation_inst = relation_cls._create_or_fetch(session, i, **{backref_id_name: self.id} if backref_id_name else {})
+
+            prefetched = relation_cls._prefetch(session, value)
+            for i in value:
+                relation_inst = relation_cls._create_or_fetch(session, i, prefetched, **{backref_id_name: self.id} if backref_id_name else {})
                 if isinstance(i, dict):
                     relation_inst.from_dict(i, _crud_write_validator if relation_inst._sa_instance_state.identity else _crud_create_validator)
                 new_insts.append(relation_inst)
 
+            # the session's identity map guarantees one instance per row, so we
+            # can match stale and new instances by identity in constant time
             relation = original_value
-            remove_insts = [stale_inst for stale_inst in relation if stale_inst not in new_insts]
+            new_ids = {id(new_inst) for new_inst in new_insts}
+            remove_insts = [stale_inst for stale_inst in relation if id(stale_inst) not in new_ids]
 
             for stale_inst in remove_insts:
                 relation.remove(stale_inst)
                 if property.cascade.delete_orphan:
                     session.delete(stale_inst)
 
+            current_ids = {id(inst) for inst in relation}
             for new_inst in new_insts:
-                if new_inst.id is None or new_inst not in relation:
+                if new_inst.id is None or id(new_inst) not in current_ids:
                     relation.append(new_inst)
+                    current_ids.add(id(new_inst))
 
         elif isinstance(value, (collections.abc.Mapping, six.string_types)):
             if backref_id_name is not None and not value.get(backref_id_name):
@@ -1518,10 +2323,90 @@ class CrudMixin(object):
         return u if six.PY3 else u.encode('utf-8')
 
 
+class _ToDictPlan(object):
+    """
+    The work crud_read does for a given model class and data specification
+    which is the same for every instance: which attributes to read, which of
+    them _crud_read_validator allows, and how to cast their values.  Plans are
+    compiled once by to_dict_plan and cached, so serializing thousands of rows
+    for crud.read doesn't repeat this work for each one.  The validator is
+    called with the model class rather than an instance, so plans are only
+    used with validators which don't depend on instance state; to_dict itself
+    still validates each instance.
+    """
+    def __init__(self, model, attrs, validator):
+        self.model, self.validator = model, validator
+        self.include_model = attrs is None or attrs.get('_model', True)
+        self.include_id = attrs is None or attrs.get('id', True)
+        if attrs is None:
+            self.fields = [(name, None) for name in model.to_dict_default_attrs if validator(model, name)]
+        else:
+            self.fields = [(name, attrs.get(name)) for name in model.extra_defaults + list(attrs.keys())
+                                                   if validator(model, name) and attrs.get(name, True)]
+
+        self.type_casts = CrudMixin.type_casts.copy()
+        self.type_casts.update(model.type_casts)
+        self.subplans = {}
+
+    def cast_type(self, value):
+        # ensure that certain types are cast appropriately for daily usage
+        # e.g. we want the result of HashedPasswords to be the string
+        # representation instead of the object
+        cast = self.type_casts.get(value.__class__)
+        return value if cast is None else cast(value)
+
+    def serialize_related(self, name, subattrs, instance):
+        model = instance.__class__
+        if model.to_dict is not CrudMixin.to_dict:
+            return instance.to_dict(subattrs, self.validator)
+        elif (name, model) not in self.subplans:
+            self.subplans[name, model] = to_dict_plan(model, subattrs, self.validator)
+        return self.subplans[name, model].serialize(instance)
+
+    def serialize(self, instance):
+        obj = {}
+
+        # it's still possible for the client to blacklist this, but by default
+        # we're going to include them
+        if self.include_model:
+            obj['_model'] = self.model.__name__
+        if self.include_id:
+            obj['id'] = instance.id
+
+        for name, subattrs in self.fields:
+            attr = getattr(instance, name, None)
+            if isinstance(attr, self.model.BaseClass):
+                obj[name] = self.serialize_related(name, subattrs, attr)
+            elif isinstance(attr, (list, set, tuple, frozenset)):
+                obj[name] = []
+                for item in attr:
+                    if isinstance(item, self.model.BaseClass):
+                        obj[name].append(self.serialize_related(name, subattrs, item))
+                    else:
+                        obj[name].append(item)
+            elif callable(attr):
+                obj[name] = self.cast_type(attr())
+            else:
+                obj[name] = self.cast_type(attr)
+        return obj
+
+_to_dict_plans = _LRUCache(1000)
+
+
+def to_dict_plan(model, attrs, validator):
+    """
+    Returns the cached _ToDictPlan for serializing instances of the model with
+    the given data specification and validator, compiling it if necessary.
+    """
+    attrs = normalize_object_graph(attrs)
+    key = model, json.dumps(attrs, sort_keys=True, default=repr), validator
+    return _to_dict_plans.get(key, lambda: _ToDictPlan(model, deepcopy(attrs), validator))
+
+
 def _crud_read_validator(self, name):
     _crud_perms = getattr(self, '_crud_perms', None)
     if _crud_perms is not None and not _crud_perms.get('read', True):
-        raise ValueError('Attempt to read non-readable model {}'.format(self.__class__.__name__))
+        raise ValueError('Attempt to read non-readable model {}'.format((self if inspect.isclass(self) else self.__class__).__name__))
     elif name in self.extra_defaults:
         return True
     elif _crud_perms is None:
@@ -1881,7 +2766,7 @@ class crud_validation(object):
     Base class for adding validators to a model, supporting adding to the crud
     spec, or to the save action
     """
-    def __init__(self, attribute_name, model_validator, validator_message, **spec_kwargs):
+    def __init__(self, attribute_name, model_validator, validator_message, uses_instance=True, **spec_kwargs):
         """
         @param attribute_name: the name of the attribute to set this validator
             for
@@ -1890,6 +2775,10 @@ class crud_validation(object):
             True if the value is valid. This is used on setting the attribute
             name with the python instance
         @param validator_message: message to print if the model validation fails
+        @param uses_instance: pass False if the model validator only looks at
+            the value and never at the instance, which allows the attribute to
+            be set by bulk crud updates (the validator is then passed None
+            instead of an instance)
         @param spec_kwargs: the key/value pairs that should be added to the
             the crud spec for this attribute name. This generally supports
             making the same sorts of validations in a client (e.g. javascript)
@@ -1897,6 +2786,7 @@ class crud_validation(object):
         self.attribute_name = attribute_name
         self.model_validator = model_validator
         self.validator_message = validator_message
+        self.uses_instance = uses_instance
         self.spec_kwargs = spec_kwargs
 
     def __call__(self, cls):
@@ -1909,6 +2799,7 @@ class crud_validation(object):
         cls._validators.setdefault(self.attribute_name, []).append({
             'model_validator': self.model_validator,
             'validator_message': self.validator_message,
+            'uses_instance': self.uses_instance,
             'spec_kwargs': self.spec_kwargs
         })
         return cls
@@ -1938,7 +2829,7 @@ class text_length_validation(crud_validation):
                 kwargs['maxLengthText'] = max_text
 
         message = 'Length of value should be between {} and {} (inclusive; None means no min/max).'.format(min_length, max_length)
-        crud_validation.__init__(self, attribute_name, model_validator, message, **kwargs)
+        crud_validation.__init__(self, attribute_name, model_validator, message, uses_instance=False, **kwargs)
 
 
 class regex_validation(crud_validation):
@@ -1954,5 +2845,23 @@ class regex_validation(crud_validation):
             # so leverage the fact that failing searches or matches return None types
             return re.search(regex, text) is not None
 
-        crud_validation.__init__(self, attribute_name, regex_validator, message,
+        crud_validation.__init__(self, attribute_name, regex_validator, message, uses_instance=False,
                                        regexText=message, regexString=regex)
+
+
+def crud_cache_stats():
+    """
+    Returns the size, capacity, hits and misses of each of the caches used by
+    the crud services, keyed by the cache's name.
+    """
+    return {
+        'filter_clauses': _filter_clauses.stats,
+        'to_dict_plans': _to_dict_plans.stats,
+        'estimated_totals': _total_cache.stats
+    }
+
+
+@register_diagnostics_status_function
+def crud_caches():
+    return '\n'.join('{}: {}'.format(name, ', '.join('{}={}'.format(k, v) for k, v in sorted(stats.items())))
+                     for name, stats in sorted(crud_cache_stats().items()))
@@ -5,8 +5,8 @@ import pytest
 import cherrypy
 from mock import Mock
 
-from sideboard.lib import services
-from sideboard.tests import service_patcher
+from sideboard.lib import services, threadlocal, _tracing
+from sideboard.tests import service_patcher, config_patcher
 from sideboard.jsonrpc import _make_jsonrpc_handler
 
 
@@ -15,6 +15,12 @@ def precall():
     return Mock()
 
 
+@pytest.fixture(autouse=True)
+def reset_threadlocal():
+    yield
+    threadlocal.reset()
+
+
 @pytest.fixture
 def raw_jsonrpc(service_patcher, precall, monkeypatch):
     service_patcher('test', {'get_message': lambda name: 'Hello {}!'.format(name)})
@@ -81,3 +87,48 @@ def test_invalid_params(raw_jsonrpc):
 
 def test_exception(jsonrpc):
     assert 'unexpected error' in jsonrpc('test.get_message')['error']['message']
+
+
+def test_timeout_sets_deadline(raw_jsonrpc, service_patcher):
+    service_patcher('deadline', {'remaining': threadlocal.time_remaining})
+    response = raw_jsonrpc({'method': 'deadline.remaining', 'params': [], 'timeout': 5})
+    assert 0 < response['result'] <= 5
+
+
+def test_expired_timeout(raw_jsonrpc):
+    response = raw_jsonrpc({'method': 'test.get_message', 'params': ['World'], 'timeout': -1})
+    assert 'deadline exceeded' in response['error']['message']
+
+
+def test_singleflight_config(jsonrpc, config_patcher, monkeypatch):
+    flights = {}
+    monkeypatch.setattr('sideboard.websockets._singleflights', flights)
+    config_patcher(['test.get_message'], 'ws.singleflight')
+    assert jsonrpc('test.get_message', 'World')['result'] == 'Hello World!'
+    assert flights['test.get_message'].calls == 1
+
+
+def test_batch(raw_jsonrpc):
+    response = raw_jsonrpc([
+        {'id': 1, 'method': 'test.get_message', 'params': ['World']},
+        {'id': 2, 'method': 'test.does_not_exist', 'params': []},
+        {'id': 3, 'method': 'test.get_message', 'params': {'name': 'Batch'}}
+    ])
+    assert [r['id'] for r in response] == [1, 2, 3]
+    assert response[0]['result'] == 'Hello World!' and response[2]['result'] == 'Hello Batch!'
+    assert 'no function' in response[1]['error']['message']
+
+
+def test_empty_batch(raw_jsonrpc):
+    assert 'empty' in raw_jsonrpc([])['error']['message']
+
+
+def test_traceparent(raw_jsonrpc, service_patcher, monkeypatch):
+    exporter = _tracing._SpanExporter()
+    monkeypatch.setattr(_tracing, '_exporter', exporter)
+    service_patcher('trace', {'current': _tracing.current_traceparent})
+    response = raw_jsonrpc({'method': 'trace.current', 'params': [],
+                            'traceparent': '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'})
+    span, = exporter.spans
+    assert span['name'] == 'trace.current' and span['parent_id'] == 'b7ad6b7169203331'
+    assert response['result'] == '00-0af7651916cd43dd8448eb211c80319c-{}-01'.format(span['span_id'])
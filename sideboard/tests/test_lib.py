@@ -1,5 +1,6 @@
 from __future__ import unicode_literals
 import json
+import socket
 from time import sleep
 from itertools import count
 from unittest import TestCase
@@ -8,13 +9,17 @@ from collections.abc import Sequence, Set
 from threading import current_thread, Thread
 
 import six
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 import pytest
 import cherrypy
-from mock import Mock
+from mock import Mock, patch
+from rpctools.jsonrpc.exc import Fault, ConnectionError as RpcConnectionError
 
-from sideboard.lib._services import _Services
+from sideboard.lib._services import _Services, _register_rpc_services, _CircuitBreaker, _ResultCache, _ServerProxy, _HttpPool
+from sideboard.lib._websockets import _NoResponse
 from sideboard.websockets import local_broadcast, local_subscriptions, local_broadcaster
-from sideboard.lib import Model, serializer, ajax, is_listy, log, notify, locally_subscribes, cached_property, request_cached_property, threadlocal, register_authenticator, restricted, all_restricted, RWGuard
+from sideboard.lib import Model, serializer, ajax, is_listy, log, notify, locally_subscribes, cached_property, request_cached_property, threadlocal, register_authenticator, restricted, all_restricted, RWGuard, FairQueue, WebSocket, WebSocketPool, ServiceUnavailable, trace_span
 
 
 class TestServices(TestCase):
@@ -48,6 +53,311 @@ class TestServices(TestCase):
             self.services.foo.baz()
 
 
+    def test_register_rpc_services(self):
+        rpc_services = {
+            'foo': ['foo.com'],
+            'bar': ['bar1.com', 'bar2.com'],
+            'baz': ['bar2.com', 'bar1.com'],
+            'bar1.com': {'pool_size': 2}
+        }
+        with patch('sideboard.lib._services.services', self.services):
+            _register_rpc_services(rpc_services)
+        foo, bar, baz = [self.services.get_websocket(name) for name in ['foo', 'bar', 'baz']]
+        assert isinstance(foo, WebSocket) and foo.url == 'ws://foo.com/ws'
+        assert isinstance(bar, WebSocketPool) and bar is not baz
+        assert [ws.url for ws in bar.websockets] == ['ws://bar1.com/ws', 'ws://bar1.com/ws', 'ws://bar2.com/ws']
+        assert bar is self.services._register_pool(['bar1.com', 'bar2.com'], rpc_services)
+
+
+    @patch.dict('sideboard.lib._services._breakers', clear=True)
+    def test_remote_services_use_breakers(self):
+        self.fail_with = OSError()
+        def bar():
+            raise self.fail_with
+        self.bar = bar
+        self.services.register(self, 'foo', _jsonrpc=self)
+        self.services.register(self, 'local')
+        for i in range(10):
+            self.assertRaises(OSError, self.services.foo.bar)
+            self.assertRaises(OSError, self.services.local.bar)
+        self.assertRaises(ServiceUnavailable, self.services.foo.bar)
+        self.assertRaises(ServiceUnavailable, self.services.jsonrpc.foo.bar)
+        self.assertRaises(OSError, self.services.local.bar)
+
+    @patch.dict('sideboard.lib._services._caches', clear=True)
+    @patch.dict('sideboard.lib._services.config', {'rpc_cache': {'foo.bar': {'size': 10, 'ttl': 60, 'subscribe': False}}})
+    def test_remote_services_use_caches(self):
+        self.bar = Mock(side_effect=lambda x: {'x': x})
+        self.baz = Mock(return_value='baz')
+        self.services.register(self, 'foo', _jsonrpc=self)
+        assert self.services.foo.bar(1) == self.services.foo.bar(1) == self.services.jsonrpc.foo.bar(1) == {'x': 1}
+        self.services.foo.bar(2)
+        self.services.foo.baz()
+        self.services.foo.baz()
+        assert self.bar.call_count == 2 and self.baz.call_count == 2
+
+        self.services.foo.bar(1)['x'] = 5
+        assert self.services.foo.bar(1) == {'x': 1}
+
+
+class TestResultCache(TestCase):
+    def setUp(self):
+        self.cache = _ResultCache('foo.bar', size=2, ttl=0.05)
+        self.func = Mock(side_effect=lambda *args, **kwargs: [args, kwargs])
+        self.cached = self.cache.wrap(self.func)
+
+    def test_hits_and_misses(self):
+        self.cached(1)
+        self.cached(1)
+        self.cached(x=1)
+        assert self.func.call_count == 2
+        assert self.cache.stats == {'size': 2, 'hits': 1, 'misses': 2, 'hit_rate': 0.333, 'evictions': 0}
+
+    def test_ttl(self):
+        self.cached(1)
+        sleep(0.06)
+        self.cached(1)
+        assert self.func.call_count == 2
+
+    def test_lru_eviction(self):
+        for arg in [1, 2, 1, 3, 1, 2]:
+            self.cached(arg)
+        assert self.func.call_count == 4
+        assert self.cache.stats['evictions'] == 2
+
+    def test_errors_not_cached(self):
+        self.func.side_effect = OSError
+        self.assertRaises(OSError, self.cached, 1)
+        self.assertRaises(OSError, self.cached, 1)
+        assert self.cache.stats['size'] == 0
+
+    def test_subscription_updates(self):
+        ws = Mock(connected=True)
+        ws.subscribe.return_value = 'client-1'
+        self.cache.subscribe = True
+        cached = self.cache.wrap(self.func, ws)
+        cached(1)
+        request = ws.subscribe.call_args[0][0]
+        sleep(0.06)
+        request['callback']('updated')
+        assert cached(1) == 'updated' and self.func.call_count == 1
+
+        ws.connected = False
+        cached(1)
+        assert self.func.call_count == 2
+        ws.unsubscribe.assert_called_with('client-1')
+
+    def test_unsubscribes_without_holding_lock(self):
+        ws = Mock(connected=True)
+        ws.unsubscribe.side_effect = lambda client: self.assertFalse(self.cache.lock._is_owned())
+        self.cache.subscribe = True
+        cached = self.cache.wrap(self.func, ws)
+        for arg in [1, 2, 3]:
+            cached(arg)
+        ws.connected = False
+        cached(2)
+        self.cache.clear()
+        assert ws.unsubscribe.call_count == 4
+
+    def test_subscription_error_invalidates(self):
+        ws = Mock(connected=True)
+        self.cache.subscribe = True
+        cached = self.cache.wrap(self.func, ws)
+        cached(1)
+        ws.subscribe.call_args[0][0]['errback']('remote error')
+        cached(1)
+        assert self.func.call_count == 2
+
+
+class _JsonrpcHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, request):
+        if request['method'] == 'test.fail':
+            return {'id': request['id'], 'error': {'code': -32603, 'message': 'failed'}}
+        return {'id': request['id'], 'result': request['params']}
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        self.server.requests.append(body)
+        response = json.dumps([self.respond(r) for r in body] if isinstance(body, list) else self.respond(body)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+        self.close_connection = self.server.drop_connections
+
+
+class TestJsonrpcTransport(TestCase):
+    def setUp(self):
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+        self.server = Server(('127.0.0.1', 0), _JsonrpcHandler)
+        self.server.requests, self.server.drop_connections = [], False
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.host = '127.0.0.1:{}'.format(self.server.server_address[1])
+        self.pool = _HttpPool('http', self.host)
+        patcher = patch.dict('sideboard.lib._services._http_pools', {('http', self.host): self.pool})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def proxy(self, **kwargs):
+        return _ServerProxy('http://{}/jsonrpc'.format(self.host), **kwargs)
+
+    def test_connections_reused(self):
+        proxy = self.proxy()
+        assert proxy.test.echo(1) == [1] and self.proxy().test.echo(2) == [2]
+        assert self.pool.stats['created'] == 1 and self.pool.stats['reused'] == 1 and self.pool.stats['idle'] == 1
+        self.assertRaises(Fault, proxy.test.fail)
+        assert self.pool.stats['created'] == 1
+
+    def test_idle_connections_expire(self):
+        with patch.dict('sideboard.lib._services.config', {'jsonrpc.idle_timeout': 0}):
+            self.proxy().test.echo(1)
+            sleep(0.01)
+            self.proxy().test.echo(2)
+        assert self.pool.stats['created'] == 2 and self.pool.stats['expired'] == 1
+
+    def test_traceparent_sent(self):
+        self.proxy().test.echo(1)
+        assert 'traceparent' not in self.server.requests[-1]
+        with trace_span('outer') as outer:
+            self.proxy().test.echo(2)
+        assert self.server.requests[-1]['traceparent'].startswith('00-{}-'.format(outer.trace_id))
+        assert self.server.requests[-1]['traceparent'] != outer.traceparent
+
+    def test_retry_connection_closed_while_idle(self):
+        self.server.drop_connections = True
+        proxy = self.proxy()
+        assert proxy.test.echo(1) == [1]
+        sleep(0.05)
+        assert proxy.test.echo(2) == [2]
+        assert len(self.server.requests) == 2 and self.pool.stats['created'] == 2
+
+    def test_no_retry_after_request_may_have_been_sent(self):
+        self.proxy().test.echo(1)
+        conn = Mock(request=Mock(side_effect=ConnectionResetError()))
+        with patch.object(self.pool, 'acquire', Mock(return_value=(conn, True))):
+            self.assertRaises(RpcConnectionError, self.proxy().test.echo, 2)
+        assert conn.request.call_count == 1
+
+    def test_read_timeout(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)  # accepts connections but never answers
+        self.addCleanup(listener.close)
+        with patch.dict('sideboard.lib._services.config', {'jsonrpc.read_timeout': 0.1}):
+            proxy = _ServerProxy('http://127.0.0.1:{}/jsonrpc'.format(listener.getsockname()[1]))
+            self.assertRaises(RpcConnectionError, proxy.test.echo, 1)
+
+    def test_batching(self):
+        proxy, results = self.proxy(batch_window=0.05), {}
+
+        def call(i):
+            try:
+                results[i] = proxy.test.fail() if i == 3 else proxy.test.echo(i)
+            except Fault as e:
+                results[i] = e
+
+        threads = [Thread(target=call, args=[i]) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(self.server.requests) == 1 and len(self.server.requests[0]) == 4
+        assert [results[i] for i in range(3)] == [[0], [1], [2]]
+        assert isinstance(results[3], Fault)
+        assert self.proxy(batch_window=0.01).test.echo(5) == [5]
+        assert isinstance(self.server.requests[-1], dict)
+
+
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        self.breaker = _CircuitBreaker('foo', window=4, min_calls=4, error_rate=0.5, slow_call=0.05, open_seconds=0.1)
+
+    def call(self, error=None, duration=0):
+        def func():
+            sleep(duration)
+            if error:
+                raise error
+            return 'ok'
+        return self.breaker.wrap(func)()
+
+    def test_opens_on_errors(self):
+        for error in [OSError(), None, _NoResponse(), OSError()]:
+            try:
+                self.call(error)
+            except Exception:
+                pass
+        self.assertEqual('open', self.breaker.state)
+        self.assertRaises(ServiceUnavailable, self.call)
+        self.assertEqual(1, self.breaker.stats['rejected'])
+
+    def test_application_errors_are_not_failures(self):
+        for error in [AssertionError('bad input'), Fault(-32000, 'remote error')] * 2:
+            self.assertRaises(type(error), self.call, error)
+        self.assertEqual('closed', self.breaker.state)
+
+    def test_opens_on_slow_calls(self):
+        for i in range(3):
+            self.call(duration=0.06)
+        self.call()
+        self.assertEqual('open', self.breaker.state)
+
+    def test_half_open(self):
+        self.breaker._open()
+        self.assertRaises(ServiceUnavailable, self.call)
+        sleep(0.1)
+        self.assertRaises(OSError, self.call, OSError())
+        self.assertEqual('open', self.breaker.state)
+        sleep(0.1)
+        self.assertEqual('ok', self.call())
+        self.assertEqual('closed', self.breaker.state)
+
+    def test_half_open_limits_trial_calls(self):
+        self.breaker._open()
+        self.breaker.opened_at -= 1
+        self.breaker.acquire()
+        self.assertRaises(ServiceUnavailable, self.breaker.acquire)
+
+    def test_only_trial_calls_close_half_open_breaker(self):
+        old = self.breaker.acquire()
+        self.breaker._open()
+        self.breaker.opened_at -= 1
+        probe = self.breaker.acquire()
+        self.breaker.release(False, 0, old)
+        self.assertEqual('half_open', self.breaker.state)
+        self.assertEqual(1, self.breaker.probes)
+        self.breaker.release(False, 0, probe)
+        self.assertEqual('closed', self.breaker.state)
+        self.assertEqual(0, self.breaker.probes)
+
+    def test_old_failures_dont_reopen_half_open_breaker(self):
+        old = self.breaker.acquire()
+        self.breaker._open()
+        self.breaker.opened_at -= 1
+        probe = self.breaker.acquire()
+        self.breaker.release(True, 0, old)
+        self.assertEqual('half_open', self.breaker.state)
+        self.breaker.release(True, 0, probe)
+        self.assertEqual('open', self.breaker.state)
+
+    def test_max_concurrent(self):
+        self.breaker.max_concurrent = 1
+        self.breaker.acquire()
+        self.assertRaises(ServiceUnavailable, self.call)
+        self.breaker.release(False, 0)
+        self.assertEqual('ok', self.call())
+
+
 class TestModel(TestCase):
     def assert_model(self, data, unpromoted=None):
         model = Model(data, 'test', unpromoted)
@@ -629,3 +939,41 @@ class TestRWGuard(object):
             assert read[0] and not written[0]
         sleep(0.1)
         assert read[0] and written[0]
+
+
+class TestFairQueue(object):
+    def drain(self, q):
+        return [q.get_nowait() for i in range(q.qsize())]
+
+    def test_fifo_within_flow(self):
+        q = FairQueue()
+        for i in range(3):
+            q.put(i)
+        assert self.drain(q) == [0, 1, 2]
+
+    def test_priority_classes(self):
+        q = FairQueue()
+        q.put('low', priority=2)
+        q.put('high', priority=0)
+        q.put('medium', priority=1)
+        assert self.drain(q) == ['high', 'medium', 'low']
+
+    def test_round_robin_between_flows(self):
+        q = FairQueue()
+        for i in range(3):
+            q.put('a{}'.format(i), flow='a')
+        q.put('b0', flow='b')
+        q.put('c0', flow='c')
+        assert self.drain(q) == ['a0', 'b0', 'c0', 'a1', 'a2']
+
+    def test_weighted_flows(self):
+        q = FairQueue()
+        for i in range(4):
+            q.put('a{}'.format(i), flow='a', weight=2)
+            q.put('b{}'.format(i), flow='b')
+        assert self.drain(q) == ['a0', 'a1', 'b0', 'a2', 'a3', 'b1', 'b2', 'b3']
+
+    def test_maxsize(self):
+        q = FairQueue(1)
+        q.put('a', flow='a')
+        pytest.raises(Exception, q.put, 'b', block=False, flow='b')
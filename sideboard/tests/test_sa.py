@@ -1,9 +1,11 @@
 from __future__ import unicode_literals
+import time
 import uuid
 import shutil
 from datetime import datetime
 
 import pytest
+from mock import Mock
 
 import sqlalchemy
 from sqlalchemy.ext.hybrid import hybrid_property
@@ -13,11 +15,12 @@ from sqlalchemy.types import Boolean, Integer, UnicodeText
 from sqlalchemy.schema import Column, CheckConstraint, ForeignKey, MetaData, Table, UniqueConstraint
 from sqlalchemy.sql import case
 
-from sideboard.lib import log, listify
+from sideboard.lib import log, listify, threadlocal, DeadlineExceeded
 from sideboard.tests import patch_session
+from sideboard.lib.sa import _crud
 from sideboard.lib.sa._crud import normalize_query, collect_ancestor_classes
 from sideboard.lib.sa import check_constraint_naming_convention, crudable, declarative_base, \
-    regex_validation, text_length_validation, CrudException, JSON, SessionManager, UUID
+    crud_validation, regex_validation, text_length_validation, CrudException, JSON, SessionManager, UUID
 
 
 @declarative_base
@@ -150,6 +153,11 @@ class BasicClassMixedIn(CrudableMixin, Base):
     pass
 
 
+class NinjaTag(Tag):
+    """Single-table subclass of a model, which should still be resolvable by name."""
+    __tablename__ = None
+
+
 class Session(SessionManager):
     engine = sqlalchemy.create_engine('sqlite:////tmp/test_sa.db', poolclass=NullPool)
 
@@ -170,6 +178,17 @@ def create(model, **params):
         return item.to_dict()
 
 
+def capture_statements(func, *args, **kwargs):
+    """Calls the function, returning its result and the SQL statements it executed."""
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    sqlalchemy.event.listen(Session.engine, 'before_cursor_execute', listener)
+    try:
+        return func(*args, **kwargs), statements
+    finally:
+        sqlalchemy.event.remove(Session.engine, 'before_cursor_execute', listener)
+
+
 def query_from(obj, attr='id'):
     return {
         '_model': obj['_model'],
@@ -202,6 +221,41 @@ def db(request, init_db):
     return init_db
 
 
+class TestModelResolution(object):
+    @pytest.mark.parametrize('name,model', [
+        ('User', User),
+        ('user', User),
+        ('users', User),
+        ('Users', User),
+        ('Tags', Tag),
+        ('account', Account),
+        ('ninja_tag', NinjaTag),
+        ('NinjaTags', NinjaTag),
+        ('crudable_class', CrudableClass)
+    ])
+    def test_resolve_model(self, name, model):
+        assert Session.resolve_model(name) is model
+        assert Session.resolve_model(model) is model
+
+    def test_unknown_model(self):
+        pytest.raises(ValueError, Session.resolve_model, 'Spaceship')
+
+    def test_all_models_includes_subclasses_of_subclasses(self):
+        assert {User, Tag, NinjaTag}.issubset(Session.all_models())
+
+    def test_index_rebuilt_when_models_change(self):
+        index = Session._model_index()
+        assert Session._model_index() is index
+        sqlalchemy.orm.configure_mappers()
+        assert Session._model_index() is index
+
+        class PirateTag(Tag):
+            __tablename__ = None
+
+        assert Session._model_index() is not index
+        assert Session.resolve_model('pirate_tags') is PirateTag
+
+
 class TestNamingConventions(object):
 
     @pytest.mark.parametrize('sqltext,expected', [
@@ -573,6 +627,230 @@ class TestCrudRead(object):
     def test_handle_bad_query(self):
         pytest.raises(CrudException, Session.crud.read, {'field': 'last_name'})
 
+    def test_total_with_limit(self, db):
+        results = Session.crud.read({'_model': 'Tag'}, order=[{'dir': 'asc', 'fields': ['name']}], limit=2, offset=1)
+        assert results['total'] == 4
+        assert [tag['name'] for tag in results['results']] == ['Male', 'Ninja']
+
+    def test_total_past_last_page(self, db):
+        results = Session.crud.read({'_model': 'Tag'}, limit=2, offset=10)
+        assert results['total'] == 4 and results['results'] == []
+
+    def test_total_suppressed(self, db):
+        results = Session.crud.read({'_model': 'Tag'}, limit=2, total=False)
+        assert results['total'] is None
+        assert len(results['results']) == 2
+
+    def test_total_estimate(self, db):
+        results = Session.crud.read({'_model': 'Tag'}, limit=2, total='estimate')
+        assert results['total'] == 4
+        assert len(results['results']) == 2
+
+    def test_total_estimate_cached_for_unchanged_page(self, db, monkeypatch):
+        estimate_count = Mock(return_value=4)
+        monkeypatch.setattr(_crud, 'estimate_count', estimate_count)
+        for i in range(2):
+            assert Session.crud.read({'_model': 'Tag'}, order=[{'fields': ['name']}], limit=2, total='estimate')['total'] == 4
+        assert estimate_count.call_count == 1
+
+    def test_total_estimate_expires(self, db, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(_crud, 'monotonic', lambda: now[0])
+        monkeypatch.setattr(_crud, '_total_cache', _crud._LRUCache(10, ttl=30))
+        estimate_count = Mock(side_effect=[4, 5])
+        monkeypatch.setattr(_crud, 'estimate_count', estimate_count)
+        read = lambda: Session.crud.read({'_model': 'Tag'}, order=[{'fields': ['name']}], limit=2, total='estimate')['total']
+
+        assert read() == 4
+        now[0] += 29
+        assert read() == 4
+        now[0] += 2
+        assert read() == 5
+        assert estimate_count.call_count == 2
+
+    def test_total_estimate_with_multiple_models(self, db):
+        results = Session.crud.read([{'_model': 'Tag'}, {'_model': 'User'}], limit=3, total='estimate')
+        assert results['total'] == 6
+        assert len(results['results']) == 3
+
+    def test_invalid_total(self):
+        pytest.raises(CrudException, Session.crud.read, {'_model': 'Tag'}, total='approximately')
+
+    def capture_queries(self, *args, **kwargs):
+        return capture_statements(Session.crud.read, *args, **kwargs)
+
+    def count_queries(self, *args, **kwargs):
+        results, statements = self.capture_queries(*args, **kwargs)
+        return results, len(statements)
+
+    def test_relationships_eagerly_loaded(self, db):
+        results, queries = self.count_queries({'_model': 'User'}, {'name': True, 'tags': ['name'], 'employees': {'username': True, 'boss': ['name']}})
+        assert queries == 3  # users, tags, and accounts joined with their bosses
+        assert sorted(tag['name'] for user in results['results'] for tag in user['tags']) == ['Male', 'Male', 'Ninja', 'Pirate']
+        bosses = [account['boss'] and account['boss']['name'] for user in results['results'] for account in user['employees']]
+        assert sorted(bosses, key=str) == ['Howard Hyde', None]
+
+    def test_relationships_eagerly_loaded_with_multiple_models(self, db):
+        results, queries = self.count_queries([{'_model': 'User'}, {'_model': 'Account'}], [{'tags': ['name']}, {'user': ['name']}])
+        assert queries == 4  # the union, users, their tags, and accounts joined with their users
+        assert len(results['results']) == 4
+
+    def test_read_plan(self):
+        assert _crud.read_plan(Account, {'username': True, 'password': False}) == (['id', 'username'], {})
+        assert _crud.read_plan(Account, {'username': True, 'user': ['name']}) == (['id', 'username'], {'user': ['name']})
+        columns, relationships = _crud.read_plan(Account, None)
+        assert columns[0] == 'id' and set(columns) == {'id', 'user_id', 'username', 'password', 'boss_id'} and relationships == {}
+        assert _crud.read_plan(CrudableClass, ['unsettable_property']) is None
+        assert _crud.read_plan(CrudableClass, None) is None  # int_attr and friends aren't columns
+
+    def test_read_plan_with_overridden_serializers(self, db, monkeypatch):
+        monkeypatch.setattr(Boss, 'crud_read', lambda self, attrs=None: {'overridden': self.name})
+        assert _crud.read_plan(Boss, ['name']) is None
+        assert [{'overridden': 'Howard Hyde'}] == Session.crud.read({'_model': 'Boss'}, ['name'])['results']
+
+        monkeypatch.undo()
+        monkeypatch.setattr(Boss, 'to_dict', lambda self, attrs=None, validator=None: {'overridden': self.name})
+        assert _crud.read_plan(Boss, ['name']) is None
+        assert [{'overridden': 'Howard Hyde'}] == Session.crud.read({'_model': 'Boss'}, ['name'])['results']
+
+    def test_read_plan_with_inheritance(self):
+        assert _crud.read_plan(Boss, ['name']) == (['id', 'name'], {})
+        assert _crud.read_plan(Tag, ['name']) is None  # NinjaTag inherits from it
+        assert _crud.read_plan(NinjaTag, ['name']) is None
+
+    def test_plain_columns_read_from_rows(self, db, monkeypatch):
+        expected = Session.crud.read({'_model': 'Account'}, {'username': True, 'user': {'id': True}})
+        loaded = Mock()
+        sqlalchemy.event.listen(Account, 'load', loaded)
+        try:
+            results, statements = self.capture_queries({'_model': 'Account'}, ['username'])
+        finally:
+            sqlalchemy.event.remove(Account, 'load', loaded)
+        assert not loaded.called
+        assert len(statements) == 1 and 'password' not in statements[0]
+        assert sorted(results['results'], key=lambda a: a['username']) == sorted([
+            {'_model': 'Account', 'id': account['id'], 'username': account['username']}
+            for account in expected['results']], key=lambda a: a['username'])
+        assert results['total'] == 2
+
+    def test_plain_columns_read_from_rows_with_limit(self, db):
+        results = Session.crud.read({'_model': 'Tag'}, {'name': True, 'id': False, '_model': False}, order=[{'fields': ['name']}], limit=3)
+        assert results['total'] == 4
+        assert results['results'] == [{'name': 'Male'}, {'name': 'Male'}, {'name': 'Ninja'}]
+
+    def test_only_requested_columns_loaded(self, db):
+        results, statements = self.capture_queries({'_model': 'Account'}, {'username': True, 'user': ['name'], 'boss': ['name']})
+        assert len(statements) == 1 and 'password' not in statements[0]
+        assert sorted(account['user']['name'] for account in results['results']) == ['Hooch', 'Turner']
+
+    def page_through(self, query, data, order, limit):
+        pages, cursor = [], None
+        while True:
+            page = Session.crud.read(query, data, order=order, limit=limit, cursor=cursor)
+            pages.append([item['name'] for item in page['results']])
+            cursor = page['next_cursor']
+            if not cursor:
+                return pages
+
+    def test_cursor_paging(self, db):
+        assert self.page_through({'_model': 'Tag'}, ['name'], [{'fields': ['name']}], 1) == [['Male'], ['Male'], ['Ninja'], ['Pirate'], []]
+        assert self.page_through({'_model': 'Tag'}, ['name'], [{'fields': ['name'], 'dir': 'desc'}], 3) == [['Pirate', 'Ninja', 'Male'], ['Male']]
+
+    def test_cursor_paging_with_instances(self, db):
+        pages = self.page_through({'_model': 'User'}, {'name': True, 'tags': ['name']}, 'name', 1)
+        assert pages == [['Hooch'], ['Turner'], []]
+
+    def test_cursor_paging_with_multiple_models(self, db):
+        pages = self.page_through([{'_model': 'Tag'}, {'_model': 'User'}], ['name'], [{'fields': ['name']}], 4)
+        assert pages == [['Hooch', 'Male', 'Male', 'Ninja'], ['Pirate', 'Turner']]
+
+    def test_cursor_unaffected_by_earlier_inserts(self, db):
+        first = Session.crud.read({'_model': 'Tag'}, ['name'], order='name', limit=2)
+        create('Tag', user_id=db.turner['id'], name='Aardvark')
+        second = Session.crud.read({'_model': 'Tag'}, ['name'], order='name', limit=2, cursor=first['next_cursor'])
+        assert [tag['name'] for tag in second['results']] == ['Ninja', 'Pirate']
+        assert second['total'] == 5
+
+    def test_invalid_cursors(self, db):
+        cursor = Session.crud.read({'_model': 'Tag'}, ['name'], order='name', limit=2)['next_cursor']
+        pytest.raises(CrudException, Session.crud.read, {'_model': 'Tag'}, order='user_id', limit=2, cursor=cursor)
+        pytest.raises(CrudException, Session.crud.read, {'_model': 'Tag'}, order='name', limit=2, cursor='garbage')
+        pytest.raises(CrudException, Session.crud.read, {'_model': 'Tag'}, order='name', limit=2, offset=2, cursor=cursor)
+
+    def test_cursor_encoding(self):
+        values = ['a', 1, None, datetime(2020, 1, 2, 3, 4, 5), datetime(2020, 1, 2).date(), uuid.UUID(int=1)]
+        sort = [[field, 'asc'] for field in 'abcdef']
+        assert _crud.decode_cursor(_crud.encode_cursor(sort, values), sort) == values[:5] + [str(uuid.UUID(int=1))]
+
+    def test_filter_shape(self):
+        shape, values = _crud.filter_shape({'_model': 'Tag', 'or': [
+            {'field': 'name', 'comparison': 'in', 'value': ('Ninja', 'Pirate')},
+            {'field': 'user_id', 'comparison': 'in', 'value': {'_model': 'User', 'field': 'name', 'value': 'Turner'}},
+            {'field': 'name', 'value': None}
+        ]})
+        assert shape == {'_model': 'Tag', 'or': [
+            {'field': 'name', 'comparison': 'in', 'value': {'_param': 0, 'expanding': True}},
+            {'field': 'user_id', 'comparison': 'in', 'value': {'_model': 'User', 'field': 'name', 'value': {'_param': 1, 'expanding': False}}},
+            {'field': 'name', 'value': None}
+        ]}
+        assert values == [['Ninja', 'Pirate'], 'Turner']
+
+    def test_filter_clause_cached_per_shape(self, db, monkeypatch):
+        monkeypatch.setattr(_crud, '_filter_clauses', _crud._LRUCache(10))
+        for name in ['Turner', 'Hooch']:
+            assert [user['name'] for user in Session.crud.read({'_model': 'User', 'field': 'name', 'value': name})['results']] == [name]
+        stats = _crud.crud_cache_stats()['filter_clauses']
+        assert stats['size'] == 1 and stats['misses'] == 1 and stats['hits'] > 0
+
+    @pytest.mark.parametrize('comparison,value,expected', [
+        ('contains', 'inj', ['Ninja']),
+        ('istartswith', 'pIr', ['Pirate']),
+        ('iendswith', 'ALE', ['Male', 'Male']),
+        ('in', ['Ninja', 'Pirate'], ['Ninja', 'Pirate']),
+        ('notin', ['Male'], ['Ninja', 'Pirate']),
+        ('isnotnull', None, ['Male', 'Male', 'Ninja', 'Pirate'])
+    ])
+    def test_parameterized_comparisons(self, db, comparison, value, expected):
+        results = Session.crud.read({'_model': 'Tag', 'field': 'name', 'comparison': comparison, 'value': value}, ['name'], order='name')
+        assert [tag['name'] for tag in results['results']] == expected
+
+    def test_to_dict_plan_compiled_once(self, db, monkeypatch):
+        monkeypatch.setattr(_crud, '_to_dict_plans', _crud._LRUCache(10))
+        results = Session.crud.read({'_model': 'User'}, {'name': True, 'tags': ['name']})
+        assert len(results['results']) == 2
+        assert _crud._to_dict_plans.stats == {'size': 2, 'max_size': 10, 'hits': 0, 'misses': 2}  # users and their tags
+
+        Session.crud.read({'_model': 'User'}, {'tags': ['name'], 'name': True})
+        assert _crud._to_dict_plans.stats['hits'] == 1
+
+    def test_to_dict_plan_respects_overridden_to_dict(self, db, monkeypatch):
+        monkeypatch.setattr(Tag, 'to_dict', lambda self, attrs=None, validator=None: {'overridden': self.name})
+        results = Session.crud.read(query_from(db.turner), {'tags': ['name']})
+        assert sorted(tag['overridden'] for tag in results['results'][0]['tags']) == ['Male', 'Ninja']
+
+    def test_to_dict_validates_each_instance(self, db):
+        with Session() as session:
+            users = session.query(User).order_by(User.name).all()
+            validator = lambda self, name: name != 'name' or self.name == 'Turner'
+            assert [{'_model': 'User', 'id': user.id, 'name': 'Turner'} if user.name == 'Turner' else {'_model': 'User', 'id': user.id}
+                    for user in users] == [user.to_dict(['name'], validator) for user in users]
+
+    def test_loader_strategy_override(self, db, monkeypatch):
+        assert self.count_queries({'_model': 'Account'}, {'user': ['name']})[1] == 1
+
+        monkeypatch.setattr(Account, 'loader_strategies', {'user': 'lazy'})
+        assert self.count_queries({'_model': 'Account'}, {'user': ['name']})[1] == 3
+
+        monkeypatch.setattr(Account, 'loader_strategies', {'user': 'sometimes'})
+        pytest.raises(CrudException, Session.crud.read, {'_model': 'Account'}, {'user': ['name']})
+
+    def test_total_with_joined_collection(self, db, monkeypatch):
+        monkeypatch.setattr(User, 'loader_strategies', {'tags': 'joined'})
+        # with no limit or offset SQLAlchemy doesn't wrap the users in a subquery
+        # before joining their tags, so a window count would count the tags
+        results = Session.crud.read({'_model': 'User'}, {'tags': ['name']}, offset=None)
+        assert results['total'] == len(results['results']) == 2
+
     def test_handle_illegal_read(self, db):
         results = Session.crud.read(query_from(db.turner), {'__repr__': True})
         assert '__repr__' not in results['results'][0]
@@ -674,6 +952,57 @@ class TestCrudUpdate(object):
     def test_update_nonupdatable_attribute(self, db):
         pytest.raises(Exception, Session.crud.update, query_from(db.turner_account), {'username': 'foo'})
 
+    def test_bulk_update_refuses_instance_dependent_validators(self, db, monkeypatch):
+        monkeypatch.setattr(Account, '_validators', Account._validators)
+        crud_validation('password', lambda self, password: password != self.username, 'Passwords may not match usernames')(Account)
+
+        pytest.raises(CrudException, Session.crud.update, {'_model': 'Account'}, {'password': 'foo'}, bulk=True)
+        pytest.raises(CrudException, Session.crud.update, {'_model': 'Account'}, {'password': 'turner_account'})
+        Session.crud.update({'_model': 'Account'}, {'password': 'foo'})
+        with Session() as session:
+            assert {'foo'} == {account.password for account in session.query(Account)}
+
+    @pytest.mark.parametrize('existing, new', [(2, 3), (20, 10)])
+    def test_merging_relations_prefetches_children(self, db, existing, new):
+        Session.crud.update(query_from(db.turner), {'tags': [{'name': 'Tag {}'.format(i)} for i in range(existing)]})
+        with Session() as session:
+            tags = [{'id': tag.id, 'name': tag.name} for tag in session.user('Turner').tags]
+        tags += [{'name': 'Tag {}'.format(i)} for i in range(existing, existing + new)]
+
+        result, statements = capture_statements(Session.crud.update, query_from(db.turner), {'tags': tags})
+        selects = [statement for statement in statements if statement.startswith('SELECT')]
+        # the user, its current tags, then one query for the tags passed by id and one for those matched by (user_id, name)
+        assert len(selects) == 4
+        assert 'tag.id IN' in selects[2] and '(tag.user_id, tag.name) IN' in selects[3]
+        with Session() as session:
+            assert {'Tag {}'.format(i) for i in range(existing + new)} == {tag.name for tag in session.user('Turner').tags}
+
+    def test_merging_relations_by_unique_constraint(self, db):
+        Session.crud.update(query_from(db.turner), {'tags': [{'name': 'Male'}, {'name': 'New'}]})
+        with Session() as session:
+            assert {'Male', 'New'} == {tag.name for tag in session.user('Turner').tags}
+            assert 1 == session.query(Tag).filter_by(name='Male', user_id=db.turner['id']).count()
+
+    def test_bulk_update(self, db):
+        updated = Session.crud.update({'_model': 'Account'}, {'password': 'bulk'}, bulk=True)
+        assert {db.turner_account['id'], db.hooch_account['id']} == set(map(str, updated))
+        with Session() as session:
+            assert {'bulk'} == {account.password for account in session.query(Account)}
+
+    def test_bulk_update_with_filter(self, db):
+        updated = Session.crud.update({'_model': 'Account', 'field': 'username', 'value': 'turner_account'}, {'password': 'bulk'}, bulk=True)
+        assert [db.turner_account['id']] == list(map(str, updated))
+        with Session() as session:
+            assert 'bulk' == session.account('turner_account').password
+            assert 'password' == session.account('hooch_account').password
+
+    def test_bulk_update_checks_permissions_and_validators(self, db):
+        pytest.raises(CrudException, Session.crud.update, {'_model': 'Account'}, {'username': 'foo'}, bulk=True)
+        pytest.raises(CrudException, Session.crud.update, {'_model': 'User'}, {'name': 'x' * 101}, bulk=True)
+        pytest.raises(CrudException, Session.crud.update, {'_model': 'User'}, {'tags': []}, bulk=True)
+        with Session() as session:
+            assert 'Turner' == session.user('Turner').name
+
 
 class TestCrudDelete(object):
     def test_delete_cascades_to_tags(self, db):
@@ -709,6 +1038,16 @@ class TestCrudDelete(object):
         pytest.raises(CrudException, Session.crud.delete, {'_model': 'Account'})
         pytest.raises(CrudException, Session.crud.delete, {'_model': 'Tag', 'field': 'name', 'value': 'Male'})
 
+    def test_bulk_delete(self, db):
+        deleted = Session.crud.delete({'_model': 'Tag', 'field': 'name', 'value': 'Male'}, bulk=True)
+        assert 2 == len(deleted)
+        with Session() as session:
+            assert ['Ninja', 'Pirate'] == sorted(tag.name for tag in session.query(Tag))
+            assert not session.query(Tag).filter(Tag.id.in_(deleted)).count()
+
+    def test_bulk_delete_without_results(self):
+        assert [] == Session.crud.delete({'_model': 'Tag', 'field': 'name', 'value': 'does_not_exist'}, bulk=True)
+
 
 class TestCrudCreate(object):
     def test_basic_create(self, db):
@@ -767,6 +1106,62 @@ class TestCrudCreate(object):
         with Session() as session:
             assert 2 == len(session.user('Turner').employees)
 
+    def test_bulk_create_single_insert(self):
+        created, statements = capture_statements(Session.crud.create, [{'_model': 'Boss', 'name': 'Boss {}'.format(i)} for i in range(10)])
+        assert 1 == len([statement for statement in statements if statement.startswith('INSERT')])
+        assert ['Boss {}'.format(i) for i in range(10)] == [boss['name'] for boss in created]
+        with Session() as session:
+            assert {boss['id'] for boss in created} == {boss.id for boss in session.query(Boss).filter(Boss.name.like('Boss %'))}
+
+    def test_bulk_create_skipped_for_overridden_crud_create(self, db, monkeypatch):
+        def crud_create(self, **kwargs):
+            _crud.CrudMixin.crud_create(self, **kwargs)
+            self.user = Session.resolve_model('User')(name='Created ' + self.name)
+            return self
+        monkeypatch.setattr(Tag, 'crud_create', crud_create)
+
+        created = Session.crud.create([{'_model': 'Tag', 'name': 'First'}, {'_model': 'Tag', 'name': 'Second'}])
+        assert ['First', 'Second'] == [tag['name'] for tag in created]
+        with Session() as session:
+            assert ['First'] == [tag.name for tag in session.user('Created First').tags]
+            assert ['Second'] == [tag.name for tag in session.user('Created Second').tags]
+
+    def test_bulk_create_validates(self):
+        pytest.raises(CrudException, Session.crud.create, [{'_model': 'User', 'name': 'Valid'}, {'_model': 'User', 'name': 'x' * 101}])
+        with Session() as session:
+            assert 0 == session.query(User).filter_by(name='Valid').count()
+
+    def test_create_without_returning(self, db):
+        created, statements = capture_statements(Session.crud.create, [{'_model': 'Tag', 'name': 'Tag {}'.format(i), 'user_id': db.turner['id']} for i in range(5)], returning=False)
+        assert created is True
+        assert not [statement for statement in statements if statement.startswith('SELECT')]
+        with Session() as session:
+            assert 7 == len(session.user('Turner').tags)
+
+    def test_create_preserves_order_across_bulk_and_orm_items(self, db):
+        created = Session.crud.create([
+            {'_model': 'Boss', 'name': 'First'},
+            {'_model': 'User', 'name': 'Second', 'tags': [{'name': 'Nested'}]},
+            {'_model': 'Boss', 'name': 'Third'},
+        ])
+        assert ['First', 'Second', 'Third'] == [item['name'] for item in created]
+        with Session() as session:
+            assert ['Nested'] == [tag.name for tag in session.user('Second').tags]
+
+    def test_upsert(self, db):
+        created = Session.crud.create([
+            {'_model': 'Account', 'username': 'turner_account', 'password': 'changed', 'user_id': db.turner['id']},
+            {'_model': 'Account', 'username': 'upserted', 'password': 'new', 'user_id': db.hooch['id']},
+        ], upsert=['username'])
+        assert db.turner_account['id'] == created[0]['id']
+        with Session() as session:
+            assert 'changed' == session.account('turner_account').password
+            assert 'new' == session.account('upserted').password
+            assert 3 == session.query(Account).count()
+
+    def test_upsert_requires_plain_columns(self, db):
+        pytest.raises(CrudException, Session.crud.create, {'_model': 'User', 'name': 'New', 'tags': [{'name': 'Nope'}]}, upsert=['name'])
+
 
 class TestCrudValidations(object):
     def test_length(self):
@@ -1079,3 +1474,15 @@ def test_get_models():
     assert_models(['User'], [{'_model': 'User'}])
     assert_models(['User'], ({'_model': 'User'},))
     assert_models(['User'], {'foo': {'_model': 'User'}})
+
+
+def test_session_deadline(request):
+    request.addfinalizer(threadlocal.reset)
+    threadlocal.reset(deadline=time.time() - 1)
+    with pytest.raises(DeadlineExceeded):
+        with Session() as session:
+            session.query(User).all()
+
+    threadlocal.reset(deadline=time.time() + 10)
+    with Session() as session:
+        assert session.query(User).count() == 2
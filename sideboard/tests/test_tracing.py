@@ -0,0 +1,104 @@
+from __future__ import unicode_literals
+import json
+
+import pytest
+
+from sideboard.lib import threadlocal, trace_span, TraceViewer
+from sideboard.lib import _tracing
+from sideboard.tests import config_patcher
+
+TRACEPARENT = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'
+
+
+@pytest.fixture(autouse=True)
+def exporter(monkeypatch):
+    exporter = _tracing._SpanExporter()
+    monkeypatch.setattr(_tracing, '_exporter', exporter)
+    yield exporter
+    exporter.close()
+    threadlocal.reset()
+
+
+def test_parse_traceparent():
+    assert _tracing.parse_traceparent(TRACEPARENT) == ('0af7651916cd43dd8448eb211c80319c', 'b7ad6b7169203331')
+    for invalid in [None, '', 'garbage', '00-xyz-b7ad6b7169203331-01', '00-0af7651916cd43dd8448eb211c80319c-b7ad-01']:
+        assert _tracing.parse_traceparent(invalid) == (None, None)
+
+
+def test_nested_spans(exporter):
+    with trace_span('outer') as outer:
+        with trace_span('inner') as inner:
+            assert _tracing.current_traceparent() == inner.traceparent
+        assert _tracing.current_traceparent() == outer.traceparent
+    assert _tracing.current_traceparent() is None
+
+    assert [span['name'] for span in exporter.spans] == ['inner', 'outer']
+    assert inner.trace_id == outer.trace_id and inner.parent_id == outer.span_id and outer.parent_id is None
+    assert all(span['duration'] >= 0 for span in exporter.spans)
+
+
+def test_span_error(exporter):
+    with pytest.raises(ValueError):
+        with trace_span('failing'):
+            raise ValueError('bad value')
+    assert exporter.spans[0]['error'] == 'ValueError: bad value'
+
+
+def test_server_span_continues_trace():
+    with trace_span('unrelated'):
+        with trace_span('handler', kind='server', traceparent=TRACEPARENT) as span:
+            assert span.trace_id == '0af7651916cd43dd8448eb211c80319c' and span.parent_id == 'b7ad6b7169203331'
+        with trace_span('handler', kind='server', traceparent='garbage') as span:
+            assert span.parent_id is None and span.trace_id != '0af7651916cd43dd8448eb211c80319c'
+
+
+def test_client_span_requires_trace(exporter):
+    with trace_span('remote.call', kind='client') as span:
+        assert span is None
+    with trace_span('outer'):
+        with trace_span('remote.call', kind='client', finish=False) as span:
+            assert span
+    assert [span['name'] for span in exporter.spans] == ['outer']
+    span.finish()
+    assert len(exporter.spans) == 2
+
+
+def test_tracing_disabled(exporter, config_patcher):
+    config_patcher(False, 'tracing.enabled')
+    with trace_span('outer') as span:
+        assert span is None and _tracing.current_traceparent() is None
+    assert not exporter.spans
+
+
+def test_ring_buffer(exporter, config_patcher):
+    config_patcher(3, 'tracing.buffer_size')
+    for i in range(5):
+        with trace_span('span{}'.format(i)):
+            pass
+    assert [span['name'] for span in exporter.spans] == ['span2', 'span3', 'span4']
+
+
+def test_ndjson_export(exporter, config_patcher, tmpdir):
+    path = str(tmpdir.join('spans.ndjson'))
+    config_patcher(path, 'tracing.ndjson_path')
+    with trace_span('outer'):
+        with trace_span('inner'):
+            pass
+    exporter.close()
+    with open(path) as f:
+        assert [json.loads(line)['name'] for line in f] == ['inner', 'outer']
+
+
+def test_trace_viewer(exporter):
+    with trace_span('first') as first:
+        with trace_span('child'):
+            pass
+    with trace_span('second'):
+        pass
+
+    traces = json.loads(TraceViewer().index())
+    assert [trace['spans'][0]['name'] for trace in traces] == ['second', 'first']
+    assert [span['name'] for span in traces[1]['spans']] == ['first', 'child']
+
+    traces = json.loads(TraceViewer().index(trace_id=first.trace_id))
+    assert len(traces) == 1 and len(traces[0]['spans']) == 2
@@ -1,12 +1,20 @@
 from __future__ import unicode_literals
+import time
+import asyncio
+import threading
+from threading import Thread
+from itertools import count
+from concurrent.futures import Future
+from datetime import datetime, timedelta
 
 import pytest
 from mock import Mock, ANY
 
 import ws4py.websocket
 
+from sideboard.lib import _websockets, _tracing, trace_span
 from sideboard.websockets import WebSocketDispatcher
-from sideboard.lib import log, WebSocket, threadlocal, stopped
+from sideboard.lib import log, WebSocket, AsyncWebSocket, WebSocketPool, MultiSubscription, threadlocal, stopped, DeadlineExceeded
 from sideboard.tests import config_patcher
 
 
@@ -15,6 +23,18 @@ def reset_stopped():
     stopped.clear()
 
 
+@pytest.fixture(autouse=True)
+def reset_threadlocal():
+    yield
+    threadlocal.reset()
+
+
+@pytest.fixture(autouse=True)
+def reset_shared_subscriptions():
+    yield
+    _websockets._SharedSubscription._registry.clear()
+
+
 @pytest.fixture
 def ws(monkeypatch):
     ws = WebSocket(connect_immediately=False)
@@ -40,7 +60,8 @@ def test_subscribe_basic(ws):
         'client': 'xxx',
         'callback': callback,
         'method': 'foo.bar',
-        'params': ('x', 'y')
+        'params': ('x', 'y'),
+        'last_used': ANY
     }
     ws._send.assert_called_with(method='foo.bar', params=('x', 'y'), client='xxx')
     assert not log.warning.called
@@ -59,7 +80,8 @@ def test_subscribe_advanced(ws):
         'callback': callback,
         'errback': errback,
         'method': 'foo.bar',
-        'params': ('x', 'y')
+        'params': ('x', 'y'),
+        'last_used': ANY
     }
     ws._send.assert_called_with(method='foo.bar', params=('x', 'y'), client='yyy')
     assert not log.warning.called
@@ -88,7 +110,8 @@ def test_subscribe_paramback(ws):
         'errback': errback,
         'paramback': paramback,
         'method': 'foo.bar',
-        'params': (5, 6)
+        'params': (5, 6),
+        'last_used': ANY
     }
     ws._send.assert_called_with(method='foo.bar', params=(5, 6), client='yyy')
     assert not log.warning.called
@@ -129,12 +152,287 @@ def test_call_error(errorer):
     assert 'xxx' not in errorer._callbacks
 
 
-def test_call_timeout(ws, config_patcher, monkeypatch):
-    monkeypatch.setattr(stopped, 'is_set', Mock(return_value=False))
-    config_patcher(1, 'ws.call_timeout')
-    pytest.raises(Exception, ws.call, 'foo.bar')
+def test_call_timeout(ws, config_patcher):
+    config_patcher(0.2, 'ws.call_timeout')
+    before = time.time()
+    pytest.raises(AssertionError, ws.call, 'foo.bar')
     assert 'xxx' not in ws._callbacks
-    assert 9 <= stopped.is_set.call_count <= 11
+    assert 0.2 <= time.time() - before < 1
+
+
+@pytest.fixture
+def async_ws(ws):
+    ws._next_id = Mock(side_effect=['callback-{}'.format(i) for i in range(100)])
+    return ws
+
+
+def test_call_async_out_of_order(async_ws):
+    futures = [async_ws.call_async('foo.bar', i) for i in range(3)]
+    assert not any(future.done() for future in futures)
+    for i in [2, 0, 1]:
+        async_ws._dispatch({'callback': 'callback-{}'.format(i), 'data': i * 10})
+    assert [future.result(0) for future in futures] == [0, 10, 20]
+    assert not async_ws._callbacks
+
+
+def test_call_async_error(async_ws):
+    future = async_ws.call_async('foo.bar')
+    async_ws._dispatch({'callback': 'callback-0', 'error': 'fail'})
+    pytest.raises(AssertionError, future.result, 0)
+
+
+def test_call_async_late_response(async_ws, config_patcher, monkeypatch):
+    config_patcher(0.1, 'ws.call_timeout')
+    monkeypatch.setattr(async_ws, 'fallback', Mock())
+    future = async_ws.call_async('foo.bar')
+    pytest.raises(AssertionError, future.result, 1)
+    async_ws._dispatch({'callback': 'callback-0', 'data': 'late'})
+    assert async_ws.fallback.called
+
+
+def test_close_fails_pending_calls(async_ws):
+    future = async_ws.call_async('foo.bar')
+    async_ws.close()
+    pytest.raises(AssertionError, future.result, 0)
+    assert not async_ws._callbacks
+
+
+def test_async_websocket_call(async_ws):
+    aws = AsyncWebSocket(websocket=async_ws)
+
+    async def call_all():
+        tasks = [asyncio.ensure_future(aws.call('foo.bar', i)) for i in range(3)]
+        await asyncio.sleep(0)
+        for i in range(3):
+            async_ws._dispatch({'callback': 'callback-{}'.format(i), 'data': i})
+        return await asyncio.gather(*tasks)
+
+    assert asyncio.run(call_all()) == [0, 1, 2]
+
+
+def test_async_websocket_subscribe(ws):
+    aws, received = AsyncWebSocket(websocket=ws), []
+
+    async def callback(data):
+        received.append(data)
+
+    async def subscribe():
+        assert 'xxx' == aws.subscribe(callback, 'foo.bar')
+        Thread(target=ws._dispatch, args=[{'client': 'xxx', 'data': 5}]).start()
+        while not received:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(asyncio.wait_for(subscribe(), 1))
+    assert received == [5]
+
+
+def test_async_websocket_subscribe_requires_running_loop(ws):
+    pytest.raises(RuntimeError, AsyncWebSocket(websocket=ws).subscribe, Mock(), 'foo.bar')
+    assert not ws._callbacks
+
+
+def test_no_threads_per_instance():
+    before = threading.active_count()
+    websockets = [WebSocket(connect_immediately=False) for i in range(10)]
+    assert threading.active_count() == before
+
+
+def test_dispatch_sharded_by_websocket(monkeypatch):
+    dispatchers = [Mock() for i in range(4)]
+    monkeypatch.setattr(_websockets._reactor, 'dispatchers', dispatchers)
+    websockets = [WebSocket(connect_immediately=False) for i in range(8)]
+    for i in range(3):
+        for ws in websockets:
+            ws._dispatcher.defer({'client': 'xxx'})
+    for ws in websockets:
+        dispatcher = dispatchers[hash(ws) % 4]
+        assert dispatcher.defer.call_args_list.count(((ws._dispatch, {'client': 'xxx'}),)) == 3
+
+
+def test_disconnect_wakes_checker(ws, monkeypatch):
+    monkeypatch.setattr(ws._checker, 'wake', Mock())
+    client = ws.WebSocketDispatcher(ws._dispatcher, ws.url)
+    client.connected = True
+    client.closed(1006, 'Going away')
+    assert not client.connected
+    assert ws._checker.wake.called
+
+
+def test_next_check(ws, monkeypatch, config_patcher):
+    config_patcher(0, 'ws.ping_interval')
+    config_patcher(300, 'ws.poll_interval')
+    monkeypatch.setattr(WebSocket, 'connected', True)
+    ws._last_poll = datetime.now() - timedelta(seconds=100)
+    assert 199 < ws._next_check <= 200
+
+    monkeypatch.setattr(WebSocket, 'connected', False)
+    ws._next_reconnect = time.time() + 8
+    assert 7 < ws._next_check <= 8
+
+
+def test_reconnect_jitter(ws, monkeypatch, config_patcher):
+    config_patcher(60, 'ws.reconnect_interval')
+    monkeypatch.setattr(WebSocket, 'connected', False)
+    monkeypatch.setattr(_websockets.random, 'uniform', Mock(side_effect=lambda low, high: high / 2))
+    assert ws._should_reconnect
+
+    ws._schedule_reconnect()
+    _websockets.random.uniform.assert_called_with(0, 1)
+    assert not ws._should_reconnect and 0 < ws._next_check <= 0.5
+
+    ws._schedule_reconnect()  # disconnecting again doesn't push back the attempt we already have planned
+    assert _websockets.random.uniform.call_count == 1
+
+    ws._reconnect_attempts = 10
+    ws._schedule_reconnect()
+    _websockets.random.uniform.assert_called_with(0, 60)
+    assert 29 < ws._next_check <= 30
+
+    ws._next_reconnect = time.time() - 1
+    assert ws._should_reconnect
+
+
+def test_reconnect_failure_backs_off(ws, monkeypatch):
+    monkeypatch.setattr(WebSocket, 'connected', False)
+    monkeypatch.setattr(ws, 'WebSocketDispatcher', Mock(side_effect=Exception('refused')))
+    ws._reconnect()
+    assert ws._reconnect_attempts == 1 and ws.reconnect_failures == 1
+    assert ws._next_reconnect and not ws._should_reconnect
+    assert ws.reconnect_stats['failed_attempts'] == 1
+
+
+def test_ping_instead_of_poll(ws, monkeypatch, config_patcher):
+    config_patcher(5, 'ws.ping_interval')
+    monkeypatch.setattr(WebSocket, 'connected', True)
+    ws.ws = Mock()
+    assert ws._should_ping and not ws._should_poll
+    ws._check()
+    ws.ws.ping.assert_called_with('0')
+    assert not ws._should_ping and 4 < ws._next_check <= 5
+
+    ws._dispatcher.ponged(b'0')
+    assert ws._liveness.missed == 0 and ws.rtt.count == 1
+
+
+def test_latency_measures_pings_and_polls_not_calls(ws):
+    future = ws.call_async('foo.bar')
+    ws._callbacks['xxx']['sent'] -= 10
+    ws._callbacks['xxx']['callback']('result')
+    assert future.result() == 'result' and ws.latency is None
+
+    ws._liveness.outstanding['0'] = time.time() - 2
+    ws._dispatcher.ponged(b'0')
+    assert 1.9 < ws.latency < 2.1
+
+    ws.ws = Mock(connected=True)
+    ws.call_async = Mock(return_value=Future())
+    ws._poll()
+    ws.call_async.return_value.set_result(None)
+    assert ws.latency < 1.7
+
+
+def test_unanswered_pings_close_connection(ws, monkeypatch, config_patcher):
+    config_patcher(2, 'ws.ping_misses')
+    monkeypatch.setattr(WebSocket, 'connected', True)
+    ws.ws = Mock()
+    ws._ping()
+    ws._ping()
+    assert ws.ws.ping.call_count == 2 and not ws.ws.close.called
+    ws._ping()
+    assert ws.ws.ping.call_count == 2 and ws.ws.close.called
+
+
+def test_pong_answers_earlier_pings():
+    liveness = _websockets._Liveness()
+    first, second = liveness.ping(), liveness.ping()
+    liveness.ponged('bogus')
+    assert liveness.missed == 2
+    liveness.ponged(second)
+    assert liveness.missed == 0 and liveness.rtt.count == 1
+
+
+def test_rtt_histogram():
+    rtt = _websockets._RttHistogram()
+    assert rtt.percentile(50) is None
+    for ms in [0.5] * 90 + [30] * 9 + [20000]:
+        rtt.add(ms / 1000.0)
+    assert rtt.percentile(50) == 1
+    assert rtt.percentile(95) == 50
+    assert rtt.percentile(100) == 20000
+    assert rtt.stats['count'] == 100
+
+    merged = _websockets._RttHistogram().merge(rtt).merge(rtt)
+    assert merged.count == 200 and merged.percentile(50) == 1
+
+
+def test_poll_failure_closes_connection(ws):
+    future = Future()
+    ws.ws = Mock(connected=True)
+    ws.call_async = Mock(return_value=future)
+    ws._poll()
+    assert ws._last_poll and not ws.ws.close.called
+    future.set_exception(AssertionError('no response'))
+    assert ws.ws.close.called
+
+
+@pytest.fixture
+def pool():
+    members = [Mock(url='ws://host{}/ws'.format(i), connected=True, latency=None) for i in range(3)]
+    for member in members:
+        member.futures = []
+        member.call_async.side_effect = lambda *args, member=member, **kwargs: member.futures.append(Future()) or member.futures[-1]
+    return WebSocketPool(members)
+
+
+def test_pool_least_outstanding(pool):
+    for i in range(3):
+        pool.call_async('foo.bar')
+    assert all(ws.call_async.call_count == 1 for ws in pool.websockets)
+    pool.websockets[1].futures[0].set_result(None)
+    pool.call_async('foo.bar')
+    assert [ws.call_async.call_count for ws in pool.websockets] == [1, 2, 1]
+
+
+def test_pool_round_robin(pool):
+    pool.balance = 'round_robin'
+    for future in [pool.call_async('foo.bar') for i in range(6)]:
+        future.set_result(None)
+    assert all(ws.call_async.call_count == 2 for ws in pool.websockets)
+
+
+def test_pool_skips_unhealthy(pool):
+    pool.websockets[0].connected = False
+    pool.websockets[1].latency = 10
+    pool._check()
+    for i in range(4):
+        pool.call_async('foo.bar').set_result(None)
+    assert [ws.call_async.call_count for ws in pool.websockets] == [0, 0, 4]
+    assert pool.stats[1]['ejected'] and not pool.stats[2]['ejected']
+
+
+def test_pool_ejects_after_errors_and_moves_subscriptions(pool, config_patcher):
+    config_patcher(2, 'ws.pool_eject_errors')
+    callback = Mock()
+    client = pool.subscribe(callback, 'foo.bar', 5)
+    src = [ws for ws in pool.websockets if ws.subscribe.called][0]
+    src.subscribe.assert_called_with({'client': client, 'callback': callback}, 'foo.bar', 5)
+    choose, member = pool._choose, pool._members[pool.websockets.index(src)]
+    pool._choose = lambda exclude=None: choose(exclude) if exclude else member
+    for i in range(2):
+        pool.call_async('foo.bar').set_exception(_websockets._NoResponse('no response'))
+    src.unsubscribe.assert_called_with(client)
+    [dest] = [ws for ws in pool.websockets if ws is not src and ws.subscribe.called]
+    dest.subscribe.assert_called_with({'client': client, 'callback': callback}, 'foo.bar', 5)
+
+    pool.unsubscribe(client)
+    dest.unsubscribe.assert_called_with(client)
+    assert not pool._subscriptions
+
+
+def test_pool_error_responses_are_not_failures(pool, config_patcher):
+    config_patcher(1, 'ws.pool_eject_errors')
+    pool.call_async('foo.bar').set_exception(AssertionError('remote error'))
+    assert not any(member['ejected'] for member in pool.stats)
 
 
 def test_call_stopped_set(ws, request, monkeypatch):
@@ -166,6 +464,31 @@ def test_refire_error(refirer):
     assert refirer._send.call_count == 1
 
 
+def test_refire_most_recent_first(refirer):
+    refirer._callbacks['zzz']['last_used'] = time.time()
+    refirer._callbacks['xxx']['last_used'] = time.time() - 10
+    refirer._refire_subscriptions()
+    assert [c[1]['client'] for c in refirer._send.call_args_list] == ['zzz', 'xxx']
+    assert refirer.resubscribed == 2
+
+
+def test_refire_rate_limited(refirer, monkeypatch, config_patcher):
+    config_patcher(1, 'ws.resubscribe_rate')
+    monkeypatch.setattr(_websockets._scheduler, 'schedule', Mock())
+    refirer.ws = Mock()
+    refirer._refire_subscriptions()
+    assert refirer._send.call_count == 1 and refirer.resubscribes_pending == 1
+    delay, defer, func, ws, clients = _websockets._scheduler.schedule.call_args[0]
+    assert delay == 1 and func == refirer._refire_batch
+
+    func(ws, clients)
+    assert refirer._send.call_count == 2 and refirer.resubscribes_pending == 0
+
+    refirer.ws = Mock()  # we've reconnected again since then, so the old batch is obsolete
+    func(ws, clients)
+    assert refirer._send.call_count == 2
+
+
 def test_make_method_caller(ws):
     ws.call = Mock()
     func = ws.make_caller('foo.bar')
@@ -191,14 +514,111 @@ def test_make_subscription_unsubscribe(ws, orig_ws):
     ws.unsubscribe = Mock()
     ws._next_id = Mock(return_value='xxx')
     threadlocal.reset(message={'client': 'yyy'}, websocket=orig_ws)
-    ws.make_caller('foo.bar').unsubscribe()
+    func = ws.make_caller('foo.bar')
+    func.unsubscribe()
+    assert not ws.unsubscribe.called
+    func(1, 2)
+    func.unsubscribe()
     ws.unsubscribe.assert_called_with('xxx')
 
 
+@pytest.fixture
+def passthru(ws, orig_ws):
+    ids = count(1)
+    ws._next_id = lambda prefix: 'upstream-{}'.format(next(ids))
+    orig_ws.send = Mock()
+
+    def subscribe(client, *args):
+        threadlocal.reset(message={'client': client}, websocket=orig_ws)
+        func = ws.make_caller('foo.bar')
+        func(*args)
+        return func
+    return subscribe
+
+
+def test_passthru_subscriptions_shared(ws, orig_ws, passthru):
+    first, second = passthru('client-1', 1, 2), passthru('client-2', 1, 2)
+    assert ws._send.call_count == 1
+    assert first.dst_client == second.dst_client == 'upstream-1'
+
+    ws._callbacks['upstream-1']['callback']('data')
+    orig_ws.send.assert_any_call(data='data', client='client-1')
+    orig_ws.send.assert_any_call(data='data', client='client-2')
+
+
+def test_passthru_subscriptions_by_params(ws, passthru):
+    first, second = passthru('client-1', 1, 2), passthru('client-2', 3, 4)
+    assert ws._send.call_count == 2
+    assert first.dst_client != second.dst_client
+
+
+def test_passthru_late_subscriber_gets_latest(ws, orig_ws, passthru):
+    passthru('client-1', 1, 2)
+    ws._callbacks['upstream-1']['callback']('data')
+    passthru('client-2', 1, 2)
+    orig_ws.send.assert_called_with(data='data', client='client-2')
+    assert ws._send.call_count == 1
+
+
+def test_passthru_unsubscribe_refcounted(ws, passthru):
+    ws.unsubscribe = Mock()
+    first, second = passthru('client-1', 1, 2), passthru('client-2', 1, 2)
+    first.unsubscribe()
+    assert not ws.unsubscribe.called
+    second.unsubscribe()
+    ws.unsubscribe.assert_called_once_with('upstream-1')
+    assert not _websockets._SharedSubscription._registry
+
+
+def test_passthru_resubscribe_new_params(ws, passthru):
+    ws.unsubscribe = Mock()
+    func = passthru('client-1', 1, 2)
+    func(3, 4)
+    ws.unsubscribe.assert_called_once_with('upstream-1')
+    assert func.dst_client not in [None, 'upstream-1']
+
+
 def test_preprocess_call(ws, returner):
     ws.preprocess = lambda method, params: ['mock_modified_params']
     assert 123 == ws.call('foo.bar')
-    ws._send.assert_called_with(method='foo.bar', params=['mock_modified_params'], callback='xxx')
+    ws._send.assert_called_with(method='foo.bar', params=['mock_modified_params'], callback='xxx', timeout=10)
+
+
+def test_call_sends_remaining_deadline(returner):
+    threadlocal.reset(deadline=time.time() + 5)
+    assert 123 == returner.call('foo.bar')
+    assert 4 < returner._send.call_args[1]['timeout'] <= 5
+
+
+def test_call_async_traced(ws, monkeypatch):
+    exporter = _tracing._SpanExporter()
+    monkeypatch.setattr(_tracing, '_exporter', exporter)
+    ws._send = Mock(side_effect=lambda **kwargs: setattr(ws, 'sent_traceparent', _tracing.current_traceparent()))
+    with trace_span('outer') as outer:
+        future = ws.call_async('foo.bar')
+    assert [span['name'] for span in exporter.spans] == ['outer']
+
+    ws._dispatch({'callback': 'xxx', 'data': 123})
+    assert future.result() == 123
+    client = exporter.spans[1]
+    assert client['name'] == 'foo.bar' and client['kind'] == 'client' and client['parent_id'] == outer.span_id
+    assert ws.sent_traceparent == '00-{trace_id}-{span_id}-01'.format(**client)
+
+
+def test_send_includes_traceparent(monkeypatch):
+    ws = WebSocket(connect_immediately=False)
+    ws.ws = Mock(connected=True)
+    ws._send(method='foo.bar')
+    assert 'traceparent' not in ws.ws.send.call_args[0][0]
+    with trace_span('outer') as outer:
+        ws._send(method='foo.bar')
+    assert ws.ws.send.call_args[0][0]['traceparent'] == outer.traceparent
+
+
+def test_call_past_deadline(ws):
+    threadlocal.reset(deadline=time.time() - 1)
+    pytest.raises(DeadlineExceeded, ws.call, 'foo.bar')
+    assert not ws._send.called
 
 
 def test_preprocess_subscribe(ws):
@@ -211,6 +631,59 @@ def test_preprocess_subscribe(ws):
         'client': 'xxx',
         'callback': callback,
         'method': 'foo.bar',
-        'params': ['mock_modified_params']
+        'params': ['mock_modified_params'],
+        'last_used': ANY
     }
     ws._send.assert_called_with(method='foo.bar', params=['mock_modified_params'], client='xxx')
+
+
+@pytest.fixture
+def multi(monkeypatch):
+    monkeypatch.setattr(_websockets, 'on_startup', Mock())
+    monkeypatch.setattr(_websockets, 'on_shutdown', Mock())
+
+    class Total(MultiSubscription):
+        aggregate = 0
+
+        def merge(self, aggregate, result, previous, ws):
+            return aggregate + result - (previous or 0)
+
+    multi = Total(['host1', 'host2', 'host3'], 'foo.bar')
+    for i in range(3):
+        multi.websockets['host{}'.format(i + 1)] = Mock(url='ws://host{}/ws'.format(i + 1))
+    return multi
+
+
+def test_multi_subscription_merge(multi):
+    ws1, ws2, ws3 = multi.websockets.values()
+    multi._callback(5, ws1)
+    multi._callback(7, ws2)
+    multi._callback(2, ws1)
+    assert multi.aggregate == 9 and multi.results == {ws1: 2, ws2: 7}
+
+
+def test_multi_subscription_refresh_in_parallel(multi):
+    ws1, ws2, ws3 = multi.websockets.values()
+    multi._callback(10, ws3)
+    futures = [Future(), Future(), Future()]
+    for ws, future in zip([ws1, ws2, ws3], futures):
+        ws.call_async.return_value = future
+    futures[0].set_result(1)
+    futures[1].set_exception(Exception('boom'))
+    Thread(target=lambda: time.sleep(0.05) or futures[2].set_result(3)).start()
+
+    assert multi.refresh(timeout=1) == {ws1: 1, ws3: 3}
+    assert all(ws.call_async.call_args == (('foo.bar',), {}) for ws in [ws1, ws2, ws3])
+    assert multi.aggregate == 4
+
+
+def test_multi_subscription_refresh_partial(multi):
+    ws1, ws2, ws3 = multi.websockets.values()
+    ws1.call_async.return_value = Future()
+    ws2.call_async.side_effect = Exception('not connected')
+    ws3.call_async.return_value = Future()
+    ws3.call_async.return_value.set_result(3)
+    start = time.time()
+    assert multi.refresh(timeout=0.1) == {ws3: 3}
+    assert time.time() - start < 1
+    assert multi.results == {ws3: 3}
@@ -1,14 +1,16 @@
 from __future__ import unicode_literals
-from threading import RLock
+import time
+from threading import RLock, Event, Thread
 from collections import namedtuple
 
 import pytest
 from mock import Mock, ANY
 from ws4py.websocket import WebSocket
 
-from sideboard.lib import log, services, subscribes, threadlocal
-from sideboard.websockets import WebSocketDispatcher, responder, threadlocal
-from sideboard.tests import service_patcher
+from sideboard.lib import log, services, subscribes, singleflight, threadlocal, DeadlineExceeded
+from sideboard.lib import _tracing
+from sideboard.websockets import WebSocketDispatcher, Responder, responder, threadlocal, timeouts, _SingleFlight, _singleflights, _decorated_singleflights
+from sideboard.tests import service_patcher, config_patcher
 from sideboard.tests.test_websocket import ws
 
 mock_session_data = {'username': 'mock_user', 'user_id': 'mock_id'}
@@ -207,7 +209,9 @@ def test_remote_unsubscribe(wsd, ws):
     ws.unsubscribe = Mock()
     ws._next_id = Mock(return_value='yyy')
     threadlocal.reset(websocket=wsd, message={'client': 'xxx'})
-    wsd.cached_queries['xxx'] = {None: (ws.make_caller('remote.foo'), (), {}, {})}
+    func = ws.make_caller('remote.foo')
+    func()
+    wsd.cached_queries['xxx'] = {None: (func, (), {}, {})}
     wsd.unsubscribe('xxx')
     ws.unsubscribe.assert_called_with('yyy')
 
@@ -238,6 +242,27 @@ def test_update_subscriptions_with_multiple_channels(wsd):
     assert WebSocketDispatcher.subscriptions['baz'][wsd]['client-0'] == {'callback-0'}
 
 
+def test_check_liveness(wsd, monkeypatch, config_patcher):
+    config_patcher(5, 'ws.ping_interval')
+    config_patcher(1, 'ws.ping_misses')
+    wsd.sock = Mock()
+    wsd.check_liveness()
+    assert WebSocket.send.call_args[0][1].data == b'0'
+
+    wsd.check_liveness()  # not due yet
+    assert WebSocket.send.call_count == 1
+
+    wsd.liveness.last_ping -= 5
+    wsd.check_liveness()
+    assert WebSocket.send.call_count == 1 and wsd.sock.shutdown.called
+
+
+def test_check_liveness_disabled(wsd, config_patcher):
+    config_patcher(0, 'ws.ping_interval')
+    wsd.check_liveness()
+    assert not WebSocket.send.called
+
+
 @pytest.fixture
 def trig(wsd):
     wsd.cached_queries['xxx']['yyy'] = (lambda *args, **kwargs: [args, kwargs], ('a', 'b'), {'c': 'd'}, {})
@@ -380,6 +405,106 @@ def test_received_non_dict(receiver):
     assert log.error.called
 
 
+@pytest.fixture
+def pooled(config_patcher):
+    config_patcher({
+        'reports': {'threads': 2, 'max_queue': 1, 'methods': ['reports']},
+        'fast': {'threads': 1, 'max_queue': 0, 'methods': ['reports.summary']}
+    }, 'ws.pools')
+    return Responder()
+
+
+def test_responder_pool_routing(pooled):
+    assert pooled.get_pool('reports.monthly') is pooled.pools['reports']
+    assert pooled.get_pool('reports.summary') is pooled.pools['fast']
+    assert pooled.get_pool('foo.bar') is pooled.default
+    assert pooled.get_pool(None) is pooled.default
+
+
+def test_responder_pool_named_default(config_patcher):
+    config_patcher({'default': {'threads': 1, 'max_queue': 0, 'methods': ['reports']}}, 'ws.pools')
+    pytest.raises(AssertionError, Responder)
+
+
+def test_responder_pool_rejects_when_full(pooled):
+    ws = Mock()
+    pooled.defer(ws, {'method': 'reports.monthly', 'callback': 'xxx'})
+    assert not ws.send.called
+    pooled.defer(ws, {'method': 'reports.monthly', 'callback': 'yyy'})
+    ws.send.assert_called_with(error=ANY, callback='yyy', client=None)
+    assert pooled.stats['reports']['queued'] == 1
+    assert pooled.stats['reports']['rejected'] == 1
+    assert pooled.stats['default']['rejected'] == 0
+
+
+def test_responder_pool_handles_message(pooled):
+    ws = Mock()
+    pool = pooled.pools['reports']
+    pool.handle(ws, {'method': 'reports.monthly'})
+    ws.handle_message.assert_called_with({'method': 'reports.monthly'}, deadline=None)
+    assert pool.stats['completed'] == 1
+    assert pool.stats['peak_busy'] == 1
+    assert pool.stats['busy'] == 0
+    assert pool.stats['latency']['interactive']['count'] == 1
+
+
+def test_responder_pool_deadline(pooled):
+    ws = Mock()
+    pooled.default.handle(ws, {'method': 'foo.bar', 'timeout': 5}, queued_at=1000)
+    ws.handle_message.assert_called_with({'method': 'foo.bar', 'timeout': 5}, deadline=1005)
+
+
+def test_responder_pool_classification(pooled):
+    classify = pooled.default.classify
+    assert classify({'method': 'foo.bar', 'callback': 'xxx'}) == 'interactive'
+    assert classify({'method': 'foo.bar', 'client': 'xxx'}) == 'subscription'
+    assert classify({'action': 'unsubscribe', 'client': 'xxx'}) == 'internal'
+
+
+def test_responder_pool_flow(pooled, wsd):
+    assert pooled.default.flow(wsd) == (('user_id', 'mock_id'), ('username', 'mock_user'))
+    wsd.session_fields = {'username': None}
+    assert pooled.default.flow(wsd) is wsd
+
+
+def test_responder_pool_weight(pooled, wsd, config_patcher, monkeypatch):
+    assert pooled.default.weight(wsd) == 1
+    monkeypatch.setattr(WebSocketDispatcher, 'flow_weight', 2)
+    assert pooled.default.weight(wsd) == 2
+    config_patcher({'mock_user': 3}, 'ws.flow_weights')
+    assert pooled.default.weight(wsd) == 3
+    assert pooled.default.weight(Mock(session_fields={'username': 'other'})) == 1
+
+
+def test_responder_pool_weighted_scheduling(pooled, config_patcher):
+    config_patcher({'heavy': 2}, 'ws.flow_weights')
+    pool, heavy_ws, other_ws = pooled.default, Mock(session_fields={'username': 'heavy'}), Mock(session_fields={'username': 'other'})
+    for i in range(4):
+        pool.defer(heavy_ws, {'method': 'foo.sub', 'client': 'heavy{}'.format(i)})
+    for i in range(2):
+        pool.defer(other_ws, {'method': 'foo.sub', 'client': 'other{}'.format(i)})
+    order = [pool.q.get_nowait()[0][1]['client'] for i in range(pool.q.qsize())]
+    assert order == ['heavy0', 'heavy1', 'other0', 'heavy2', 'heavy3', 'other1']
+
+
+def test_responder_pool_scheduling(pooled):
+    pool, busy_ws, other_ws = pooled.default, Mock(session_fields={'username': 'busy'}), Mock(session_fields={'username': 'other'})
+    for i in range(3):
+        pool.defer(busy_ws, {'method': 'foo.sub', 'client': i})
+    pool.defer(other_ws, {'method': 'foo.sub', 'client': 'other'})
+    pool.defer(other_ws, {'action': 'unsubscribe', 'client': 'other'})
+    pool.defer(busy_ws, {'method': 'foo.bar', 'callback': 'xxx'})
+    order = [pool.q.get_nowait()[0][1] for i in range(pool.q.qsize())]
+    assert order == [
+        {'method': 'foo.bar', 'callback': 'xxx'},
+        {'method': 'foo.sub', 'client': 0},
+        {'method': 'foo.sub', 'client': 'other'},
+        {'method': 'foo.sub', 'client': 1},
+        {'action': 'unsubscribe', 'client': 'other'},
+        {'method': 'foo.sub', 'client': 2}
+    ]
+
+
 @pytest.fixture
 def handler(ws, wsd, service_patcher, monkeypatch):
     service_patcher('remote', ws)
@@ -427,6 +552,20 @@ def test_handle_method_with_client(handler):
     assert not log.error.called
 
 
+def test_handle_message_traced(handler, monkeypatch):
+    exporter = _tracing._SpanExporter()
+    monkeypatch.setattr(_tracing, '_exporter', exporter)
+    services.foo.bar.side_effect = lambda *args: _tracing.current_traceparent()
+    handler.handle_message({'method': 'foo.bar', 'callback': 'xxx', 'traceparent': '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'})
+    handler.handle_message({'method': 'foo.err', 'callback': 'yyy'})
+
+    traced, failed = exporter.spans
+    assert traced['name'] == 'foo.bar' and traced['kind'] == 'server' and not traced['error']
+    assert traced['trace_id'] == '0af7651916cd43dd8448eb211c80319c' and traced['parent_id'] == 'b7ad6b7169203331'
+    assert handler.send.call_args_list[0][1]['data'] == '00-{trace_id}-{span_id}-01'.format(**traced)
+    assert failed['name'] == 'foo.err' and failed['error'] and failed['trace_id'] != traced['trace_id']
+
+
 def test_handle_message_client_error(handler):
     message = {'method': 'foo.err', 'client': 'xxx'}
     handler.handle_message(message)
@@ -484,3 +623,135 @@ def test_explicit_call_resets_cache(service_patcher, wsd):
     assert WebSocket.send.call_count == 1
     wsd.handle_message(message)
     assert WebSocket.send.call_count == 2
+
+
+def test_time_remaining():
+    assert threadlocal.time_remaining() is None
+    threadlocal.check_deadline()
+    threadlocal.reset(deadline=time.time() + 5)
+    assert 4 < threadlocal.time_remaining() <= 5
+    threadlocal.check_deadline()
+    threadlocal.reset(deadline=time.time() - 1)
+    pytest.raises(DeadlineExceeded, threadlocal.check_deadline)
+
+
+def test_handle_message_with_deadline(handler):
+    handler.handle_message({'method': 'foo.bar', 'callback': 'xxx', 'timeout': 5})
+    assert 4 < threadlocal.time_remaining() <= 5
+    handler.send.assert_called_with(data='baz', callback='xxx', client=None, _time=ANY)
+
+
+def test_handle_message_past_deadline(handler, monkeypatch):
+    monkeypatch.setitem(timeouts, 'foo.bar', 0)
+    handler.handle_message({'method': 'foo.bar', 'callback': 'xxx'}, deadline=time.time() - 1)
+    threadlocal.reset()
+    assert not services.foo.bar.called
+    handler.send.assert_called_with(error=ANY, callback='xxx', client=None)
+    assert 'deadline exceeded' in handler.send.call_args[1]['error']
+    assert timeouts['foo.bar'] == 1
+    assert not log.error.called
+
+
+@pytest.fixture
+def flight():
+    flight = _SingleFlight('foo.bar', ['username'])
+    flight.release, flight.ran = Event(), []
+
+    def func(x):
+        flight.ran.append(x)
+        flight.release.wait(5)
+        if x == 'err':
+            raise ValueError(x)
+        return [x]
+
+    def call(x, **fields):
+        threadlocal.reset(**fields)
+        try:
+            return flight.call(func, x)
+        except Exception as e:
+            return e
+
+    def run(*calls):
+        results = {}
+        threads = [Thread(target=lambda i=i, args=args: results.setdefault(i, call(*args[:1], **args[1]))) for i, args in enumerate(calls)]
+        for thread in threads:
+            thread.start()
+        for i in range(50):
+            if flight.calls == len(calls):
+                break
+            time.sleep(0.01)
+        flight.release.set()
+        for thread in threads:
+            thread.join()
+        return [results[i] for i in range(len(calls))]
+
+    flight.run = run
+    return flight
+
+
+def test_singleflight_shares_concurrent_calls(flight):
+    results = flight.run(*[(1, {'username': 'a'})] * 5)
+    assert flight.ran == [1] and flight.shared == 4
+    assert all(result is results[0] for result in results)
+
+
+def test_singleflight_separates_args_and_scope(flight):
+    flight.run((1, {'username': 'a'}), (2, {'username': 'a'}), (1, {'username': 'b'}), (1, {'username': 'b', 'other': 'x'}))
+    assert sorted(flight.ran) == [1, 1, 2] and flight.shared == 1
+
+
+def test_singleflight_shares_errors(flight):
+    results = flight.run(('err', {}), ('err', {}))
+    assert flight.ran == ['err']
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_singleflight_runs_again_after_completion(flight):
+    flight.release.set()
+    flight.run((1, {}))
+    flight.run((1, {}))
+    assert flight.ran == [1, 1] and flight.shared == 0
+
+
+def test_singleflight_waiter_deadline(flight):
+    Thread(target=flight.call, args=[lambda: flight.release.wait(5)]).start()
+    time.sleep(0.05)
+    threadlocal.reset(deadline=time.time() + 0.05)
+    try:
+        pytest.raises(DeadlineExceeded, flight.call, lambda: 'not called')
+    finally:
+        flight.release.set()
+
+
+def test_singleflight_decorator():
+    @subscribes('foo')
+    @singleflight(scope=[])
+    def baz(x):
+        return x
+
+    assert baz(5) == 5 and baz.subscribes == ['foo'] and baz.__name__ == 'baz'
+    assert _decorated_singleflights[__name__ + '.baz'].calls == 1
+    assert __name__ + '.baz' not in _singleflights
+
+
+def test_handle_message_singleflight_decorated_and_configured(handler, service_patcher, config_patcher, monkeypatch):
+    def baz(x):
+        return x
+    baz.__module__ = 'qux'  # services are registered under their module name by default
+    baz = singleflight(scope=[])(baz)
+
+    monkeypatch.setattr('sideboard.websockets._singleflights', {})
+    service_patcher('qux', {'baz': baz})
+    config_patcher(['qux'], 'ws.singleflight')
+    handler.handle_message({'method': 'qux.baz', 'params': [5], 'callback': 'xxx'}, deadline=time.time() + 1)
+    handler.send.assert_called_with(data=5, callback='xxx', client=None, _time=ANY)
+    assert baz.singleflight.calls == 1
+
+
+def test_handle_message_singleflight_config(handler, config_patcher, monkeypatch):
+    flights = {}
+    monkeypatch.setattr('sideboard.websockets._singleflights', flights)
+    config_patcher(['foo'], 'ws.singleflight')
+    handler.handle_message({'method': 'foo.bar', 'callback': 'xxx'})
+    handler.send.assert_called_with(data='baz', callback='xxx', client=None, _time=ANY)
+    assert flights['foo.bar'].calls == 1
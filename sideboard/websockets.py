@@ -2,23 +2,30 @@ from __future__ import unicode_literals
 import sys
 import json
 import time
+import socket
 import hashlib
 import logging
 import traceback
 from copy import deepcopy
 from functools import wraps
-from threading import local, RLock
+from itertools import chain
+from threading import local, RLock, Lock, Event
 from collections import defaultdict
 
 import six
 import cherrypy
+from six.moves.queue import Queue, Full
 
 from ws4py.websocket import WebSocket
+from ws4py.messaging import PingControlMessage
 from ws4py.server.cherrypyserver import WebSocketPlugin, WebSocketTool
 
 import sideboard.lib
-from sideboard.lib import log, class_property, Caller
+from sideboard.lib import log, class_property, Caller, DaemonTask, FairQueue
+from sideboard.lib._websockets import _Subscriber, _Liveness, _RttHistogram
+from sideboard.lib._tracing import start_span, _exporter
 from sideboard.config import config
+from sideboard.debugging import register_diagnostics_status_function
 
 local_subscriptions = defaultdict(list)
 DELAYED_NOTIFICATIONS_KEY = 'sideboard.delayed_notifications'
@@ -48,6 +55,11 @@ class threadlocal(object):
         -> client_data: see the client_data property below for an explanation
         -> message: the RPC request body; this is present on the initial call
             but not on subscription triggers in the broadcast thread
+
+    Additionally, both JSON-RPC and websocket calls may have a "deadline" field
+    set, which is the absolute time.time() value after which the caller will no
+    longer be waiting for a response; see the time_remaining and check_deadline
+    methods below.
     """
     _threadlocal = local()
 
@@ -89,6 +101,28 @@ class threadlocal(object):
         for key, val in kwargs.items():
             cls.set(key, val)
 
+    @classmethod
+    def time_remaining(cls):
+        """
+        Returns the number of seconds until the deadline of the current request,
+        which may be zero or negative if the deadline has already passed, or
+        None if the current request has no deadline.
+        """
+        deadline = cls.get('deadline')
+        return None if deadline is None else deadline - time.time()
+
+    @classmethod
+    def check_deadline(cls):
+        """
+        Raises DeadlineExceeded if the current request has a deadline which has
+        already passed.  Sideboard calls this before dispatching to a service
+        or making a remote call, and long-running service methods may call this
+        periodically to stop working on a result nobody is waiting for.
+        """
+        remaining = cls.time_remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded('deadline exceeded by {:.3f} seconds'.format(-remaining))
+
     @class_property
     def client_data(cls):
         """
@@ -99,6 +133,38 @@ class threadlocal(object):
         return cls.setdefault('client_data', {})
 
 
+class DeadlineExceeded(Exception):
+    """
+    Exception raised when the deadline of the current request has passed, which
+    means that the caller has already given up waiting for the response.
+    """
+
+
+def get_deadline(timeout, default=0, start=None):
+    """
+    Given the (possibly missing) "timeout" field of an incoming RPC message, in
+    seconds relative to when the message was received, return the absolute
+    deadline for that request, or None if there is no deadline.  If no timeout
+    was given, the default timeout is used instead, where 0 means no deadline.
+    """
+    try:
+        timeout = float(timeout if timeout is not None else default)
+    except (TypeError, ValueError):
+        log.warning('ignoring invalid timeout value %r', timeout)
+        timeout = default
+    return (start or time.time()) + timeout if timeout else None
+
+
+_timeouts_lock = RLock()
+timeouts = defaultdict(int)
+
+
+def record_timeout(method):
+    """Increments the count of deadlines exceeded by calls to the given method."""
+    with _timeouts_lock:
+        timeouts[method] += 1
+
+
 def _normalize_channels(*channels):
     """
     Converts a list of types, strings, or whatever else into a list of strings.
@@ -273,6 +339,118 @@ def locally_subscribes(*args):
     return decorated_func
 
 
+class _SingleFlight(object):
+    """
+    Collapses concurrent calls to a function with the same arguments (and the
+    same values of the given threadlocal fields) into a single call, whose
+    result or exception is returned to every caller.  Calls made after that
+    shared call has finished run the function again as normal.
+    """
+    def __init__(self, name, scope):
+        self.name, self.scope = name, scope
+        self.lock = RLock()
+        self.in_flight = {}
+        self.calls = self.shared = 0
+
+    def _key(self, args, kwargs):
+        try:
+            return _fingerprint([args, kwargs, [threadlocal.get(field) for field in self.scope]])
+        except Exception:
+            return None
+
+    def call(self, func, *args, **kwargs):
+        key = self._key(args, kwargs)
+        if key is None:
+            return func(*args, **kwargs)
+
+        with self.lock:
+            self.calls += 1
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = {'done': Event()}
+            else:
+                self.shared += 1
+
+        if leader:
+            try:
+                flight['result'] = func(*args, **kwargs)
+                return flight['result']
+            except:
+                flight['error'] = sys.exc_info()[1]
+                raise
+            finally:
+                with self.lock:
+                    del self.in_flight[key]
+                flight['done'].set()
+
+        if not flight['done'].wait(threadlocal.time_remaining()):
+            raise DeadlineExceeded('gave up waiting for the shared call to {}'.format(self.name))
+        if 'error' in flight:
+            raise flight['error']
+        return flight['result']
+
+
+# flights for methods enabled by the ws.singleflight config option, keyed by
+# "service.method", and flights created by the @singleflight decorator, keyed
+# by "module.function", which are only kept here for the diagnostics page
+_singleflights, _decorated_singleflights, _singleflights_lock = {}, {}, RLock()
+
+
+def _get_singleflight(method, func=None):
+    """
+    Returns the _SingleFlight for the given "service.method" if either that
+    method or its service is listed in the ws.singleflight config option,
+    unless the function being called has already been wrapped by the
+    @singleflight decorator.
+    """
+    if isinstance(getattr(func, 'singleflight', None), _SingleFlight):
+        return None
+
+    with _singleflights_lock:
+        if method not in _singleflights:
+            enabled = {method, method.split('.')[0]}.intersection(config['ws.singleflight'])
+            _singleflights[method] = _SingleFlight(method, config['ws.session_fields']) if enabled else None
+        return _singleflights[method]
+
+
+def singleflight(func=None, scope=None):
+    """
+    Decorator for service methods which makes concurrent calls with the same
+    arguments share a single execution, e.g. when dozens of clients load the
+    same page at once and all ask for the same expensive report:
+
+    @singleflight
+    def monthly_report(year, month):
+        ...
+
+    Calls are only shared between requests with the same values for each of
+    the threadlocal fields listed in scope, which defaults to the session fields
+    in the ws.session_fields config option so that users never receive results
+    computed for someone else.  Pass scope=[] for methods whose results are the
+    same for everyone:
+
+    @singleflight(scope=[])
+    def holidays(year):
+        ...
+
+    Only the first call actually runs the method, so this shouldn't be used on
+    methods with side effects which need to happen for every call.
+    """
+    def decorated_func(func):
+        flight = _SingleFlight(func.__name__, config['ws.session_fields'] if scope is None else sideboard.lib.listify(scope))
+        with _singleflights_lock:
+            _decorated_singleflights['{}.{}'.format(func.__module__, func.__name__)] = flight
+
+        @wraps(func)
+        def singleflight_func(*args, **kwargs):
+            return flight.call(func, *args, **kwargs)
+        singleflight_func.singleflight = flight
+        return singleflight_func
+
+    return decorated_func(func) if func is not None else decorated_func
+
+
 def local_broadcast(channels, trigger=None, originating_client=None):
     """Triggers callbacks registered via @locally_subscribes"""
     triggered = set()
@@ -376,6 +554,13 @@ class WebSocketDispatcher(WebSocket):
     adding and removing their subscriptions from this data structure.
     """
 
+    flow_weight = 1
+    """
+    How many of this connection's calls the ResponderPool runs per round-robin
+    turn between users; subclasses for trusted high-volume clients may raise
+    this, and the [ws.flow_weights] config section overrides it per user.
+    """
+
     instances = set()
     """
     When debugging Sideboard, it can be useful to introspect a list of all
@@ -405,6 +590,9 @@ class WebSocketDispatcher(WebSocket):
         header_fields: We copy header fields from the request that initiated the
             websocket connection.
 
+        liveness: Tracks the websocket pings we send to the client to make sure
+            it's still there, and the round trip times of their pongs.
+
         cached_queries and cached_fingerprints: When we receive a subscription
             update, Sideboard re-runs all of the subscription methods to see if
             new data needs to be pushed out.  We do this by storing all of the
@@ -436,6 +624,7 @@ class WebSocketDispatcher(WebSocket):
         self.passthru_subscriptions = {}
         self.client_locks = defaultdict(RLock)
         self.cached_queries, self.cached_fingerprints = defaultdict(dict), defaultdict(dict)
+        self.liveness = _Liveness()
         self.session_fields = self.check_authentication()
         self.header_fields = self.fetch_headers()
 
@@ -585,6 +774,31 @@ class WebSocketDispatcher(WebSocket):
             if not self.is_closed:
                 WebSocket.send(self, message)
 
+    def ponged(self, pong):
+        self.liveness.ponged(pong.data)
+
+    def check_liveness(self):
+        """
+        This is called every second or so by a background thread for every open
+        websocket.  Every ws.ping_interval seconds we send a websocket ping, and
+        if the last ws.ping_misses pings haven't been answered then we assume
+        the client is gone and shut down the socket, which then closes this
+        websocket and cleans up its subscriptions as usual.
+        """
+        if self.is_closed or not self.liveness.ping_due:
+            return
+
+        if self.liveness.dead:
+            log.warning('no response to the last %s pings sent to websocket for %s, closing connection', self.liveness.missed, self.session_fields)
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except:
+                log.debug('error shutting down unresponsive websocket', exc_info=True)
+        else:
+            with self.send_lock:
+                if not self.is_closed:
+                    WebSocket.send(self, PingControlMessage(self.liveness.ping()))
+
     def closed(self, code, reason=''):
         """
         This overrides the default closed handler to first clean up all of our
@@ -654,7 +868,14 @@ class WebSocketDispatcher(WebSocket):
         if callback in self.cached_queries[client]:
             function, args, kwargs, client_data = self.cached_queries[client][callback]
             threadlocal.reset(websocket=self, client_data=client_data, headers=self.header_fields, **self.session_fields)
-            result = function(*args, **kwargs)
+            deadline = get_deadline(None, config['ws.trigger_timeout'])
+            if deadline:
+                threadlocal.set('deadline', deadline)
+            try:
+                result = function(*args, **kwargs)
+            except DeadlineExceeded:
+                record_timeout(getattr(function, '__name__', repr(function)))
+                raise
             self.send(trigger=trigger, client=client, callback=callback, data=result)
 
     def update_triggers(self, client, callback, function, args, kwargs, result, duration=None):
@@ -714,39 +935,63 @@ class WebSocketDispatcher(WebSocket):
             log.debug('received %s', fields)
             responder.defer(self, fields)
 
-    def handle_message(self, message):
+    def handle_message(self, message, deadline=None):
         """
         Given a message dictionary, perform the relevant RPC actions and send
         out the response.  This function is called from a pool of background
         threads
+
+        If the message has a "timeout" field, the request's deadline is that
+        many seconds after the message was received (the responder pools pass
+        that in as the deadline parameter).  If the deadline passes while the
+        message is still waiting in the queue, we return an error without
+        calling the method at all.
+
+        Each method call is recorded as a tracing span, which continues the
+        trace given by the message's "traceparent" field if it has one.
         """
         before = time.time()
-        duration, result = None, None
+        duration, result, error = None, None, None
         threadlocal.reset(websocket=self, message=message, headers=self.header_fields, **self.session_fields)
+        deadline = deadline or get_deadline(message.get('timeout'), config['ws.default_timeout'], before)
+        if deadline:
+            threadlocal.set('deadline', deadline)
         action, callback, client, method = message.get('action'), message.get('callback'), message.get('client'), message.get('method')
+        span = method and start_span(method, kind='server', traceparent=message.get('traceparent'))
         try:
             with self.client_lock(client):
                 self.internal_action(action, client, callback)
                 if method:
                     self.clear_cached_response(client, callback)
+                    threadlocal.check_deadline()
                     func = self.get_method(method)
                     args, kwargs = get_params(message.get('params'))
                     result = self.NO_RESPONSE
+                    flight = not isinstance(func, _Subscriber) and _get_singleflight(method, func)
                     try:
-                        result = func(*args, **kwargs)
+                        result = flight.call(func, *args, **kwargs) if flight else func(*args, **kwargs)
                         duration = (time.time() - before) if config['debug'] else None
                     finally:
                         trigger_delayed_notifications()
                         self.update_triggers(client, callback, func, args, kwargs, result, duration)
+        except DeadlineExceeded as e:
+            error = e
+            record_timeout(method)
+            log.warning('abandoning call to %s: %s', method, e)
+            self.send(error='{}: {}'.format(method, e), callback=callback, client=client)
         except:
             log.error('unexpected websocket dispatch error', exc_info=True)
             exc_class, exc, tb = sys.exc_info()
+            error = exc
             str_content = str(exc) or 'Unexpected Error.'
             message = (str_content + '\n' + traceback.format_exc()) if config['debug'] else str_content
             self.send(error=message, callback=callback, client=client)
         else:
             if callback is not None and result is not self.NO_RESPONSE:
                 self.send(data=result, callback=callback, client=client, _time=duration)
+        finally:
+            if span:
+                span.finish(error)
 
     def __repr__(self):
         return '<{} {}>'.format(
@@ -795,4 +1040,228 @@ websocket_plugin.subscribe()
 
 local_broadcaster = Caller(local_broadcast)
 broadcaster = Caller(WebSocketDispatcher.broadcast)
-responder = Caller(WebSocketDispatcher.handle_message, threads=config['ws.thread_pool'])
+
+
+class ResponderPool(Caller):
+    """
+    A pool of threads which executes incoming websocket messages with its own
+    concurrency limit and (optionally) bounded queue.  Each pool keeps simple
+    counters so we can tell at a glance which pools are saturated.
+
+    Messages are scheduled by priority class and then fairly between users:
+
+    -> interactive: method calls without a client id, i.e. one-off calls whose
+        caller is waiting on the response rather than a subscription; these
+        always run first
+    -> subscription: method calls which set up or refresh a subscription
+    -> internal: internal actions such as "unsubscribe"; these share the
+        subscription class so that they are never reordered relative to the
+        subscription calls for the same client
+
+    Within a class, each user (as identified by the ws.session_fields values of
+    the connection, or the connection itself for anonymous connections) gets
+    a turn in round-robin order, so one page opening hundreds of subscriptions
+    doesn't delay every other user's calls.  Each turn is one call unless the
+    user has a weight in the [ws.flow_weights] config section, or the
+    connection's class sets flow_weight.
+    """
+    PRIORITIES = {'interactive': 0, 'subscription': 1, 'internal': 1}
+
+    def __init__(self, name, threads, max_queue=0):
+        Caller.__init__(self, self.handle, threads=threads, name=name, queue=FairQueue(max_queue))
+        self.max_queue = max_queue
+        self.stats_lock = Lock()
+        self.busy = self.peak_busy = self.completed = self.rejected = 0
+        self.latency = defaultdict(lambda: defaultdict(float))
+
+    @staticmethod
+    def classify(message):
+        """
+        Returns the priority class of the message: 'internal' if it doesn't
+        call a method, 'subscription' if it has a client id, and otherwise
+        'interactive' (whether or not it has a callback).
+        """
+        if not message.get('method'):
+            return 'internal'
+        elif message.get('client') is None:
+            return 'interactive'
+        else:
+            return 'subscription'
+
+    @staticmethod
+    def flow(websocket):
+        session_fields = getattr(websocket, 'session_fields', None)
+        if isinstance(session_fields, dict) and any(val is not None for val in session_fields.values()):
+            return tuple(sorted((field, six.text_type(val)) for field, val in session_fields.items()))
+        else:
+            return websocket
+
+    @staticmethod
+    def weight(websocket):
+        """
+        Returns how many calls the connection's flow may take per turn: the
+        largest weight in [ws.flow_weights] for any of its session field values,
+        otherwise the flow_weight of its class, otherwise 1.
+        """
+        session_fields = getattr(websocket, 'session_fields', None)
+        if isinstance(session_fields, dict):
+            weights = [config['ws.flow_weights'][six.text_type(val)] for val in session_fields.values()
+                       if val is not None and six.text_type(val) in config['ws.flow_weights']]
+            if weights:
+                return max(weights)
+        weight = getattr(type(websocket), 'flow_weight', 1)
+        return weight if isinstance(weight, six.integer_types) else 1
+
+    def handle(self, websocket, message, priority_class='interactive', queued_at=None):
+        started = time.time()
+        with self.stats_lock:
+            self.busy += 1
+            self.peak_busy = max(self.peak_busy, self.busy)
+        try:
+            websocket.handle_message(message, deadline=get_deadline(message.get('timeout'), config['ws.default_timeout'], queued_at))
+        finally:
+            finished = time.time()
+            waited = started - queued_at if queued_at else 0
+            with self.stats_lock:
+                self.busy -= 1
+                self.completed += 1
+                latency = self.latency[priority_class]
+                latency['count'] += 1
+                latency['wait'] += waited
+                latency['run'] += finished - started
+                latency['max_wait'] = max(latency['max_wait'], waited)
+                latency['max_run'] = max(latency['max_run'], finished - started)
+
+    def defer(self, websocket, message):
+        """
+        Queue a message for execution, raising Queue.Full without blocking if
+        this pool's queue is bounded and already at capacity.
+        """
+        priority_class = self.classify(message)
+        try:
+            self.q.put([[websocket, message], {'priority_class': priority_class, 'queued_at': time.time()}],
+                       block=False, priority=self.PRIORITIES[priority_class], flow=self.flow(websocket),
+                       weight=self.weight(websocket))
+        except Full:
+            with self.stats_lock:
+                self.rejected += 1
+            raise
+
+    @property
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'threads': self.thread_count,
+                'busy': self.busy,
+                'peak_busy': self.peak_busy,
+                'queued': self.q.qsize(),
+                'max_queue': self.max_queue,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'latency': {
+                    priority_class: {
+                        'count': int(latency['count']),
+                        'avg_wait': latency['wait'] / latency['count'],
+                        'max_wait': latency['max_wait'],
+                        'avg_run': latency['run'] / latency['count'],
+                        'max_run': latency['max_run']
+                    } for priority_class, latency in self.latency.items()
+                }
+            }
+
+
+class Responder(object):
+    """
+    Routes incoming websocket messages to a ResponderPool.  Methods and services
+    listed in the [ws.pools] config section get their own pools, so that a slow
+    service can only tie up its own threads; everything else (including
+    internal actions like "unsubscribe") goes to the default pool, which has
+    ws.thread_pool threads and an unbounded queue.
+    """
+    def __init__(self):
+        self.default = ResponderPool('responder', config['ws.thread_pool'])
+        self.pools, self.routes = {}, {}
+        for name, opts in config['ws.pools'].items():
+            assert name != 'default', '[ws.pools] may not define a pool named "default", which is the name of the default pool'
+            pool = self.pools[name] = ResponderPool('responder-' + name, opts['threads'], opts['max_queue'])
+            for method in opts['methods']:
+                self.routes[method] = pool
+
+    def get_pool(self, method):
+        """
+        Returns the pool for a "service.method" string, preferring an exact
+        method mapping over a whole-service mapping over the default pool.
+        """
+        if method:
+            for key in [method, method.split('.')[0]]:
+                if key in self.routes:
+                    return self.routes[key]
+        return self.default
+
+    def defer(self, websocket, message):
+        method = message.get('method')
+        try:
+            self.get_pool(method).defer(websocket, message)
+        except Full:
+            log.warning('rejecting call to %s from %s because its responder pool is full', method, websocket)
+            websocket.send(error='server too busy to handle {}, please try again later'.format(method),
+                           callback=message.get('callback'), client=message.get('client'))
+
+    @property
+    def stats(self):
+        stats = {name: pool.stats for name, pool in self.pools.items()}
+        stats['default'] = self.default.stats
+        return stats
+
+responder = Responder()
+
+
+def check_websocket_liveness():
+    for websocket in list(WebSocketDispatcher.instances):
+        try:
+            websocket.check_liveness()
+        except:
+            log.warning('unable to ping websocket', exc_info=True)
+
+_liveness_checker = DaemonTask(check_websocket_liveness, name='ws_liveness')
+
+
+@register_diagnostics_status_function
+def singleflight_calls():
+    with _singleflights_lock:
+        flights = sorted((name, flight) for name, flight in chain(_singleflights.items(), _decorated_singleflights.items()) if flight)
+    return '\n'.join('{}: calls={} shared={}'.format(name, flight.calls, flight.shared) for name, flight in flights)
+
+
+@register_diagnostics_status_function
+def websocket_ping_times():
+    rtt = _RttHistogram()
+    for websocket in list(WebSocketDispatcher.instances):
+        rtt.merge(websocket.liveness.rtt)
+    return 'incoming connections: {} ({})'.format(len(WebSocketDispatcher.instances),
+                                                   ', '.join('{}={}'.format(k, v) for k, v in sorted(rtt.stats.items())))
+
+
+@register_diagnostics_status_function
+def slowest_recent_traces():
+    return '\n'.join('{trace_id}: {duration:.3f}s, {count} spans, starting with {name}'.format(
+                         count=len(trace['spans']), name=trace['spans'][0]['name'], **trace)
+                     for trace in sorted(_exporter.traces(limit=None), key=lambda trace: -trace['duration'])[:10])
+
+
+@register_diagnostics_status_function
+def rpc_timeouts():
+    with _timeouts_lock:
+        return '\n'.join('{}: {}'.format(method, count) for method, count in sorted(timeouts.items()))
+
+
+@register_diagnostics_status_function
+def websocket_responder_pools():
+    out = []
+    for name, stats in sorted(responder.stats.items()):
+        latency = stats.pop('latency')
+        out.append('{}: {}'.format(name, ', '.join('{}={}'.format(k, v) for k, v in sorted(stats.items()))))
+        for priority_class, timing in sorted(latency.items()):
+            out.append('    {}: count={count} avg_wait={avg_wait:.4f}s max_wait={max_wait:.4f}s '
+                       'avg_run={avg_run:.4f}s max_run={max_run:.4f}s'.format(priority_class, **timing))
+    return '\n'.join(out)